@@ -7,4 +7,29 @@ app = func.FunctionApp()
 @app.route(route="generar_documento", auth_level=func.AuthLevel.ANONYMOUS)
 def upload_log(req: func.HttpRequest) -> func.HttpResponse:
     import propia.de_1 as function_logic
-    return function_logic.main(req)
\ No newline at end of file
+    return function_logic.main(req)
+
+
+@app.function_name(name="completar_propuesta")
+@app.route(route="completar_propuesta/{document_id}", methods=["POST"], auth_level=func.AuthLevel.ANONYMOUS)
+def completar_propuesta(req: func.HttpRequest) -> func.HttpResponse:
+    import propia.de_1 as function_logic
+    return function_logic.completar(req)
+
+
+@app.function_name(name="metricas")
+@app.route(route="metricas", methods=["GET"], auth_level=func.AuthLevel.ANONYMOUS)
+def metricas(req: func.HttpRequest) -> func.HttpResponse:
+    import json
+    from propia import metricas as metricas_proceso, enrutador_openai, cache_semantico, admision, rutas_secciones
+    return func.HttpResponse(
+        json.dumps(dict(
+            metricas_proceso.instantanea(),
+            openai=enrutador_openai.estado_pool(),
+            cache_semantico=cache_semantico.estado(),
+            admision=admision.estado(),
+            rutas=rutas_secciones.estado()
+        )),
+        status_code=200,
+        mimetype="application/json"
+    )
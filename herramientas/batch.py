@@ -0,0 +1,145 @@
+"""
+Generación offline de propuestas con la Batch API de Azure OpenAI.
+
+Las secciones de todas las propuestas se envían en un solo trabajo batch (cuota y precio propios,
+sin competir con el tráfico en línea); cuando el trabajo termina, los documentos se arman, se suben
+y se registran en el manifiesto como cualquier otra propuesta.
+
+    # Enviar: un prompt por línea de un .jsonl ({"prompt": ..., "plantilla": {...}}) o de un .txt
+    python herramientas/batch.py enviar --conexion "$STORAGE_CONNECTION_STRING" --prompts nocturnas.jsonl
+    # Más tarde (o en seguida, esperando): armar los documentos
+    python herramientas/batch.py ensamblar --conexion "..." --batch-id batch_abc123
+
+    # Comparar con el camino en línea usando el servidor falso (que también imita la Batch API)
+    python herramientas/servidor_openai_falso.py --puerto 8101 --latencia 0.5 --demora-batch 5 &
+    azurite-blob --silent --location /tmp/azurite &
+    python herramientas/carga.py preparar --conexion "UseDevelopmentStorage=true"
+    python herramientas/batch.py comparar --conexion "UseDevelopmentStorage=true" \\
+        --openai http://127.0.0.1:8101/ --propuestas 32 --hilos 8
+
+El costo se estima con OPENAI_PRECIO_PROMPT_MTOK / OPENAI_PRECIO_COMPLETION_MTOK y el descuento
+BATCH_FACTOR_COSTO de la Batch API.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, ".")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def cargar_prompts(ruta):
+    with open(ruta, encoding="utf-8") as archivo:
+        if ruta.endswith(".jsonl"):
+            return [json.loads(linea) for linea in archivo if linea.strip()]
+        return [{"prompt": bloque.strip()} for bloque in archivo.read().split("\n\n\n") if bloque.strip()]
+
+
+def ejemplos(cantidad):
+    from carga import PROMPTS_BASE
+    return [
+        {"prompt": PROMPTS_BASE[indice % len(PROMPTS_BASE)].replace("\n", f" (lote {indice})\n", 1)}
+        for indice in range(cantidad)
+    ]
+
+
+def reportar_avance(trabajo):
+    conteos = trabajo.get("request_counts") or {}
+    print(f"  {trabajo['status']}: {conteos.get('completed', 0)}/{conteos.get('total', 0)} solicitudes", flush=True)
+
+
+def enviar(propia, args):
+    propuestas = cargar_prompts(args.prompts) if args.prompts else ejemplos(args.propuestas)
+    estado = propia.enviar_batch(propuestas)
+    print(f"Trabajo {estado['batch_id']}: {len(estado['propuestas'])} propuestas, {estado['solicitudes']} solicitudes")
+    return estado
+
+
+def ensamblar(propia, args, batch_id=None):
+    reporte = propia.ensamblar_batch(
+        batch_id or args.batch_id, esperar=not args.sin_esperar, intervalo=args.intervalo,
+        al_sondear=reportar_avance, hilos=args.hilos
+    )
+    print(json.dumps(reporte, ensure_ascii=False, indent=2))
+    return reporte
+
+
+def comparar(propia, args):
+    from propia import batch_openai
+
+    propuestas = ejemplos(args.propuestas)
+    # Contra el servidor falso el trabajo termina en segundos
+    args.intervalo = args.intervalo or 1.0
+
+    print(f"\nBatch ({args.propuestas} propuestas)")
+    inicio = time.perf_counter()
+    estado = propia.enviar_batch(propuestas)
+    reporte_batch = ensamblar(propia, args, estado["batch_id"])
+    duracion_batch = time.perf_counter() - inicio
+
+    print(f"\nEn línea ({args.hilos} hilos)")
+    resultados, errores = [], []
+
+    def una(propuesta):
+        try:
+            resultados.append(propia.procesar_propuesta_completa(propuesta["prompt"], str(uuid.uuid4())[:8]))
+        except Exception as e:
+            errores.append(str(e))
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.hilos) as executor:
+        list(executor.map(una, propuestas))
+    duracion_linea = time.perf_counter() - inicio
+    tokens_linea = batch_openai.sumar_uso(r["tokens"] for r in resultados)
+
+    print(f"\n{'':<12}{'propuestas':>12}{'errores':>10}{'duración s':>12}{'prop/hora':>12}{'tokens':>10}{'costo USD':>12}")
+    for nombre, completadas, fallidas, duracion, tokens, costo in (
+        ("batch", reporte_batch["ensambladas"], len(reporte_batch["errores"]), duracion_batch,
+         reporte_batch["tokens"]["total_tokens"], reporte_batch["costo_usd"]),
+        ("en línea", len(resultados), len(errores), duracion_linea,
+         tokens_linea["total_tokens"], batch_openai.costo(tokens_linea)),
+    ):
+        print(f"{nombre:<12}{completadas:>12}{fallidas:>10}{duracion:>12.1f}{completadas * 3600 / duracion:>12.0f}"
+              f"{tokens:>10}{costo:>12.4f}")
+    for error in errores[:3]:
+        print(f"  Error en línea: {error}")
+    print("\nEl modo batch no consume la cuota por minuto del despliegue en línea; su duración depende de la "
+          "ventana del trabajo (hasta BATCH_VENTANA), no de la latencia de cada llamada.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generación offline con la Batch API de Azure OpenAI")
+    parser.add_argument("accion", choices=["enviar", "ensamblar", "comparar"])
+    parser.add_argument("--conexion", required=True, help="Connection string de Blob Storage")
+    parser.add_argument("--openai", default=None, help="Endpoint de Azure OpenAI (o el falso)")
+    parser.add_argument("--prompts", default=None, help=".jsonl con {prompt, plantilla} o .txt separado por 2 líneas en blanco")
+    parser.add_argument("--propuestas", type=int, default=16, help="Propuestas de ejemplo si no se indican prompts")
+    parser.add_argument("--batch-id", default=None)
+    parser.add_argument("--sin-esperar", action="store_true", help="Solo ensamblar si el trabajo ya terminó")
+    parser.add_argument("--intervalo", type=float, default=None, help="Segundos entre consultas (BATCH_INTERVALO_SONDEO)")
+    parser.add_argument("--hilos", type=int, default=8, help="Documentos que se arman a la vez")
+    args = parser.parse_args()
+
+    # La configuración se lee al importar los módulos
+    os.environ["STORAGE_CONNECTION_STRING"] = args.conexion
+    if args.openai:
+        os.environ["AZURE_OPENAI_ENDPOINT"] = args.openai
+        os.environ.setdefault("AZURE_OPENAI_API_KEY", "batch")
+    import propia
+
+    if args.accion == "enviar":
+        enviar(propia, args)
+    elif args.accion == "ensamblar":
+        if not args.batch_id:
+            parser.error("ensamblar requiere --batch-id")
+        ensamblar(propia, args)
+    else:
+        comparar(propia, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Compara el throughput del camino síncrono (procesar_propuesta_completa en un pool de hilos, como
+los handlers anteriores) con el asíncrono (procesar_propuesta_completa_async en un solo event loop)
+al generar muchas propuestas a la vez. Usa las mismas dependencias falsas que carga.py:
+
+    python herramientas/servidor_openai_falso.py --puerto 8101 --latencia 0.5 &
+    azurite-blob --silent --location /tmp/azurite &
+    python herramientas/carga.py preparar --conexion "UseDevelopmentStorage=true"
+
+    python herramientas/benchmark_async.py --conexion "UseDevelopmentStorage=true" \\
+        --openai http://127.0.0.1:8101/ --propuestas 64 --concurrencia 32 --hilos 8
+
+`--hilos` es el número de solicitudes síncronas simultáneas que admite el worker (cada una bloquea
+un hilo mientras espera a Azure OpenAI y a Storage); el camino asíncrono atiende las
+`--concurrencia` propuestas en curso desde un solo hilo más el executor de ASYNC_HILOS_CPU.
+"""
+import os
+import sys
+import time
+import uuid
+import asyncio
+import argparse
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, ".")
+
+PROMPT = (
+    "# Migración de ERP a la nube {indice}\nPropuesta para Grupo Industrial Monterrey SA de CV, 15 de marzo de 2025.\n"
+    "Migrar SAP ECC (2.5 TB, 480 usuarios) a Azure en 6 meses. Presupuesto estimado: $4,200,000 MXN. "
+    "Equipo: 1 gerente de proyecto, 3 consultores SAP, 2 ingenieros de infraestructura."
+)
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+def resumen(nombre, latencias, errores, duracion):
+    completadas = len(latencias)
+    print(f"\n{nombre}")
+    print(f"  Completadas: {completadas}  Errores: {len(errores)}  Duración: {duracion:.2f} s")
+    print(f"  Throughput: {completadas / duracion:.2f} propuestas/s")
+    if latencias:
+        print(f"  Latencia p50 {percentil(latencias, 50):.0f} ms, p95 {percentil(latencias, 95):.0f} ms, "
+              f"media {statistics.mean(latencias):.0f} ms")
+    for error in errores[:3]:
+        print(f"  Error: {error}")
+    return completadas / duracion if duracion else 0.0
+
+
+def correr_sincrono(propia, args):
+    latencias, errores = [], []
+
+    def una(indice):
+        inicio = time.perf_counter()
+        try:
+            propia.procesar_propuesta_completa(PROMPT.format(indice=indice), str(uuid.uuid4())[:8])
+            latencias.append((time.perf_counter() - inicio) * 1000)
+        except Exception as e:
+            errores.append(str(e))
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.hilos) as executor:
+        list(executor.map(una, range(args.propuestas)))
+    return resumen(f"Síncrono ({args.hilos} hilos)", latencias, errores, time.perf_counter() - inicio)
+
+
+async def correr_asincrono(propia, args):
+    from propia import asincrono
+
+    latencias, errores = [], []
+    limite = asyncio.Semaphore(args.concurrencia)
+
+    async def una(indice):
+        async with limite:
+            inicio = time.perf_counter()
+            try:
+                await propia.procesar_propuesta_completa_async(PROMPT.format(indice=indice), str(uuid.uuid4())[:8])
+                latencias.append((time.perf_counter() - inicio) * 1000)
+            except Exception as e:
+                errores.append(str(e))
+
+    inicio = time.perf_counter()
+    try:
+        await asyncio.gather(*(una(indice) for indice in range(args.propuestas)))
+    finally:
+        await asincrono.cerrar()
+    return resumen(
+        f"Asíncrono ({args.concurrencia} en curso, {asincrono.ASYNC_HILOS_CPU} hilos de CPU)",
+        latencias, errores, time.perf_counter() - inicio
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput concurrente: camino síncrono vs asíncrono")
+    parser.add_argument("--conexion", required=True, help="Connection string de Blob Storage (p. ej. Azurite)")
+    parser.add_argument("--openai", default="http://127.0.0.1:8101/", help="Endpoint de Azure OpenAI (o el falso)")
+    parser.add_argument("--propuestas", type=int, default=32)
+    parser.add_argument("--concurrencia", type=int, default=32, help="Propuestas en curso en el camino asíncrono")
+    parser.add_argument("--hilos", type=int, default=8, help="Solicitudes simultáneas del camino síncrono")
+    parser.add_argument("--solo", choices=["sincrono", "asincrono"], default=None)
+    args = parser.parse_args()
+
+    # La configuración se lee al importar los módulos
+    os.environ["STORAGE_CONNECTION_STRING"] = args.conexion
+    os.environ.setdefault("AZURE_OPENAI_ENDPOINT", args.openai)
+    os.environ.setdefault("AZURE_OPENAI_API_KEY", "benchmark")
+    import propia
+
+    # Calentar la cache de plantillas para no medir la primera descarga
+    propia.descargar_plantilla()
+
+    resultados = {}
+    if args.solo != "asincrono":
+        resultados["sincrono"] = correr_sincrono(propia, args)
+    if args.solo != "sincrono":
+        resultados["asincrono"] = asyncio.run(correr_asincrono(propia, args))
+
+    if len(resultados) == 2 and resultados["sincrono"]:
+        print(f"\nAceleración del camino asíncrono: {resultados['asincrono'] / resultados['sincrono']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
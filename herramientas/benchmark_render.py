@@ -0,0 +1,120 @@
+"""
+Compara el ensamblado de documentos en hilos (copia de la plantilla, reemplazos y guardado en el
+proceso del worker, como hace el pipeline por defecto) con el pool de procesos de render_procesos
+para un lote de documentos con las secciones ya generadas. No usa Storage ni Azure OpenAI:
+
+    python herramientas/benchmark_render.py --documentos 64 --hilos 8 --procesos 4
+    python herramientas/benchmark_render.py --plantilla ruta/Plantilla-Propuesta.docx --motor xml
+
+Con el GIL los hilos no suman CPU: el pool de procesos escala con los núcleos disponibles.
+"""
+import io
+import os
+import sys
+import time
+import argparse
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, ".")
+
+PARRAFO = (
+    "La migración se ejecuta en cuatro fases con ventanas de corte acordadas con el cliente; cada fase "
+    "incluye pruebas de regresión, validación de datos y un plan de retorno documentado. "
+)
+
+
+def plantilla_sintetica(placeholders, relleno):
+    """Plantilla con los placeholders del pipeline y `relleno` párrafos de texto fijo"""
+    from docx import Document
+
+    documento = Document()
+    for indice in range(relleno):
+        documento.add_paragraph(PARRAFO * 3 if indice % 4 else f"{indice // 4 + 1}. Antecedentes")
+        if indice % (relleno // len(placeholders) or 1) == 0 and placeholders:
+            documento.add_paragraph(placeholders.pop(0))
+    for placeholder in placeholders:
+        documento.add_paragraph(placeholder)
+    salida = io.BytesIO()
+    documento.save(salida)
+    return salida.getvalue()
+
+
+def contenidos(indice):
+    secciones = ["[RESUMEN]", "[ALCANCE]", "[PLAN_TRABAJO]", "[EQUIPO]", "[INVERSION]", "[SUPUESTOS]",
+                 "[CARTA_PRESENTACION]"]
+    textos = {p: "\n\n".join(f"{p[1:-1].title()} {indice}: {PARRAFO}" for _ in range(6)) for p in secciones}
+    textos["[titulo]"] = f"Propuesta {indice}"
+    textos["[fecha]"] = "15 de marzo de 2025"
+    return textos
+
+
+def resumen(nombre, latencias, duracion):
+    print(f"\n{nombre}")
+    print(f"  Documentos: {len(latencias)}  Duración: {duracion:.2f} s  Throughput: {len(latencias) / duracion:.2f} docs/s")
+    print(f"  Latencia media {statistics.mean(latencias):.0f} ms, máxima {max(latencias):.0f} ms")
+    return len(latencias) / duracion
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ensamblado de documentos: hilos vs pool de procesos")
+    parser.add_argument("--plantilla", default=None, help="Plantilla .docx (por defecto una sintética)")
+    parser.add_argument("--relleno", type=int, default=400, help="Párrafos de la plantilla sintética")
+    parser.add_argument("--documentos", type=int, default=32)
+    parser.add_argument("--hilos", type=int, default=8)
+    parser.add_argument("--procesos", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--motor", choices=["docx", "xml"], default="docx")
+    args = parser.parse_args()
+
+    # La configuración se lee al importar los módulos
+    os.environ["MOTOR_RENDER"] = args.motor
+    os.environ["RENDER_PROCESOS"] = str(args.procesos)
+    from propia import plantillas, render_procesos, reemplazar_placeholder, guardar_documento
+
+    if args.plantilla:
+        with open(args.plantilla, "rb") as archivo:
+            plantilla_docx = archivo.read()
+    else:
+        plantilla_docx = plantilla_sintetica(list(contenidos(0)), args.relleno)
+
+    stream = io.BytesIO(plantilla_docx)
+    if args.motor == "xml":
+        compilada = {"xml": plantillas.motor_xml.compilar(stream, plantillas.PLACEHOLDER_PATTERN), "documento": None}
+    else:
+        compilada = {"xml": None, "documento": plantillas.Document(stream)}
+    compilada.update(nombre="benchmark", etag="local")
+
+    def en_hilo(indice):
+        inicio = time.perf_counter()
+        doc, _ = plantillas.copiar_plantilla(compilada)
+        for placeholder, texto in contenidos(indice).items():
+            reemplazar_placeholder(doc, placeholder, texto)
+        guardar_documento(doc, io.BytesIO())
+        return (time.perf_counter() - inicio) * 1000
+
+    def en_proceso(indice):
+        inicio = time.perf_counter()
+        render_procesos.renderizar(compilada, contenidos(indice), reemplazar_placeholder)
+        return (time.perf_counter() - inicio) * 1000
+
+    print(f"Plantilla de {len(plantilla_docx) / 1024:.0f} KB, motor {args.motor}, {args.documentos} documentos")
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.hilos) as executor:
+        latencias = list(executor.map(en_hilo, range(args.documentos)))
+    hilos = resumen(f"Hilos ({args.hilos})", latencias, time.perf_counter() - inicio)
+
+    # Arrancar los procesos y enviarles la plantilla antes de medir
+    with ThreadPoolExecutor(max_workers=args.procesos * 2) as executor:
+        list(executor.map(en_proceso, range(args.procesos * 2)))
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.procesos * 2) as executor:
+        latencias = list(executor.map(en_proceso, range(args.documentos)))
+    procesos = resumen(f"Pool de procesos ({args.procesos})", latencias, time.perf_counter() - inicio)
+
+    print(f"\nAceleración del pool de procesos: {procesos / hilos:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+"""
+Prueba de carga de extremo a extremo contra el host local de Azure Functions (`func start`).
+
+Reproduce prompts realistas de propuestas contra el endpoint de generación y reporta throughput,
+latencias p50/p95/p99, tasa de errores y memoria del worker. Se recomienda correr el host con
+dependencias falsas para medir solo el código de la función:
+
+    # OpenAI falso (uno o varios, ver servidor_openai_falso.py) y Azurite como Blob Storage
+    python herramientas/servidor_openai_falso.py --puerto 8101 --latencia 0.5 &
+    azurite-blob --silent --location /tmp/azurite &
+    python herramientas/carga.py preparar --conexion "UseDevelopmentStorage=true"
+    # local.settings.json: STORAGE_CONNECTION_STRING=UseDevelopmentStorage=true,
+    # AZURE_OPENAI_ENDPOINT=http://127.0.0.1:8101/ (o AZURE_OPENAI_POOL)
+    func start
+
+    # Modelo abierto: llegadas Poisson a 2 solicitudes/s, rampa de 30 s
+    python herramientas/carga.py correr --modelo abierto --tasa 2 --rampa 30 --duracion 120 --guardar base.json
+    # Modelo cerrado: 16 usuarios concurrentes con 1 s de pausa entre solicitudes
+    python herramientas/carga.py correr --modelo cerrado --usuarios 16 --pausa 1 --duracion 120 --comparar base.json
+"""
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+PROMPTS_BASE = [
+    "# Migración de ERP a la nube\nPropuesta para Grupo Industrial Monterrey SA de CV, 15 de marzo de 2025.\n"
+    "Migrar SAP ECC (2.5 TB, 480 usuarios) a Azure en 6 meses. Presupuesto estimado: $4,200,000 MXN. "
+    "Equipo: 1 gerente de proyecto, 3 consultores SAP, 2 ingenieros de infraestructura.",
+    "# Plataforma de analítica de ventas\nPropuesta para Comercializadora del Bajío S.A., 2 de abril de 2025.\n"
+    "Construir un data lake con Power BI para 35 sucursales. Fases: diagnóstico (3 semanas), ingesta (6 semanas), "
+    "tableros (4 semanas). Inversión: $1,850,000 MXN más licencias por $12,000 USD anuales.",
+    "# Chatbot de atención a clientes\nPropuesta para Seguros Atlántico Inc., 20 de mayo de 2025.\n"
+    "Asistente con Azure OpenAI para 12,000 consultas mensuales, integración con CRM Dynamics 365 y WhatsApp. "
+    "Meta: reducir 40% el tiempo de atención. Equipo de 4 personas durante 10 semanas.",
+    "# Modernización de aplicaciones\nPropuesta para Logística Express Corp., 7 de junio de 2025.\n"
+    "Reescribir 3 aplicaciones .NET Framework a .NET 8 en contenedores AKS. 220 mil líneas de código, "
+    "SLA objetivo 99.9%. Costo: $3,100,000 MXN en 5 meses con pagos mensuales.",
+    "# Ciberseguridad y cumplimiento\nPropuesta para Banco Regional del Norte S.A., 30 de junio de 2025.\n"
+    "Evaluación ISO 27001, pruebas de penetración a 45 aplicaciones y SOC administrado 24x7 por 12 meses. "
+    "Inversión anual: $2,750,000 MXN. Supuestos: acceso VPN y contraparte técnica dedicada."
+]
+
+# ========== PREPARACIÓN DE DEPENDENCIAS FALSAS ==========
+
+def preparar(args):
+    """Sube a Blob Storage (Azurite) una plantilla con todos los placeholders conocidos"""
+    from azure.storage.blob import BlobServiceClient
+    from azure.core.exceptions import ResourceExistsError
+    from docx import Document
+
+    documento = Document()
+    documento.add_heading("[titulo]", level=1)
+    documento.add_paragraph("[fecha]")
+    for placeholder in args.placeholders.split(","):
+        documento.add_heading(placeholder.strip("[]").replace("_", " ").title(), level=2)
+        documento.add_paragraph(placeholder)
+    contenido = io.BytesIO()
+    documento.save(contenido)
+
+    servicio = BlobServiceClient.from_connection_string(args.conexion)
+    contenedor = servicio.get_container_client(args.contenedor)
+    try:
+        contenedor.create_container()
+    except ResourceExistsError:
+        pass
+    contenedor.upload_blob(args.plantilla, contenido.getvalue(), overwrite=True)
+    print(f"Plantilla subida a {args.contenedor}/{args.plantilla}")
+
+# ========== GENERACIÓN DE CARGA ==========
+
+def percentil(valores, p):
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    return round(ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))], 1)
+
+
+class Ejecucion:
+    """Resultados de una corrida (se llena desde varios hilos)"""
+
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.resultados = []
+        self.memoria_mb = []
+        self.en_vuelo = 0
+        self.descartadas = 0
+        self.inicio = time.monotonic()
+        self.prompts = cargar_prompts(args.prompts)
+        self.sesion = requests.Session()
+        self.sesion.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=args.max_en_vuelo))
+
+    def transcurrido(self):
+        return time.monotonic() - self.inicio
+
+    def enviar(self):
+        """Envía una solicitud y registra su resultado"""
+        prompt = random.choice(self.prompts)
+        # Sufijo único para que la deduplicación por idempotencia no oculte trabajo real
+        cuerpo = {"prompt": f"{prompt}\nReferencia de carga: {random.getrandbits(48):012x}"}
+        inicio = time.perf_counter()
+        codigo, error = None, None
+        try:
+            respuesta = self.sesion.post(self.args.url, json=cuerpo, timeout=self.args.timeout)
+            codigo = respuesta.status_code
+            if codigo >= 400:
+                error = f"HTTP {codigo}"
+        except requests.RequestException as e:
+            error = type(e).__name__
+        latencia_ms = (time.perf_counter() - inicio) * 1000
+        with self.lock:
+            self.en_vuelo -= 1
+            self.resultados.append({
+                "t": round(self.transcurrido(), 2),
+                "latencia_ms": latencia_ms,
+                "codigo": codigo,
+                "error": error
+            })
+
+    def lanzar(self, executor):
+        """Envía en segundo plano respetando el máximo de solicitudes en vuelo"""
+        with self.lock:
+            if self.en_vuelo >= self.args.max_en_vuelo:
+                self.descartadas += 1
+                return
+            self.en_vuelo += 1
+        executor.submit(self.enviar)
+
+
+def cargar_prompts(ruta):
+    """Prompts de un archivo JSONL ({"prompt": ...} por línea) o los de ejemplo"""
+    if not ruta:
+        return PROMPTS_BASE
+    with open(ruta, encoding="utf-8") as archivo:
+        return [json.loads(linea)["prompt"] for linea in archivo if linea.strip()]
+
+
+def modelo_abierto(ejecucion):
+    """Llegadas Poisson: la tasa no depende de las respuestas (expone el colapso por cola)"""
+    args = ejecucion.args
+    with ThreadPoolExecutor(max_workers=args.max_en_vuelo) as executor:
+        while True:
+            # Proceso de Poisson con tasa variable (rampa) por adelgazamiento: se generan
+            # llegadas a la tasa máxima y se acepta cada una con probabilidad tasa(t) / tasa máxima
+            time.sleep(random.expovariate(args.tasa))
+            transcurrido = ejecucion.transcurrido()
+            if transcurrido >= args.rampa + args.duracion:
+                break
+            factor = min(1.0, transcurrido / args.rampa) if args.rampa else 1.0
+            if random.random() < factor:
+                ejecucion.lanzar(executor)
+
+
+def modelo_cerrado(ejecucion):
+    """Usuarios concurrentes que esperan su respuesta y una pausa antes de la siguiente solicitud"""
+    args = ejecucion.args
+
+    def usuario(indice):
+        # Los usuarios se incorporan escalonadamente durante la rampa
+        time.sleep(args.rampa * indice / args.usuarios)
+        while ejecucion.transcurrido() < args.rampa + args.duracion:
+            with ejecucion.lock:
+                ejecucion.en_vuelo += 1
+            ejecucion.enviar()
+            if args.pausa:
+                time.sleep(random.expovariate(1 / args.pausa))
+
+    hilos = [threading.Thread(target=usuario, args=(i,), daemon=True) for i in range(args.usuarios)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+
+def muestrear_memoria(ejecucion, detener):
+    """Lee la memoria pico del worker desde /api/metricas mientras dura la corrida"""
+    url = ejecucion.args.url_metricas
+    while not detener.wait(5):
+        try:
+            indicadores = requests.get(url, timeout=5).json().get("indicadores", {})
+            if indicadores.get("proceso.memoria_pico_mb") is not None:
+                ejecucion.memoria_mb.append(indicadores["proceso.memoria_pico_mb"])
+        except (requests.RequestException, ValueError):
+            pass
+
+# ========== REPORTE ==========
+
+def resumir(ejecucion):
+    """Métricas de la fase estable (después de la rampa)"""
+    args = ejecucion.args
+    estables = [r for r in ejecucion.resultados if r["t"] >= args.rampa] or ejecucion.resultados
+    exitosas = [r["latencia_ms"] for r in estables if r["error"] is None]
+    errores = {}
+    for resultado in estables:
+        if resultado["error"]:
+            errores[resultado["error"]] = errores.get(resultado["error"], 0) + 1
+
+    return {
+        "modelo": args.modelo,
+        "tasa_objetivo": args.tasa if args.modelo == "abierto" else None,
+        "usuarios": args.usuarios if args.modelo == "cerrado" else None,
+        "duracion_s": args.duracion,
+        "solicitudes": len(estables),
+        "throughput_rps": round(len(exitosas) / args.duracion, 3) if args.duracion else None,
+        "p50_ms": percentil(exitosas, 50),
+        "p95_ms": percentil(exitosas, 95),
+        "p99_ms": percentil(exitosas, 99),
+        "max_ms": round(max(exitosas), 1) if exitosas else None,
+        "tasa_error": round(sum(errores.values()) / len(estables), 4) if estables else 0.0,
+        "errores": errores,
+        "descartadas_cliente": ejecucion.descartadas,
+        "memoria_pico_mb": max(ejecucion.memoria_mb) if ejecucion.memoria_mb else None
+    }
+
+
+def serie_por_intervalo(ejecucion, intervalo):
+    """Throughput y p95 por ventana para ver en qué momento se degrada la latencia"""
+    ventanas = {}
+    for resultado in ejecucion.resultados:
+        ventanas.setdefault(int(resultado["t"] // intervalo), []).append(resultado)
+    filas = []
+    for indice in sorted(ventanas):
+        exitosas = [r["latencia_ms"] for r in ventanas[indice] if r["error"] is None]
+        filas.append({
+            "desde_s": indice * intervalo,
+            "completadas": len(ventanas[indice]),
+            "rps": round(len(exitosas) / intervalo, 2),
+            "p95_ms": percentil(exitosas, 95),
+            "errores": sum(1 for r in ventanas[indice] if r["error"])
+        })
+    return filas
+
+
+def comparar(actual, base, tolerancia):
+    """Imprime la diferencia contra la corrida base; regresa False si hay regresión"""
+    print("\nComparación contra la base:")
+    print(f"{'métrica':<18}{'base':>12}{'actual':>12}{'cambio':>10}")
+    regresion = False
+    # (métrica, True si más alto es peor)
+    for metrica, peor_si_sube in [("throughput_rps", False), ("p50_ms", True), ("p95_ms", True),
+                                  ("p99_ms", True), ("tasa_error", True), ("memoria_pico_mb", True)]:
+        antes, despues = base.get(metrica), actual.get(metrica)
+        if antes is None or despues is None:
+            continue
+        cambio = (despues - antes) / antes * 100 if antes else (0.0 if despues == antes else float("inf"))
+        empeora = cambio > tolerancia if peor_si_sube else cambio < -tolerancia
+        if metrica == "tasa_error":
+            empeora = despues - antes > 0.01
+        regresion = regresion or empeora
+        print(f"{metrica:<18}{antes:>12}{despues:>12}{cambio:>9.1f}%{'  <-- regresión' if empeora else ''}")
+    return not regresion
+
+
+def correr(args):
+    ejecucion = Ejecucion(args)
+    detener = threading.Event()
+    muestreo = threading.Thread(target=muestrear_memoria, args=(ejecucion, detener), daemon=True)
+    muestreo.start()
+
+    print(f"Carga {args.modelo} contra {args.url}: rampa {args.rampa} s, duración {args.duracion} s")
+    if args.modelo == "abierto":
+        modelo_abierto(ejecucion)
+    else:
+        modelo_cerrado(ejecucion)
+    detener.set()
+
+    for fila in serie_por_intervalo(ejecucion, args.intervalo):
+        print(f"  t={fila['desde_s']:>4}s  rps={fila['rps']:<6} p95={fila['p95_ms']} ms  errores={fila['errores']}")
+
+    resumen = resumir(ejecucion)
+    print(json.dumps(resumen, indent=2, ensure_ascii=False))
+
+    if args.guardar:
+        with open(args.guardar, "w", encoding="utf-8") as archivo:
+            json.dump(resumen, archivo, indent=2, ensure_ascii=False)
+        print(f"Resultados guardados en {args.guardar}")
+
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as archivo:
+            if not comparar(resumen, json.load(archivo), args.tolerancia):
+                sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga contra el host local de Azure Functions")
+    subparsers = parser.add_subparsers(dest="comando", required=True)
+
+    parser_preparar = subparsers.add_parser("preparar", help="Sube una plantilla de prueba a Blob Storage (Azurite)")
+    parser_preparar.add_argument("--conexion", default="UseDevelopmentStorage=true")
+    parser_preparar.add_argument("--contenedor", default="propia")
+    parser_preparar.add_argument("--plantilla", default="plantilla/Plantilla-Propuesta.docx")
+    parser_preparar.add_argument(
+        "--placeholders",
+        default="[RESUMEN],[ALCANCE],[PLAN_TRABAJO],[EQUIPO],[INVERSION],[SUPUESTOS],[CARTA_PRESENTACION]"
+    )
+    parser_preparar.set_defaults(funcion=preparar)
+
+    parser_correr = subparsers.add_parser("correr", help="Ejecuta la prueba de carga")
+    parser_correr.add_argument("--url", default="http://localhost:7071/api/generar_documento")
+    parser_correr.add_argument("--url-metricas", default="http://localhost:7071/api/metricas")
+    parser_correr.add_argument("--modelo", choices=["abierto", "cerrado"], default="abierto")
+    parser_correr.add_argument("--tasa", type=float, default=1.0, help="Solicitudes por segundo (modelo abierto)")
+    parser_correr.add_argument("--usuarios", type=int, default=8, help="Usuarios concurrentes (modelo cerrado)")
+    parser_correr.add_argument("--pausa", type=float, default=1.0, help="Pausa media entre solicitudes de un usuario (s)")
+    parser_correr.add_argument("--rampa", type=float, default=30, help="Segundos para alcanzar la carga objetivo")
+    parser_correr.add_argument("--duracion", type=float, default=120, help="Segundos de carga estable tras la rampa")
+    parser_correr.add_argument("--max-en-vuelo", type=int, default=256)
+    parser_correr.add_argument("--timeout", type=float, default=300)
+    parser_correr.add_argument("--intervalo", type=float, default=10, help="Segundos por fila de la serie de tiempo")
+    parser_correr.add_argument("--prompts", help="Archivo JSONL con prompts ({\"prompt\": ...} por línea)")
+    parser_correr.add_argument("--guardar", help="Guarda el resumen como JSON (base para comparar)")
+    parser_correr.add_argument("--comparar", help="Resumen base contra el cual comparar")
+    parser_correr.add_argument("--tolerancia", type=float, default=10, help="Porcentaje de cambio aceptado")
+    parser_correr.set_defaults(funcion=correr)
+
+    args = parser.parse_args()
+    args.funcion(args)
+
+
+if __name__ == "__main__":
+    main()
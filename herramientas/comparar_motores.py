@@ -0,0 +1,120 @@
+"""
+Compara el motor de render de python-docx ("docx") con el motor XML ("xml") sobre un conjunto
+de plantillas locales: ambos deben producir el mismo texto en cada párrafo del documento.
+
+    python herramientas/comparar_motores.py plantillas/*.docx --repeticiones 20
+
+Cada placeholder se llena con un texto de varias líneas (con caracteres que requieren escape)
+y se reportan las diferencias de texto y el tiempo medio de render por motor. El formato no se
+compara: el motor XML conserva el formato del run del placeholder en lugar de aplicar la fuente fija.
+"""
+import io
+import sys
+import time
+import zipfile
+import argparse
+import statistics
+from docx import Document
+from lxml import etree
+
+sys.path.insert(0, ".")
+from propia import motor_xml
+from propia.de_1 import reemplazar_placeholder
+from propia.plantillas import PLACEHOLDER_PATTERN, escanear_placeholders
+
+W = motor_xml.W
+
+
+def _contenido(placeholder):
+    nombre = placeholder.strip("[]")
+    return f"Contenido de {nombre} con <marcas> & \"comillas\".\nSegunda línea de {nombre}.\n\n- viñeta"
+
+
+def _textos(docx_bytes):
+    """Texto de cada párrafo del documento (w:t, saltos y tabuladores de sus propios runs)"""
+    with zipfile.ZipFile(io.BytesIO(docx_bytes)) as paquete:
+        raiz = etree.fromstring(paquete.read(motor_xml.PARTE_DOCUMENTO))
+    textos = []
+    for parrafo in raiz.iter(W + "p"):
+        partes = []
+        for elemento in parrafo.iter(W + "t", W + "br", W + "tab"):
+            if motor_xml._parrafo_de(elemento) is not parrafo:
+                continue
+            if elemento.tag == W + "t":
+                partes.append(elemento.text or "")
+            else:
+                partes.append("\n" if elemento.tag == W + "br" else "\t")
+        textos.append("".join(partes))
+    return textos
+
+
+def render_docx(plantilla, placeholders):
+    doc = Document(io.BytesIO(plantilla))
+    for placeholder in placeholders:
+        reemplazar_placeholder(doc, placeholder, _contenido(placeholder))
+    salida = io.BytesIO()
+    doc.save(salida)
+    return salida.getvalue()
+
+
+def render_xml(compilada, placeholders):
+    doc = motor_xml.nuevo_documento(compilada)
+    for placeholder in placeholders:
+        motor_xml.reemplazar(doc, placeholder, _contenido(placeholder))
+    salida = io.BytesIO()
+    motor_xml.guardar(doc, salida)
+    return salida.getvalue()
+
+
+def comparar(ruta, repeticiones):
+    with open(ruta, "rb") as archivo:
+        plantilla = archivo.read()
+    placeholders = sorted(escanear_placeholders(Document(io.BytesIO(plantilla))))
+    compilada = motor_xml.compilar(plantilla, PLACEHOLDER_PATTERN)
+
+    faltantes = set(placeholders) - compilada["placeholders"]
+    salida_docx = render_docx(plantilla, placeholders)
+    salida_xml = render_xml(compilada, placeholders)
+    Document(io.BytesIO(salida_xml))  # El resultado debe abrir con python-docx
+
+    textos_docx, textos_xml = _textos(salida_docx), _textos(salida_xml)
+    diferencias = [
+        (indice, a, b) for indice, (a, b) in enumerate(zip(textos_docx, textos_xml)) if a != b
+    ]
+    if len(textos_docx) != len(textos_xml):
+        diferencias.append((None, f"{len(textos_docx)} párrafos", f"{len(textos_xml)} párrafos"))
+
+    tiempos = {"docx": [], "xml": []}
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        render_docx(plantilla, placeholders)
+        tiempos["docx"].append((time.perf_counter() - inicio) * 1000)
+        inicio = time.perf_counter()
+        render_xml(compilada, placeholders)
+        tiempos["xml"].append((time.perf_counter() - inicio) * 1000)
+
+    print(f"\n{ruta}: {len(placeholders)} placeholders, {len(textos_docx)} párrafos")
+    if faltantes:
+        print(f"  Placeholders que el motor XML no encontró: {sorted(faltantes)}")
+    for indice, a, b in diferencias[:10]:
+        print(f"  Párrafo {indice}:\n    docx: {a!r}\n    xml:  {b!r}")
+    print(f"  Diferencias: {len(diferencias)}")
+    print("  Render (incluye parseo en docx): " + ", ".join(
+        f"{motor} {statistics.median(valores):.1f} ms" for motor, valores in tiempos.items()
+    ))
+    return not diferencias and not faltantes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compara los motores de render docx y xml")
+    parser.add_argument("plantillas", nargs="+", help="Archivos .docx con placeholders")
+    parser.add_argument("--repeticiones", type=int, default=10)
+    args = parser.parse_args()
+
+    resultados = [comparar(ruta, args.repeticiones) for ruta in args.plantillas]
+    print(f"\n{sum(resultados)}/{len(resultados)} plantillas con el mismo texto en ambos motores")
+    sys.exit(0 if all(resultados) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Vuelve a renderizar propuestas guardadas con una versión nueva de plantilla, sin llamadas al LLM.
+
+Cada propuesta generada guarda junto a su .docx el texto final de sus secciones
+(propuestas/<nombre>.secciones.json.gz). Este trabajo aplica la plantilla seleccionada (la versión
+vigente en Storage) a esos textos y reemplaza el .docx, en paralelo:
+
+    # Todas las propuestas con secciones guardadas bajo propuestas/
+    python herramientas/rerenderizar.py --conexion "$STORAGE_CONNECTION_STRING" --hilos 16
+    # Solo algunas propuestas, con otra plantilla
+    python herramientas/rerenderizar.py --conexion "..." --plantilla consultoria/en \\
+        --blob propuestas/Propuesta_ACME_1a2b3c4d_20250301_101500.docx --lista pendientes.txt
+
+Si el trabajo se interrumpe basta con volver a correrlo: las propuestas que ya tienen la versión
+de la plantilla se omiten (`--forzar` las renderiza de todos modos). Con RENDER_PROCESOS=N el
+ensamblado corre en un pool de procesos.
+"""
+import os
+import sys
+import json
+import argparse
+
+sys.path.insert(0, ".")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-render masivo de propuestas con una plantilla nueva")
+    parser.add_argument("--conexion", required=True, help="Connection string de Blob Storage")
+    parser.add_argument("--plantilla", default=None, help="Nombre de la plantilla (por defecto la predeterminada)")
+    parser.add_argument("--unidad-negocio", default=None)
+    parser.add_argument("--idioma", default=None)
+    parser.add_argument("--blob", action="append", default=[], help="Documento por renderizar (se puede repetir)")
+    parser.add_argument("--lista", default=None, help="Archivo con un documento por línea")
+    parser.add_argument("--prefijo", default=None, help="Prefijo de las propuestas si no se indican documentos")
+    parser.add_argument("--hilos", type=int, default=None, help="Propuestas en paralelo (RERENDER_HILOS)")
+    parser.add_argument("--forzar", action="store_true", help="Renderizar aunque ya tengan esta versión")
+    args = parser.parse_args()
+
+    # La configuración se lee al importar los módulos
+    os.environ["STORAGE_CONNECTION_STRING"] = args.conexion
+    import propia
+    from propia import secciones
+
+    seleccion = {
+        clave: valor for clave, valor in
+        (("nombre", args.plantilla), ("unidad_negocio", args.unidad_negocio), ("idioma", args.idioma)) if valor
+    }
+    compilada = propia.descargar_plantilla(seleccion)
+    print(f"Plantilla {compilada['nombre']} ({compilada['etag']}), placeholders: {sorted(compilada['placeholders'])}")
+
+    blobs = list(args.blob)
+    if args.lista:
+        with open(args.lista, encoding="utf-8") as archivo:
+            blobs.extend(linea.strip() for linea in archivo if linea.strip())
+
+    def al_avanzar(blob_docx, estado):
+        print(f"  {estado:<14} {blob_docx}", flush=True)
+
+    resumen = secciones.rerenderizar(
+        propia.get_blob_service_client().get_container_client(propia.BLOB_CONTAINER_NAME),
+        compilada,
+        propia.reemplazar_placeholder,
+        blobs=blobs or None,
+        prefijo=args.prefijo or propia.PROPUESTAS_FOLDER,
+        hilos=args.hilos,
+        forzar=args.forzar,
+        al_avanzar=al_avanzar
+    )
+    print(json.dumps(resumen, ensure_ascii=False, indent=2))
+    sys.exit(1 if resumen["errores"] else 0)
+
+
+if __name__ == "__main__":
+    main()
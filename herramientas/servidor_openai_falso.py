@@ -0,0 +1,325 @@
+"""
+Servidor local que imita el endpoint de chat completions de Azure OpenAI.
+
+Sirve para probar el pool de endpoints (AZURE_OPENAI_POOL), el balanceo por latencia
+y los circuit breakers sin consumir cuota real. Se pueden levantar varios en distintos puertos:
+
+    python herramientas/servidor_openai_falso.py --puerto 8101 --latencia 0.2
+    python herramientas/servidor_openai_falso.py --puerto 8102 --latencia 1.5 --tasa-error 0.3
+    python herramientas/servidor_openai_falso.py --puerto 8103 --cuota 20000
+
+El estado se puede cambiar en caliente con POST /control (JSON con latencia, tasa_error,
+cuota o caido) para simular una degradación regional.
+
+También responde /embeddings con vectores deterministas (bolsa de palabras con hash), de modo
+que textos casi iguales tienen similitud alta: sirve para probar la cache semántica.
+
+Con "stream": true responde por SSE palabra por palabra, repartiendo la latencia entre los
+fragmentos. `--parrafos N` alarga cada respuesta a N párrafos (un modelo que ignora el
+"Máximo N párrafos" de las instrucciones) para medir el corte anticipado de OPENAI_STREAMING;
+`/` (GET) reporta cuántas transmisiones cortó el cliente.
+
+También imita la Batch API (POST /openai/files, POST /openai/batches, GET /openai/batches/{id} y
+GET /openai/files/{id}/content): el trabajo se completa `--demora-batch` segundos después de
+crearse, sin consumir la cuota por minuto, y `--tasa-error` envía esa fracción de las
+solicitudes al archivo de errores.
+
+Las respuestas se truncan a `max_tokens` (finish_reason "length") y `--latencia-deployment
+nombre=segundos` da a un despliegue otra latencia, para probar el ruteo por sección (RUTAS_SECCIONES).
+"""
+import re
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from email.parser import BytesParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+_lock = threading.Lock()
+_config = {
+    "latencia": 0.1, "tasa_error": 0.0, "cuota": None, "caido": False, "nombre": "falso", "parrafos": 1,
+    "demora_batch": 2.0, "latencia_deployment": {}
+}
+_estado = {
+    "solicitudes": 0, "errores": 0, "tokens": 0, "ventana": int(time.time() // 60), "transmisiones_cortadas": 0,
+    "solicitudes_batch": 0
+}
+# Batch API: id -> contenido de archivo / trabajo
+_archivos = {}
+_trabajos = {}
+DIMENSIONES_EMBEDDING = 256
+
+
+def _contar_tokens(texto):
+    return max(1, len(texto) // 4)
+
+
+def _embedding(texto):
+    """Cuenta de palabras proyectada con hash a DIMENSIONES_EMBEDDING dimensiones"""
+    vector = [0.0] * DIMENSIONES_EMBEDDING
+    for palabra in re.findall(r"\w+", texto.lower()):
+        vector[int(hashlib.md5(palabra.encode("utf-8")).hexdigest(), 16) % DIMENSIONES_EMBEDDING] += 1.0
+    return vector
+
+
+def _contenido(messages):
+    """Respuesta determinista; si el prompt pide un JSON con claves [X], las incluye (lotes)"""
+    ultimo = messages[-1]["content"] if messages else ""
+    sistema = messages[0]["content"] if messages else ""
+    if "objeto JSON" in sistema and "claves del JSON deben ser exactamente:" in sistema:
+        claves = sistema.split("exactamente:")[1].split("\n")[0]
+        return json.dumps({clave.strip(): f"Contenido de {clave.strip()} generado por {_config['nombre']}"
+                           for clave in claves.split(",") if clave.strip()})
+    extra = "".join(
+        f"\n\nPárrafo adicional {indice} generado por {_config['nombre']}, más allá del límite de la sección."
+        for indice in range(2, _config["parrafos"] + 1)
+    )
+    return f"Contenido generado por {_config['nombre']}.\n{ultimo[:200]}{extra}"
+
+
+def _completion(messages, max_tokens=None):
+    """Cuerpo de una chat completion exitosa"""
+    contenido = _contenido(messages)
+    finish_reason = "stop"
+    if max_tokens and _contar_tokens(contenido) > max_tokens:
+        contenido, finish_reason = contenido[:max_tokens * 4], "length"
+    prompt_tokens = sum(_contar_tokens(m.get("content", "")) for m in messages)
+    completion_tokens = _contar_tokens(contenido)
+    return {
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": contenido}, "finish_reason": finish_reason}],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": 0}
+        }
+    }
+
+
+def _guardar_archivo(contenido, proposito):
+    file_id = f"file-{hashlib.md5(contenido + str(time.time()).encode()).hexdigest()[:16]}"
+    with _lock:
+        _archivos[file_id] = contenido
+    return {"id": file_id, "object": "file", "purpose": proposito, "bytes": len(contenido), "status": "processed"}
+
+
+def _procesar_trabajo(batch_id):
+    """Resuelve las solicitudes del trabajo y lo completa después de demora_batch segundos"""
+    with _lock:
+        trabajo = _trabajos[batch_id]
+        entrada = _archivos[trabajo["input_file_id"]]
+        trabajo.update(status="in_progress", in_progress_at=int(time.time()))
+    salida, errores = [], []
+    for linea in entrada.decode("utf-8").splitlines():
+        if not linea.strip():
+            continue
+        solicitud = json.loads(linea)
+        if random.random() < _config["tasa_error"]:
+            errores.append({"custom_id": solicitud["custom_id"], "response": {
+                "status_code": 500, "body": {"error": {"message": "Error interno simulado"}}
+            }, "error": None})
+            continue
+        salida.append({"id": f"batch_req_{len(salida)}", "custom_id": solicitud["custom_id"], "response": {
+            "status_code": 200, "body": _completion(solicitud["body"].get("messages", []), solicitud["body"].get("max_tokens"))
+        }, "error": None})
+    time.sleep(_config["demora_batch"])
+
+    def jsonl(registros):
+        return ("\n".join(json.dumps(r, ensure_ascii=False) for r in registros) + "\n").encode("utf-8")
+
+    with _lock:
+        _estado["solicitudes_batch"] += len(salida) + len(errores)
+    trabajo.update(
+        status="completed",
+        completed_at=int(time.time()),
+        output_file_id=_guardar_archivo(jsonl(salida), "batch_output")["id"] if salida else None,
+        error_file_id=_guardar_archivo(jsonl(errores), "batch_output")["id"] if errores else None,
+        request_counts={"total": len(salida) + len(errores), "completed": len(salida), "failed": len(errores)}
+    )
+
+
+class Manejador(BaseHTTPRequestHandler):
+    def log_message(self, formato, *args):
+        pass
+
+    def _responder(self, codigo, cuerpo, headers=None):
+        datos = json.dumps(cuerpo).encode("utf-8")
+        self.send_response(codigo)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(datos)))
+        for nombre, valor in (headers or {}).items():
+            self.send_header(nombre, str(valor))
+        self.end_headers()
+        self.wfile.write(datos)
+
+    def _transmitir(self, contenido, duracion, restantes):
+        """Respuesta SSE en fragmentos de una palabra; se detiene si el cliente cierra la conexión"""
+        # Como Azure: HTTP/1.1 con Transfer-Encoding chunked, para que el cliente reciba cada evento al enviarse
+        self.protocol_version = "HTTP/1.1"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Connection", "close")
+        self.send_header("x-ratelimit-remaining-tokens", str(restantes))
+        self.end_headers()
+        fragmentos = re.findall(r"\S+\s*|\s+", contenido)
+        eventos = [{"choices": [], "prompt_filter_results": []}]
+        eventos += [{"choices": [{"index": 0, "delta": {"content": f}, "finish_reason": None}]} for f in fragmentos]
+        eventos.append({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        try:
+            for indice, evento in enumerate(eventos):
+                if 1 < indice < len(eventos) - 1:
+                    time.sleep(duracion / max(1, len(fragmentos)))
+                self._enviar_trozo(f"data: {json.dumps(evento)}\n\n".encode("utf-8"))
+            self._enviar_trozo(b"data: [DONE]\n\n")
+            self._enviar_trozo(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            with _lock:
+                _estado["transmisiones_cortadas"] += 1
+        self.close_connection = True
+
+    def _enviar_trozo(self, datos):
+        self.wfile.write(f"{len(datos):x}\r\n".encode("ascii") + datos + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        ruta = self.path.split("?")[0]
+        if ruta.startswith("/openai/batches/"):
+            trabajo = _trabajos.get(ruta.rsplit("/", 1)[1])
+            return self._responder(200, trabajo) if trabajo else self._responder(404, {"error": {"message": "No existe"}})
+        if ruta.startswith("/openai/files/") and ruta.endswith("/content"):
+            contenido = _archivos.get(ruta.split("/")[3])
+            if contenido is None:
+                return self._responder(404, {"error": {"message": "No existe"}})
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(contenido)))
+            self.end_headers()
+            return self.wfile.write(contenido)
+        with _lock:
+            self._responder(200, {"config": _config, "estado": _estado, "trabajos_batch": len(_trabajos)})
+
+    def _batch(self, ruta, datos):
+        """POST /openai/files (multipart) y /openai/batches"""
+        if ruta.startswith("/openai/files"):
+            mensaje = BytesParser().parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("utf-8") + datos
+            )
+            partes = {parte.get_param("name", header="content-disposition"): parte for parte in mensaje.get_payload()}
+            proposito = partes["purpose"].get_payload(decode=True).decode("utf-8") if "purpose" in partes else "batch"
+            return self._responder(200, _guardar_archivo(partes["file"].get_payload(decode=True), proposito))
+
+        cuerpo = json.loads(datos or b"{}")
+        if cuerpo.get("input_file_id") not in _archivos:
+            return self._responder(400, {"error": {"message": "input_file_id inválido"}})
+        batch_id = f"batch_{hashlib.md5(str(time.time()).encode()).hexdigest()[:16]}"
+        trabajo = {
+            "id": batch_id, "object": "batch", "endpoint": cuerpo.get("endpoint"), "status": "validating",
+            "input_file_id": cuerpo["input_file_id"], "completion_window": cuerpo.get("completion_window"),
+            "created_at": int(time.time()), "output_file_id": None, "error_file_id": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0}
+        }
+        with _lock:
+            _trabajos[batch_id] = trabajo
+        threading.Thread(target=_procesar_trabajo, args=(batch_id,), daemon=True).start()
+        return self._responder(200, dict(trabajo))
+
+    def do_POST(self):
+        datos = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.startswith(("/openai/files", "/openai/batches")):
+            return self._batch(self.path.split("?")[0], datos)
+        cuerpo = json.loads(datos or b"{}")
+
+        if self.path.startswith("/control"):
+            with _lock:
+                _config.update({k: v for k, v in cuerpo.items() if k in _config})
+            return self._responder(200, {"config": _config})
+
+        if "/chat/completions" not in self.path and "/embeddings" not in self.path:
+            return self._responder(404, {"error": {"message": "Ruta no soportada"}})
+
+        with _lock:
+            _estado["solicitudes"] += 1
+            config = dict(_config)
+            # La cuota se renueva cada minuto, como el límite de tokens por minuto de Azure
+            ventana = int(time.time() // 60)
+            if ventana != _estado["ventana"]:
+                _estado.update({"ventana": ventana, "tokens": 0})
+
+        # Los embeddings responden mucho más rápido que una completion; una transmisión
+        # entrega el primer fragmento al 20% de la latencia y reparte el resto entre las palabras
+        factor = 0.1 if "/embeddings" in self.path else (0.2 if cuerpo.get("stream") else 1.0)
+        deployment = re.search(r"/deployments/([^/]+)/", self.path)
+        latencia = config["latencia_deployment"].get(deployment.group(1) if deployment else None, config["latencia"])
+        time.sleep(latencia * factor * random.uniform(0.8, 1.2))
+
+        if config["caido"] or random.random() < config["tasa_error"]:
+            with _lock:
+                _estado["errores"] += 1
+            return self._responder(500, {"error": {"message": "Error interno simulado"}})
+
+        if "/embeddings" in self.path:
+            textos = cuerpo.get("input", [])
+            textos = [textos] if isinstance(textos, str) else textos
+            tokens = sum(_contar_tokens(texto) for texto in textos)
+            with _lock:
+                _estado["tokens"] += tokens
+            return self._responder(200, {
+                "data": [{"index": i, "embedding": _embedding(texto)} for i, texto in enumerate(textos)],
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+            })
+
+        respuesta = _completion(cuerpo.get("messages", []), cuerpo.get("max_tokens"))
+        contenido = respuesta["choices"][0]["message"]["content"]
+        prompt_tokens = respuesta["usage"]["prompt_tokens"]
+        completion_tokens = respuesta["usage"]["completion_tokens"]
+
+        with _lock:
+            if config["cuota"] is not None and _estado["tokens"] + prompt_tokens + completion_tokens > config["cuota"]:
+                return self._responder(
+                    429,
+                    {"error": {"message": "Cuota de tokens por minuto agotada"}},
+                    {"Retry-After": 60 - int(time.time()) % 60}
+                )
+            _estado["tokens"] += prompt_tokens + completion_tokens
+            restantes = config["cuota"] - _estado["tokens"] if config["cuota"] is not None else 1000000
+
+        if cuerpo.get("stream"):
+            return self._transmitir(contenido, latencia * 0.8, restantes)
+
+        self._responder(200, respuesta, {"x-ratelimit-remaining-tokens": restantes})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor falso de Azure OpenAI chat completions")
+    parser.add_argument("--puerto", type=int, default=8101)
+    parser.add_argument("--latencia", type=float, default=0.1, help="Segundos por respuesta")
+    parser.add_argument("--tasa-error", type=float, default=0.0, help="Fracción de respuestas 500")
+    parser.add_argument("--cuota", type=int, default=None, help="Tokens por minuto antes de responder 429")
+    parser.add_argument("--nombre", default=None)
+    parser.add_argument("--parrafos", type=int, default=1, help="Párrafos de cada respuesta")
+    parser.add_argument("--demora-batch", type=float, default=2.0, help="Segundos que tarda un trabajo batch")
+    parser.add_argument("--latencia-deployment", action="append", default=[], metavar="NOMBRE=SEGUNDOS",
+                        help="Latencia de un despliegue distinta de --latencia (se puede repetir)")
+    args = parser.parse_args()
+
+    _config.update({
+        "latencia": args.latencia,
+        "tasa_error": args.tasa_error,
+        "cuota": args.cuota,
+        "parrafos": args.parrafos,
+        "demora_batch": args.demora_batch,
+        "latencia_deployment": {
+            nombre: float(segundos) for nombre, segundos in (valor.split("=", 1) for valor in args.latencia_deployment)
+        },
+        "nombre": args.nombre or f"falso-{args.puerto}"
+    })
+    servidor = ThreadingHTTPServer(("127.0.0.1", args.puerto), Manejador)
+    print(f"Servidor falso de Azure OpenAI en http://127.0.0.1:{args.puerto}/ ({_config})")
+    servidor.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,13 +3,36 @@ import os
 import json
 import uuid
 import traceback
+import logging
 from datetime import datetime, timedelta
-from docx import Document
 from docx.shared import Pt
-import requests
 import re
-from io import BytesIO
-from azure.storage.blob import BlobServiceClient, generate_blob_sas, BlobSasPermissions
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from azure.storage.blob import generate_blob_sas, BlobSasPermissions
+from propia import (
+    metricas, cache_http, consumo, enrutador_openai, perfilado, motor_xml, cache_semantico, sintesis, asincrono,
+    render_procesos, secciones, batch_openai, admision, rutas_secciones, tablas, plazos, contexto
+)
+from propia.almacenamiento import (
+    crear_cliente_servicio, crear_stream_temporal, subir_desde_stream, subir_desde_stream_async
+)
+from propia.pipeline import etapa, ejecutar_grafo, ejecutar_grafo_async
+from propia.plantillas import (
+    obtener_compilada, copiar_plantilla, info_plantilla, planificar_placeholders, listar_plantillas,
+    seleccion_desde_body, PlantillaNoEncontrada
+)
+from propia.manifiesto import (
+    construir_registro, registrar_propuesta, registrar_propuesta_async, consultar_async, buscar_por_id,
+    buscar_por_id_async, reindexar_desde_blobs
+)
+from propia.idempotencia import calcular_huella, obtener_clave, ejecutar_una_vez_async, ConflictoIdempotencia
+from propia.consumo import PresupuestoExcedido
+from propia.plazos import PlazoAgotado
+from propia.admision import CapacidadAgotada
 
 # Configuración
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT", "https://chabot-inventario-talento-aistudio.openai.azure.com/")
@@ -20,7 +43,6 @@ API_VERSION = "2024-02-15-preview"
 STORAGE_CONNECTION_STRING = os.getenv("STORAGE_CONNECTION_STRING")
 BLOB_CONTAINER_NAME = "propia"
 TEMPLATE_CONTAINER_NAME = "propia"
-TEMPLATE_BLOB_NAME = "plantilla/Plantilla-Propuesta.docx"
 PROPUESTAS_FOLDER = "propuestas/"
 
 # Registrar la función
@@ -31,28 +53,55 @@ app = func.FunctionApp()
 def call_azure_openai(messages, max_tokens=1000):
     """Función para llamar a Azure OpenAI"""
     try:
-        if not AZURE_OPENAI_API_KEY:
+        if not AZURE_OPENAI_API_KEY and not enrutador_openai.AZURE_OPENAI_POOL:
             raise Exception("Azure OpenAI API Key no configurado")
-            
-        api_url = f"{AZURE_OPENAI_ENDPOINT}openai/deployments/{DEPLOYMENT_NAME}/chat/completions?api-version={API_VERSION}"
+        
+        # Despliegues disponibles (AZURE_OPENAI_POOL o el endpoint único configurado)
+        pool = enrutador_openai.obtener_pool(AZURE_OPENAI_ENDPOINT, DEPLOYMENT_NAME, AZURE_OPENAI_API_KEY, API_VERSION)
+        # Despliegue, max_tokens y temperatura de la sección en curso (RUTAS_SECCIONES y presupuesto aprendido)
+        ruta = rutas_secciones.resolver(pool, max_tokens)
 
-        headers = {
-            "Content-Type": "application/json",
-            "api-key": AZURE_OPENAI_API_KEY
-        }
+        def generar(messages):
+            # Fallar antes de enviar si la llamada no cabe en el presupuesto de tokens
+            estimado = consumo.reservar(messages, ruta["max_tokens"])
+            usage = None
+            try:
+                # Con OPENAI_STREAMING la respuesta se corta al llegar al límite de párrafos de la sección
+                contenido, usage = rutas_secciones.completar(ruta, messages)
+                return contenido
+            finally:
+                consumo.registrar_uso(usage, estimado)
 
-        data = {
-            "messages": messages,
-            "max_tokens": max_tokens
-        }
+        # Con CACHE_SEMANTICO_HABILITADO, una llamada casi idéntica ya generada se reutiliza
+        return cache_semantico.completar(pool, messages, max_tokens, generar)
 
-        response = requests.post(api_url, headers=headers, json=data)
+    except (PresupuestoExcedido, PlazoAgotado):
+        raise
+    except Exception as e:
+        raise Exception(f"Error llamando Azure OpenAI: {str(e)}")
 
-        if response.status_code == 200:
-            return response.json()['choices'][0]['message']['content'].strip()
-        else:
-            raise Exception(f"Error Azure OpenAI: {response.status_code}, {response.text}")
+async def call_azure_openai_async(messages, max_tokens=1000):
+    """Versión asíncrona de call_azure_openai (sesión aiohttp compartida del event loop)"""
+    try:
+        if not AZURE_OPENAI_API_KEY and not enrutador_openai.AZURE_OPENAI_POOL:
+            raise Exception("Azure OpenAI API Key no configurado")
+        
+        pool = enrutador_openai.obtener_pool(AZURE_OPENAI_ENDPOINT, DEPLOYMENT_NAME, AZURE_OPENAI_API_KEY, API_VERSION)
+        ruta = rutas_secciones.resolver(pool, max_tokens)
 
+        async def generar(messages):
+            estimado = consumo.reservar(messages, ruta["max_tokens"])
+            usage = None
+            try:
+                contenido, usage = await rutas_secciones.completar_async(ruta, messages)
+                return contenido
+            finally:
+                consumo.registrar_uso(usage, estimado)
+
+        return await cache_semantico.completar_async(pool, messages, max_tokens, generar)
+
+    except (PresupuestoExcedido, PlazoAgotado):
+        raise
     except Exception as e:
         raise Exception(f"Error llamando Azure OpenAI: {str(e)}")
 
@@ -88,35 +137,18 @@ def limpiar_formato_markdown(texto):
     return texto.strip()
 
 def extraer_informacion_empresa(prompt_completo):
-    """Extrae información específica de la empresa del prompt"""
-    empresa_pattern = r'(?:para\s+|de\s+|empresa\s+)([A-Z][a-zA-Z\s&]+(?:SA\s+de\s+CV|S\.A\.|Inc\.|Corp\.|Ltd\.)?)'
-    fecha_pattern = r'(\d{1,2}\s+de\s+\w+\s+de\s+\d{4}|\d{1,2}/\d{1,2}/\d{4})'
-    titulo_pattern = r'#\s*(.*?)(?:\n|$)'
-    
-    info = {
-        'empresa': 'Cliente Estimado',
-        'fecha': datetime.now().strftime('%d de %B de %Y'),
-        'titulo': 'Propuesta Técnica'
-    }
-    
-    empresa_match = re.search(empresa_pattern, prompt_completo, re.IGNORECASE)
-    if empresa_match:
-        info['empresa'] = empresa_match.group(1).strip()
-    
-    fecha_match = re.search(fecha_pattern, prompt_completo)
-    if fecha_match:
-        info['fecha'] = fecha_match.group(1)
-    
-    titulo_match = re.search(titulo_pattern, prompt_completo)
-    if titulo_match:
-        info['titulo'] = titulo_match.group(1).strip()
-    
-    return info
+    """
+    Extrae información específica de la empresa del prompt.
+
+    Dentro de una propuesta se extrae una sola vez (contexto.iniciar) y la comparten la etapa
+    "empresa", el título, la fecha y la carta de presentación.
+    """
+    return contexto.info_empresa(prompt_completo)
 
 # ========== FUNCIONES DE GENERACIÓN DE CONTENIDO ==========
 
-def generar_resumen_ejecutivo(prompt_completo):
-    """Genera contenido específico para resumen ejecutivo"""
+def _seccion_resumen_ejecutivo(prompt_completo):
+    """Mensajes para resumen ejecutivo"""
     messages = [
         {
             "role": "system",
@@ -136,11 +168,10 @@ IMPORTANTE:
         }
     ]
     
-    contenido = call_azure_openai(messages, max_tokens=600)
-    return limpiar_formato_markdown(contenido) if contenido else None
+    return messages, 600, limpiar_seccion
 
-def generar_alcance_minimo(prompt_completo):
-    """Genera contenido específico para alcance mínimo"""
+def _seccion_alcance_minimo(prompt_completo):
+    """Mensajes para alcance mínimo"""
     messages = [
         {
             "role": "system",
@@ -160,11 +191,10 @@ IMPORTANTE:
         }
     ]
     
-    contenido = call_azure_openai(messages, max_tokens=700)
-    return limpiar_formato_markdown(contenido) if contenido else None
+    return messages, 700, limpiar_seccion
 
-def generar_plan_trabajo(prompt_completo):
-    """Genera contenido específico para plan de trabajo"""
+def _seccion_plan_trabajo(prompt_completo):
+    """Mensajes para plan de trabajo"""
     messages = [
         {
             "role": "system",
@@ -186,11 +216,10 @@ IMPORTANTE:
         }
     ]
     
-    contenido = call_azure_openai(messages, max_tokens=800)
-    return limpiar_formato_markdown(contenido) if contenido else None
+    return messages, 800, limpiar_seccion
 
-def generar_estructura_equipo(prompt_completo):
-    """Genera contenido específico para estructura del equipo"""
+def _seccion_estructura_equipo(prompt_completo):
+    """Mensajes para estructura del equipo"""
     messages = [
         {
             "role": "system",
@@ -212,11 +241,10 @@ IMPORTANTE:
         }
     ]
     
-    contenido = call_azure_openai(messages, max_tokens=800)
-    return limpiar_formato_markdown(contenido) if contenido else None
+    return messages, 800, limpiar_seccion
 
-def generar_inversion_detallada(prompt_completo):
-    """Genera contenido específico para inversión detallada"""
+def _seccion_inversion_detallada(prompt_completo):
+    """Mensajes para inversión detallada"""
     messages = [
         {
             "role": "system",
@@ -239,11 +267,10 @@ IMPORTANTE:
         }
     ]
     
-    contenido = call_azure_openai(messages, max_tokens=700)
-    return limpiar_formato_markdown(contenido) if contenido else None
+    return messages, 700, limpiar_seccion
 
-def generar_supuestos_condiciones(prompt_completo):
-    """Genera contenido específico para supuestos y condiciones"""
+def _seccion_supuestos_condiciones(prompt_completo):
+    """Mensajes para supuestos y condiciones"""
     messages = [
         {
             "role": "system",
@@ -263,11 +290,10 @@ IMPORTANTE:
         }
     ]
     
-    contenido = call_azure_openai(messages, max_tokens=700)
-    return limpiar_formato_markdown(contenido) if contenido else None
+    return messages, 700, limpiar_seccion
 
-def generar_carta_presentacion(prompt_completo):
-    """Genera contenido específico para carta de presentación"""
+def _seccion_carta_presentacion(prompt_completo):
+    """Mensajes para carta de presentación"""
     info_empresa = extraer_informacion_empresa(prompt_completo)
     
     messages = [
@@ -291,9 +317,9 @@ IMPORTANTE:
         }
     ]
     
-    contenido = call_azure_openai(messages, max_tokens=500)
-    
-    if contenido:
+    def completar_carta(contenido):
+        if not contenido:
+            return None
         carta_personalizada = f"""Estimado Equipo,
 
 Ciudad de México, México {info_empresa['fecha']}
@@ -305,7 +331,95 @@ Sergio Portales Aburto"""
         
         return limpiar_formato_markdown(carta_personalizada)
     
-    return None
+    return messages, 500, completar_carta
+
+# Secciones generadas con Azure OpenAI: placeholder -> función (prompt) -> (messages, max_tokens, postproceso).
+# Las comparten el camino síncrono y el asíncrono.
+SECCIONES_LLM = {
+    "[RESUMEN]": _seccion_resumen_ejecutivo,
+    "[ALCANCE]": _seccion_alcance_minimo,
+    "[PLAN_TRABAJO]": _seccion_plan_trabajo,
+    "[EQUIPO]": _seccion_estructura_equipo,
+    "[INVERSION]": _seccion_inversion_detallada,
+    "[SUPUESTOS]": _seccion_supuestos_condiciones,
+    "[CARTA_PRESENTACION]": _seccion_carta_presentacion
+}
+
+# Placeholders que se llenan a partir del prompt, sin Azure OpenAI
+SECCIONES_LOCALES = {
+    "[titulo]": lambda prompt: generar_titulo_fecha(prompt).split('\n')[0],
+    "[fecha]": lambda prompt: generar_titulo_fecha(prompt).split('\n')[1]
+}
+
+# Secciones que usan la empresa, fecha y título del prompt: esperan a la etapa "empresa", que los extrae
+SECCIONES_CON_CONTEXTO = ("[CARTA_PRESENTACION]", "[titulo]", "[fecha]")
+
+def limpiar_seccion(contenido):
+    """Postproceso por defecto de una sección generada"""
+    return limpiar_formato_markdown(contenido) if contenido else None
+
+def plan_seccion(placeholder, prompt_completo):
+    """
+    Llamada con la que se genera una sección de SECCIONES_LLM.
+
+    Las secciones tabulares ([EQUIPO], [INVERSION]) se arman de las tablas del prompt sin el LLM;
+    con TABLAS_NARRATIVA_LLM la llamada solo escribe el párrafo que acompaña a las tablas.
+
+    :return: Tupla (plan, contenido_tablas): plan es (messages, max_tokens, postproceso), o None si
+             la sección queda completa con contenido_tablas.
+    """
+    contenido_tablas = tablas.formatear(placeholder, prompt_completo)
+    if contenido_tablas is None:
+        return SECCIONES_LLM[placeholder](prompt_completo), None
+    narrativa = tablas.mensajes_narrativa(placeholder, prompt_completo)
+    if narrativa is None:
+        return None, contenido_tablas
+    messages, max_tokens = narrativa
+    return (messages, max_tokens, lambda contenido: tablas.combinar(limpiar_seccion(contenido), contenido_tablas)), contenido_tablas
+
+def generar_seccion(placeholder, prompt_completo):
+    """Genera el contenido de una sección de SECCIONES_LLM"""
+    plan, contenido_tablas = plan_seccion(placeholder, prompt_completo)
+    if plan is None:
+        return contenido_tablas
+    messages, max_tokens, postproceso = plan
+    return postproceso(call_azure_openai(messages, max_tokens=max_tokens))
+
+async def generar_seccion_async(placeholder, prompt_completo):
+    """Versión asíncrona de generar_seccion"""
+    plan, contenido_tablas = plan_seccion(placeholder, prompt_completo)
+    if plan is None:
+        return contenido_tablas
+    messages, max_tokens, postproceso = plan
+    return postproceso(await call_azure_openai_async(messages, max_tokens=max_tokens))
+
+def generar_resumen_ejecutivo(prompt_completo):
+    """Genera contenido específico para resumen ejecutivo"""
+    return generar_seccion("[RESUMEN]", prompt_completo)
+
+def generar_alcance_minimo(prompt_completo):
+    """Genera contenido específico para alcance mínimo"""
+    return generar_seccion("[ALCANCE]", prompt_completo)
+
+def generar_plan_trabajo(prompt_completo):
+    """Genera contenido específico para plan de trabajo"""
+    return generar_seccion("[PLAN_TRABAJO]", prompt_completo)
+
+def generar_estructura_equipo(prompt_completo):
+    """Genera contenido específico para estructura del equipo"""
+    return generar_seccion("[EQUIPO]", prompt_completo)
+
+def generar_inversion_detallada(prompt_completo):
+    """Genera contenido específico para inversión detallada"""
+    return generar_seccion("[INVERSION]", prompt_completo)
+
+def generar_supuestos_condiciones(prompt_completo):
+    """Genera contenido específico para supuestos y condiciones"""
+    return generar_seccion("[SUPUESTOS]", prompt_completo)
+
+def generar_carta_presentacion(prompt_completo):
+    """Genera contenido específico para carta de presentación"""
+    return generar_seccion("[CARTA_PRESENTACION]", prompt_completo)
 
 def generar_titulo_fecha(prompt_completo):
     """Genera título y fecha para el cuadro de texto de la página 1"""
@@ -394,35 +508,53 @@ def replace_in_textboxes(doc, old_text, new_text):
     
     return replacements_made
 
+def reemplazar_placeholder(doc, placeholder, contenido_generado):
+    """Reemplaza un placeholder en párrafos, tablas y cuadros de texto; regresa el número de reemplazos"""
+    # Con MOTOR_RENDER=xml la sustitución se hace al guardar, sobre el XML ya normalizado
+    if motor_xml.es_documento(doc):
+        return motor_xml.reemplazar(doc, placeholder, contenido_generado)
+
+    replacements_for_this_item = 0
+    
+    # 1. Buscar en párrafos normales
+    for paragraph in doc.paragraphs:
+        if replace_in_paragraph(paragraph, placeholder, contenido_generado):
+            replacements_for_this_item += 1
+    
+    # 2. Buscar en tablas
+    replacements_for_this_item += replace_in_tables(doc, placeholder, contenido_generado)
+    
+    # 3. Buscar en cuadros de texto
+    replacements_for_this_item += replace_in_textboxes(doc, placeholder, contenido_generado)
+    
+    return replacements_for_this_item
+
 # ========== FUNCIONES DE AZURE STORAGE ==========
 
 def get_blob_service_client():
     """Obtiene el cliente de Azure Blob Storage"""
-    if not STORAGE_CONNECTION_STRING:
-        raise Exception("Storage connection string no configurado")
-    return BlobServiceClient.from_connection_string(STORAGE_CONNECTION_STRING)
+    return crear_cliente_servicio(STORAGE_CONNECTION_STRING)
+
+def descargar_plantilla(seleccion_plantilla=None):
+    """
+    Obtiene la plantilla compilada seleccionada.
 
-def descargar_plantilla():
-    """Descarga la plantilla desde Blob Storage"""
+    Las plantillas se descubren bajo plantilla/ y se mantienen compiladas en una cache LRU
+    por nombre y ETag, así que solo se descargan y parsean la primera vez.
+
+    :param seleccion_plantilla: Diccionario opcional con 'nombre', 'unidad_negocio' e 'idioma'.
+    :return: Entrada compilada con el documento y sus placeholders; usar copiar_plantilla para editarla.
+    """
     try:
-        blob_service_client = get_blob_service_client()
-        blob_client = blob_service_client.get_blob_client(
-            container=TEMPLATE_CONTAINER_NAME, 
-            blob=TEMPLATE_BLOB_NAME
-        )
-        
-        # Descargar el blob en memoria
-        plantilla_stream = BytesIO()
-        blob_data = blob_client.download_blob()
-        plantilla_stream.write(blob_data.readall())
-        plantilla_stream.seek(0)  # Regresar al inicio del stream para ser leído
-        
-        return plantilla_stream
+        container_client = get_blob_service_client().get_container_client(TEMPLATE_CONTAINER_NAME)
+        return obtener_compilada(container_client, **(seleccion_plantilla or {}))
+    except PlantillaNoEncontrada:
+        raise
     except Exception as e:
         raise Exception(f"Error descargando plantilla: {str(e)}")
 
 def subir_documento(documento_stream, nombre_archivo):
-    """Sube el documento generado a Blob Storage"""
+    """Sube el documento generado a Blob Storage en bloques paralelos"""
     try:
         blob_service_client = get_blob_service_client()
         # Agregar el prefijo de carpeta propuestas/
@@ -433,19 +565,22 @@ def subir_documento(documento_stream, nombre_archivo):
             blob=blob_name
         )
         
-        documento_stream.seek(0)
-        blob_client.upload_blob(documento_stream, overwrite=True)
+        transferencia = subir_desde_stream(blob_client, documento_stream)
         
-        return blob_name  # Retornar solo el nombre del blob para generar SAS después
+        # Retornar el nombre del blob para generar SAS después, junto con las estadísticas de subida
+        return blob_name, transferencia
     except Exception as e:
         raise Exception(f"Error subiendo documento: {str(e)}")
 
-def generar_url_presignada(nombre_archivo, expiracion_minutos=60):
+def generar_url_presignada(nombre_archivo, expiracion_minutos=60, fin_ventana=None):
     """
     Genera una URL pre-firmada (SAS) para acceder al archivo en Azure Blob Storage.
 
     :param nombre_archivo: Nombre del archivo en el contenedor (puede incluir carpeta/).
     :param expiracion_minutos: Tiempo de expiración de la URL en minutos.
+    :param fin_ventana: Si se indica, la expiración se cuenta desde el fin de la ventana de firma en lugar
+                        de ahora: la URL es idéntica para todas las firmas de la misma ventana y dura al
+                        menos `expiracion_minutos` desde cualquiera de ellas.
     :return: URL pre-firmada (SAS).
     """
     try:
@@ -462,7 +597,7 @@ def generar_url_presignada(nombre_archivo, expiracion_minutos=60):
             blob_name=nombre_archivo,
             account_key=blob_service_client.credential.account_key,
             permission=BlobSasPermissions(read=True),  # Solo lectura
-            expiry=datetime.utcnow() + timedelta(minutes=expiracion_minutos)  # Expira en X minutos
+            expiry=(fin_ventana or datetime.utcnow()) + timedelta(minutes=expiracion_minutos)  # Expira en X minutos
         )
 
         # Crear URL con el token SAS
@@ -507,15 +642,42 @@ def obtener_url_documento(nombre_archivo):
 
 # ========== FUNCIÓN PRINCIPAL DE PROCESAMIENTO ==========
 
-def procesar_propuesta_completa(prompt_completo, document_id):
-    """Procesa una propuesta completa"""
+def procesar_propuesta_completa(prompt_completo, document_id, seleccion_plantilla=None, perfilar=False, recibida=None):
+    """
+    Procesa una propuesta completa.
+
+    El proceso se ejecuta como un grafo de etapas: la copia de la plantilla, la extracción de la
+    empresa y cada sección generada corren en paralelo, y cada sección se reemplaza en el documento
+    en cuanto está lista, mientras las demás siguen en curso. Solo se generan las secciones cuyo
+    placeholder existe en la plantilla. Con RENDER_PROCESOS los reemplazos y el guardado se hacen
+    en un pool de procesos (render_procesos) una vez que están todas las secciones.
+
+    Con `perfilar` se muestrean las pilas del pipeline y la memoria de la plantilla y del guardado;
+    el perfil se sube bajo perfiles/{document_id}/ y se enlaza en el resultado.
+
+    Las llamadas al LLM se ajustan al plazo de la solicitud (PLAZO_SOLICITUD_SEGUNDOS desde
+    `recibida`). Las secciones que no alcanzan a generarse quedan fuera del documento, que se sube
+    igual con status "partial" y sus placeholders_pendientes; completar_pendientes las genera después.
+    """
+    sesion_perfil = perfilado.iniciar(f"generar_propuesta:{document_id}") if perfilar else None
     try:
-        # Descargar plantilla
-        plantilla_stream = descargar_plantilla()
-        doc = Document(plantilla_stream)
+        # Tokens de la propuesta (falla de inmediato si el presupuesto diario está agotado)
+        acumulador_tokens = consumo.iniciar()
+        plazo = plazos.iniciar(recibida)
+        # Empresa, fecha y título se extraen una vez del prompt original (etapa "empresa")
+        contexto.iniciar(prompt_completo)
+        
+        # Prompts largos: las secciones se generan a partir de una síntesis del proyecto
+        prompt_completo, info_sintesis = sintesis.preparar(
+            prompt_completo,
+            call_azure_openai,
+            lambda: get_blob_service_client().get_container_client(BLOB_CONTAINER_NAME)
+        )
+        contexto.asociar(prompt_completo)
         
-        # Extraer información de la empresa
-        info_empresa = extraer_informacion_empresa(prompt_completo)
+        # Plantilla compilada (en cache) para conocer sus placeholders antes de generar
+        with perfilado.medir_memoria("plantilla.compilada"):
+            plantilla_compilada = descargar_plantilla(seleccion_plantilla)
         
         # Definir placeholders con funciones de generación
         placeholders_config = {
@@ -526,86 +688,656 @@ def procesar_propuesta_completa(prompt_completo, document_id):
             "[INVERSION]": generar_inversion_detallada,
             "[SUPUESTOS]": generar_supuestos_condiciones,
             "[CARTA_PRESENTACION]": generar_carta_presentacion,
-            "[titulo]": lambda prompt: generar_titulo_fecha(prompt).split('\n')[0],
-            "[fecha]": lambda prompt: generar_titulo_fecha(prompt).split('\n')[1]
+            **SECCIONES_LOCALES
         }
         
-        cambios_totales = 0
+        # No pagar completions para placeholders que la plantilla no contiene
+        placeholders_config, placeholders_omitidos, placeholders_sin_generador = planificar_placeholders(
+            placeholders_config, plantilla_compilada["placeholders"]
+        )
         
-        # Procesar cada placeholder
-        for placeholder, funcion_generadora in placeholders_config.items():
+        # Los reemplazos modifican el mismo documento, así que se serializan entre sí
+        lock_documento = threading.Lock()
+        # Con RENDER_PROCESOS el documento se ensambla completo en el pool de procesos al final
+        procesos = render_procesos.habilitado()
+        
+        def generar(placeholder, funcion_generadora):
+            consumo.etiquetar(placeholder)
             try:
-                # Generar contenido específico
-                contenido_generado = funcion_generadora(prompt_completo)
-                
-                if not contenido_generado:
-                    continue
-                
-                replacements_for_this_item = 0
-                
-                # 1. Buscar en párrafos normales
-                for paragraph in doc.paragraphs:
-                    if replace_in_paragraph(paragraph, placeholder, contenido_generado):
-                        replacements_for_this_item += 1
-                
-                # 2. Buscar en tablas
-                table_replacements = replace_in_tables(doc, placeholder, contenido_generado)
-                replacements_for_this_item += table_replacements
-                
-                # 3. Buscar en cuadros de texto
-                textbox_replacements = replace_in_textboxes(doc, placeholder, contenido_generado)
-                replacements_for_this_item += textbox_replacements
-                
-                cambios_totales += replacements_for_this_item
-                
+                return funcion_generadora(prompt_completo)
+            except PresupuestoExcedido:
+                raise
+            except PlazoAgotado:
+                # El documento se sube sin esta sección; queda pendiente para completar_pendientes
+                plazos.marcar_pendiente(placeholder)
+                return None
             except Exception as e:
                 raise Exception(f"Error procesando {placeholder}: {str(e)}")
         
-        if cambios_totales == 0:
-            raise Exception("No se realizaron cambios en el documento")
-        
-        # Generar nombre de archivo
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        empresa_clean = re.sub(r'[^\w\s-]', '', info_empresa['empresa']).strip()[:20]
-        nombre_archivo = f"Propuesta_{empresa_clean}_{document_id}_{timestamp}.docx"
+        def reemplazar(placeholder, entradas):
+            doc, _ = entradas["plantilla"]
+            contenido_generado = entradas[f"seccion:{placeholder}"]
+            if not contenido_generado:
+                return 0
+            with lock_documento:
+                return reemplazar_placeholder(doc, placeholder, contenido_generado)
         
-        # Guardar documento en memoria
-        documento_stream = BytesIO()
-        doc.save(documento_stream)
+        def copiar_documento():
+            if procesos:
+                return None, info_plantilla(plantilla_compilada)
+            with perfilado.medir_memoria("plantilla.copia"):
+                return copiar_plantilla(plantilla_compilada)
         
-        # Subir a Azure Storage
-        blob_name = subir_documento(documento_stream, nombre_archivo)
+        def guardar_y_subir(entradas):
+            doc, _ = entradas["plantilla"]
+            info_empresa = entradas["empresa"]
+            if procesos:
+                docx_bytes, cambios = render_procesos.renderizar(
+                    plantilla_compilada, contenidos_secciones(entradas, placeholders_config), reemplazar_placeholder
+                )
+                cambios_totales = sum(cambios.values())
+            else:
+                cambios_totales = sum(entradas[f"reemplazo:{placeholder}"] for placeholder in placeholders_config)
+            
+            verificar_cambios(cambios_totales, plazo)
+            
+            nombre_archivo = nombre_archivo_propuesta(info_empresa, document_id)
+            
+            # Guardar documento (en memoria hasta el umbral, después en disco)
+            with crear_stream_temporal() as documento_stream:
+                if procesos:
+                    documento_stream.write(docx_bytes)
+                else:
+                    guardar_documento(doc, documento_stream)
+                
+                # Subir a Azure Storage
+                blob_name, transferencia = subir_documento(documento_stream, nombre_archivo)
+            
+            # Textos de las secciones junto al documento, para renderizarlo de nuevo sin el LLM
+            secciones.guardar(
+                get_blob_service_client().get_container_client(BLOB_CONTAINER_NAME), blob_name, document_id,
+                contenidos_secciones(entradas, placeholders_config), info_plantilla(plantilla_compilada),
+                pendientes=plazos.pendientes(plazo), prompt=prompt_completo
+            )
+            
+            return {
+                "nombre_archivo": nombre_archivo,
+                "blob_name": blob_name,
+                "transferencia": transferencia,
+                "cambios_totales": cambios_totales
+            }
         
+        etapas = {
+            # Obtener copia editable de la plantilla compilada
+            "plantilla": etapa(lambda entradas: copiar_documento()),
+            # Extraer información de la empresa
+            "empresa": etapa(lambda entradas: extraer_informacion_empresa(prompt_completo))
+        }
+        for placeholder, funcion_generadora in placeholders_config.items():
+            etapas[f"seccion:{placeholder}"] = etapa(
+                lambda entradas, p=placeholder, f=funcion_generadora: generar(p, f),
+                dependencias=etapas_previas_seccion(placeholder)
+            )
+            if not procesos:
+                etapas[f"reemplazo:{placeholder}"] = etapa(
+                    lambda entradas, p=placeholder: reemplazar(p, entradas),
+                    dependencias=("plantilla", f"seccion:{placeholder}")
+                )
+        etapas["guardar_subir"] = etapa(
+            guardar_y_subir,
+            dependencias=["plantilla", "empresa"] + etapas_previas_guardado(placeholders_config, procesos)
+        )
         # Generar URL pre-firmada con expiración de 24 horas para el documento recién creado
-        url_presignada = generar_url_presignada(blob_name, expiracion_minutos=1440)  # 24 horas
+        etapas["firmar"] = etapa(
+            lambda entradas: generar_url_presignada(entradas["guardar_subir"]["blob_name"], expiracion_minutos=1440),
+            dependencias=("guardar_subir",)
+        )
+        
+        resultados, reporte = ejecutar_grafo(etapas, nombre_pipeline="generar_propuesta")
+        
+        tokens = consumo.cerrar(acumulador_tokens)
+        
+        # Registrar la propuesta en el manifiesto consultable
+        registrar_propuesta(
+            get_blob_service_client().get_container_client(BLOB_CONTAINER_NAME),
+            registro_propuesta(document_id, resultados, reporte, tokens, plazos.pendientes(plazo))
+        )
+        cache_http.invalidar("listar_propuestas:")
+        
+        # Subir el perfil de la solicitud y enlazarlo en la respuesta
+        perfil = subir_perfil(sesion_perfil, document_id, reporte, tokens)
         
+        return armar_resultado(
+            document_id, resultados, reporte, tokens, perfil, info_sintesis,
+            placeholders_omitidos, placeholders_sin_generador, plazos.pendientes(plazo)
+        )
+        
+    except (PlantillaNoEncontrada, PresupuestoExcedido, PlazoAgotado):
+        raise
+    except Exception as e:
+        raise Exception(f"Error procesando propuesta: {str(e)}")
+    finally:
+        perfilado.detener(sesion_perfil)
+
+def nombre_archivo_propuesta(info_empresa, document_id):
+    """Nombre del documento generado: Propuesta_{empresa}_{document_id}_{timestamp}.docx"""
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    empresa_clean = re.sub(r'[^\w\s-]', '', info_empresa['empresa']).strip()[:20]
+    return f"Propuesta_{empresa_clean}_{document_id}_{timestamp}.docx"
+
+def contenidos_secciones(entradas, placeholders_config):
+    """Textos generados por placeholder (para el pool de procesos y el registro de secciones)"""
+    return {placeholder: entradas[f"seccion:{placeholder}"] for placeholder in placeholders_config}
+
+def etapas_previas_seccion(placeholder):
+    """Las secciones con datos de la empresa esperan a la etapa que los extrae"""
+    return ("empresa",) if placeholder in SECCIONES_CON_CONTEXTO else ()
+
+def etapas_previas_guardado(placeholders_config, procesos):
+    """Etapas que espera el guardado: las secciones (su texto se guarda) y, sin pool de procesos, los reemplazos"""
+    previas = [f"seccion:{placeholder}" for placeholder in placeholders_config]
+    if not procesos:
+        previas += [f"reemplazo:{placeholder}" for placeholder in placeholders_config]
+    return previas
+
+def verificar_cambios(cambios_totales, plazo):
+    """Un documento sin reemplazos no se sube; si fue por falta de tiempo, se reporta como plazo agotado"""
+    if cambios_totales:
+        return
+    if plazos.pendientes(plazo):
+        raise PlazoAgotado("Plazo de la solicitud agotado sin ninguna sección generada")
+    raise Exception("No se realizaron cambios en el documento")
+
+def guardar_documento(doc, documento_stream):
+    """Serializa el documento con el motor con que se creó"""
+    with perfilado.medir_memoria("doc.save"):
+        if motor_xml.es_documento(doc):
+            motor_xml.guardar(doc, documento_stream)
+        else:
+            doc.save(documento_stream)
+
+def registro_propuesta(document_id, resultados, reporte, tokens, pendientes=None):
+    """Registro del manifiesto para una propuesta generada"""
+    documento = resultados["guardar_subir"]
+    extra = {"placeholders_pendientes": pendientes} if pendientes else {}
+    return construir_registro(
+        document_id,
+        documento["nombre_archivo"],
+        documento["blob_name"],
+        resultados["empresa"],
+        documento["transferencia"],
+        resultados["plantilla"][1],
+        reporte,
+        tokens=tokens,
+        **extra
+    )
+
+def subir_perfil(sesion_perfil, document_id, reporte, tokens):
+    """Sube el perfil de la solicitud (si se perfiló) y regresa sus URLs pre-firmadas"""
+    if not sesion_perfil:
+        return None
+    try:
+        blobs_perfil = perfilado.subir(
+            get_blob_service_client().get_container_client(BLOB_CONTAINER_NAME),
+            sesion_perfil,
+            document_id,
+            tiempos=reporte,
+            tokens=tokens
+        )
         return {
-            "document_id": document_id,
-            "filename": nombre_archivo,
-            "blob_name": blob_name,
-            "url_presignada": url_presignada,
-            "empresa": info_empresa['empresa'],
-            "fecha": info_empresa['fecha'],
-            "titulo": info_empresa['titulo'],
-            "cambios_realizados": cambios_totales,
-            "status": "completed"
+            clave: generar_url_presignada(blob_name, expiracion_minutos=1440)
+            for clave, blob_name in blobs_perfil.items()
+        }
+    except Exception as e:
+        return {"error": f"No se pudo subir el perfil: {str(e)}"}
+
+def armar_resultado(document_id, resultados, reporte, tokens, perfil, info_sintesis,
+                    placeholders_omitidos, placeholders_sin_generador, placeholders_pendientes=None):
+    """Resultado de una propuesta generada, común a los caminos síncrono y asíncrono"""
+    info_empresa = resultados["empresa"]
+    documento = resultados["guardar_subir"]
+    return {
+        "document_id": document_id,
+        "filename": documento["nombre_archivo"],
+        "blob_name": documento["blob_name"],
+        "url_presignada": resultados["firmar"],
+        "empresa": info_empresa['empresa'],
+        "fecha": info_empresa['fecha'],
+        "titulo": info_empresa['titulo'],
+        "cambios_realizados": documento["cambios_totales"],
+        "transferencia": documento["transferencia"],
+        "plantilla": resultados["plantilla"][1],
+        "placeholders_omitidos": placeholders_omitidos,
+        "placeholders_sin_generador": placeholders_sin_generador,
+        "placeholders_pendientes": placeholders_pendientes or [],
+        "tiempos": reporte,
+        "tokens": tokens,
+        "perfil": perfil,
+        "sintesis": info_sintesis,
+        # "partial": el plazo se agotó y faltan las secciones de placeholders_pendientes
+        "status": "partial" if placeholders_pendientes else "completed"
+    }
+
+async def procesar_propuesta_completa_async(prompt_completo, document_id, seleccion_plantilla=None, perfilar=False,
+                                           recibida=None):
+    """
+    Versión asíncrona de procesar_propuesta_completa, con el mismo grafo de etapas.
+
+    Las secciones se generan con la sesión aiohttp compartida y el documento se sube con
+    azure.storage.blob.aio, sin ocupar un hilo mientras esperan; la copia de la plantilla,
+    los reemplazos y el guardado del docx (CPU) corren en el executor de asincrono. Así un
+    solo worker mantiene en curso muchas propuestas a la vez.
+    """
+    sesion_perfil = perfilado.iniciar(f"generar_propuesta:{document_id}") if perfilar else None
+    try:
+        acumulador_tokens = consumo.iniciar()
+        plazo = plazos.iniciar(recibida)
+        contexto.iniciar(prompt_completo)
+        contenedor = asincrono.servicio_blob(STORAGE_CONNECTION_STRING).get_container_client(BLOB_CONTAINER_NAME)
+        
+        # La síntesis de prompts largos y la plantilla (en cache) usan el camino síncrono en el executor
+        # de I/O: una síntesis de varios minutos no frena el trabajo de CPU de las demás propuestas
+        prompt_completo, info_sintesis = await asincrono.en_executor_io(
+            sintesis.preparar,
+            prompt_completo,
+            call_azure_openai,
+            lambda: get_blob_service_client().get_container_client(BLOB_CONTAINER_NAME)
+        )
+        contexto.asociar(prompt_completo)
+        
+        def compilar_plantilla():
+            with perfilado.medir_memoria("plantilla.compilada"):
+                return descargar_plantilla(seleccion_plantilla)
+        
+        plantilla_compilada = await asincrono.en_executor_io(compilar_plantilla)
+        
+        placeholders_config = dict.fromkeys(SECCIONES_LLM, generar_seccion_async)
+        placeholders_config["[titulo]"] = lambda placeholder, prompt: generar_titulo_fecha(prompt).split('\n')[0]
+        placeholders_config["[fecha]"] = lambda placeholder, prompt: generar_titulo_fecha(prompt).split('\n')[1]
+        
+        placeholders_config, placeholders_omitidos, placeholders_sin_generador = planificar_placeholders(
+            placeholders_config, plantilla_compilada["placeholders"]
+        )
+        
+        lock_documento = threading.Lock()
+        procesos = render_procesos.habilitado()
+        
+        async def generar(placeholder, funcion_generadora, entradas):
+            consumo.etiquetar(placeholder)
+            try:
+                contenido = funcion_generadora(placeholder, prompt_completo)
+                return await contenido if asyncio.iscoroutine(contenido) else contenido
+            except PresupuestoExcedido:
+                raise
+            except PlazoAgotado:
+                plazos.marcar_pendiente(placeholder)
+                return None
+            except Exception as e:
+                raise Exception(f"Error procesando {placeholder}: {str(e)}")
+        
+        def reemplazar(placeholder, entradas):
+            doc, _ = entradas["plantilla"]
+            contenido_generado = entradas[f"seccion:{placeholder}"]
+            if not contenido_generado:
+                return 0
+            with lock_documento:
+                return reemplazar_placeholder(doc, placeholder, contenido_generado)
+        
+        def copiar_documento(entradas):
+            if procesos:
+                return None, info_plantilla(plantilla_compilada)
+            with perfilado.medir_memoria("plantilla.copia"):
+                return copiar_plantilla(plantilla_compilada)
+        
+        async def guardar_y_subir(entradas):
+            doc, _ = entradas["plantilla"]
+            if procesos:
+                docx_bytes, cambios = await render_procesos.renderizar_async(
+                    plantilla_compilada, contenidos_secciones(entradas, placeholders_config), reemplazar_placeholder
+                )
+                cambios_totales = sum(cambios.values())
+            else:
+                cambios_totales = sum(entradas[f"reemplazo:{placeholder}"] for placeholder in placeholders_config)
+            
+            verificar_cambios(cambios_totales, plazo)
+            
+            nombre_archivo = nombre_archivo_propuesta(entradas["empresa"], document_id)
+            blob_name = f"{PROPUESTAS_FOLDER}{nombre_archivo}"
+            
+            with crear_stream_temporal() as documento_stream:
+                if procesos:
+                    documento_stream.write(docx_bytes)
+                else:
+                    await asincrono.en_executor(guardar_documento, doc, documento_stream)
+                try:
+                    transferencia = await subir_desde_stream_async(contenedor.get_blob_client(blob_name), documento_stream)
+                except Exception as e:
+                    raise Exception(f"Error subiendo documento: {str(e)}")
+            
+            await secciones.guardar_async(
+                contenedor, blob_name, document_id,
+                contenidos_secciones(entradas, placeholders_config), info_plantilla(plantilla_compilada),
+                pendientes=plazos.pendientes(plazo), prompt=prompt_completo
+            )
+            
+            return {
+                "nombre_archivo": nombre_archivo,
+                "blob_name": blob_name,
+                "transferencia": transferencia,
+                "cambios_totales": cambios_totales
+            }
+        
+        async def firmar(entradas):
+            # La firma SAS es local (HMAC con la llave de la cuenta), no requiere I/O
+            return generar_url_presignada(entradas["guardar_subir"]["blob_name"], expiracion_minutos=1440)
+        
+        etapas = {
+            "plantilla": etapa(copiar_documento),
+            "empresa": etapa(lambda entradas: extraer_informacion_empresa(prompt_completo))
         }
+        for placeholder, funcion_generadora in placeholders_config.items():
+            etapas[f"seccion:{placeholder}"] = etapa(
+                functools.partial(generar, placeholder, funcion_generadora),
+                dependencias=etapas_previas_seccion(placeholder)
+            )
+            if not procesos:
+                etapas[f"reemplazo:{placeholder}"] = etapa(
+                    lambda entradas, p=placeholder: reemplazar(p, entradas),
+                    dependencias=("plantilla", f"seccion:{placeholder}")
+                )
+        etapas["guardar_subir"] = etapa(
+            guardar_y_subir,
+            dependencias=["plantilla", "empresa"] + etapas_previas_guardado(placeholders_config, procesos)
+        )
+        etapas["firmar"] = etapa(firmar, dependencias=("guardar_subir",))
+        
+        resultados, reporte = await ejecutar_grafo_async(etapas, nombre_pipeline="generar_propuesta")
+        
+        tokens = consumo.cerrar(acumulador_tokens)
+        
+        await registrar_propuesta_async(
+            contenedor, registro_propuesta(document_id, resultados, reporte, tokens, plazos.pendientes(plazo))
+        )
+        cache_http.invalidar("listar_propuestas:")
+        
+        perfil = await asincrono.en_executor_io(subir_perfil, sesion_perfil, document_id, reporte, tokens)
+        
+        return armar_resultado(
+            document_id, resultados, reporte, tokens, perfil, info_sintesis,
+            placeholders_omitidos, placeholders_sin_generador, plazos.pendientes(plazo)
+        )
         
+    except (PlantillaNoEncontrada, PresupuestoExcedido, PlazoAgotado):
+        raise
     except Exception as e:
         raise Exception(f"Error procesando propuesta: {str(e)}")
+    finally:
+        perfilado.detener(sesion_perfil)
+
+# ========== SECCIONES PENDIENTES ==========
+
+def generar_pendiente(placeholder, prompt_completo):
+    """Genera una sección pendiente; regresa None si de nuevo no alcanza el plazo"""
+    consumo.etiquetar(placeholder)
+    try:
+        if placeholder in SECCIONES_LLM:
+            return generar_seccion(placeholder, prompt_completo)
+        if placeholder in SECCIONES_LOCALES:
+            return SECCIONES_LOCALES[placeholder](prompt_completo)
+    except PlazoAgotado:
+        plazos.marcar_pendiente(placeholder)
+        return None
+    logging.warning(f"{placeholder}: sin generador para completarla, sigue pendiente")
+    return None
+
+def completar_pendientes(document_id, recibida=None):
+    """
+    Genera las secciones que una propuesta dejó pendientes al agotarse su plazo y sube de nuevo el
+    documento, en el mismo blob y con el mismo document_id. Las secciones se generan en paralelo
+    con un plazo nuevo; las que tampoco alcanzan siguen pendientes.
+
+    Solo se completan los placeholders de SECCIONES_LLM y SECCIONES_LOCALES; los personalizados
+    de generar_documento siguen pendientes.
+
+    :return: Resultado con las secciones completadas y las pendientes, o None si la propuesta no
+             existe o no tiene registro de secciones.
+    """
+    contenedor = get_blob_service_client().get_container_client(BLOB_CONTAINER_NAME)
+    registro = buscar_por_id(contenedor, document_id)
+    if registro is None:
+        return None
+    
+    acumulador_tokens = consumo.iniciar()
+    plazos.iniciar(recibida)
+    # La misma plantilla con que se generó (su versión vigente)
+    plantilla_compilada = descargar_plantilla({"nombre": (registro.get("plantilla") or {}).get("nombre")})
+    
+    def generar(pendientes, prompt_completo):
+        etapas = {
+            placeholder: etapa(lambda entradas, p=placeholder: generar_pendiente(p, prompt_completo))
+            for placeholder in pendientes
+        }
+        resultados, _ = ejecutar_grafo(etapas, nombre_pipeline="completar_propuesta")
+        return resultados
+    
+    resumen = secciones.completar(
+        contenedor, registro["blob_name"], plantilla_compilada, reemplazar_placeholder, generar
+    )
+    tokens = consumo.cerrar(acumulador_tokens)
+    if resumen is None:
+        return None
+    cache_http.invalidar("listar_propuestas:")
+    
+    return {
+        "document_id": document_id,
+        "blob_name": registro["blob_name"],
+        "url_presignada": generar_url_presignada(registro["blob_name"], expiracion_minutos=1440),
+        "completadas": resumen["completadas"],
+        "placeholders_pendientes": resumen["pendientes"],
+        "transferencia": resumen["transferencia"],
+        "tokens": tokens,
+        "status": "partial" if resumen["pendientes"] else "completed"
+    }
+
+# ========== MODO OFFLINE (BATCH API) ==========
+
+# Estado de cada trabajo batch (propuestas planificadas y ya ensambladas), para ensamblar después
+BATCH_PREFIJO = "batch/"
+
+def configuracion_batch():
+    return batch_openai.configuracion(AZURE_OPENAI_ENDPOINT, DEPLOYMENT_NAME, AZURE_OPENAI_API_KEY)
+
+def preparar_batch(propuestas):
+    """
+    Planifica las secciones de varias propuestas como solicitudes de un trabajo batch.
+
+    :param propuestas: Lista de {"prompt", "document_id" (opcional), "plantilla" (selección opcional)}.
+    :return: Tupla (propuestas planificadas, solicitudes (custom_id, messages, max_tokens)).
+    """
+    planificadas, solicitudes = [], []
+    for propuesta in propuestas:
+        document_id = propuesta.get("document_id") or str(uuid.uuid4())[:8]
+        seleccion = propuesta.get("plantilla") or {}
+        plantilla_compilada = descargar_plantilla(seleccion)
+        placeholders_config, _, _ = planificar_placeholders(
+            {**dict.fromkeys(SECCIONES_LLM, generar_seccion), **SECCIONES_LOCALES}, plantilla_compilada["placeholders"]
+        )
+        for placeholder in placeholders_config:
+            if placeholder not in SECCIONES_LLM:
+                continue
+            # Las secciones que se arman de las tablas del prompt no necesitan solicitud
+            plan, _ = plan_seccion(placeholder, propuesta["prompt"])
+            if plan is not None:
+                messages, max_tokens, _ = plan
+                solicitudes.append((f"{document_id}|{placeholder}", messages, max_tokens))
+        planificadas.append({
+            "document_id": document_id,
+            "prompt": propuesta["prompt"],
+            "plantilla": seleccion,
+            "placeholders": list(placeholders_config)
+        })
+    return planificadas, solicitudes
+
+def _blob_estado_batch(contenedor, batch_id):
+    return contenedor.get_blob_client(f"{BATCH_PREFIJO}{batch_id}.json")
+
+def _guardar_estado_batch(blob_estado, estado):
+    blob_estado.upload_blob(json.dumps(estado, ensure_ascii=False).encode("utf-8"), overwrite=True)
+
+def enviar_batch(propuestas):
+    """
+    Envía las secciones de varias propuestas como un solo trabajo de la Batch API.
+
+    Falla de inmediato si el presupuesto diario de tokens está agotado.
+
+    :return: Estado del trabajo (también guardado en batch/{batch_id}.json).
+    """
+    consumo.iniciar()
+    planificadas, solicitudes = preparar_batch(propuestas)
+    if not solicitudes:
+        raise Exception("Ninguna propuesta tiene secciones por generar con la plantilla seleccionada")
+    trabajo = batch_openai.enviar(configuracion_batch(), solicitudes)
+
+    estado = {
+        "batch_id": trabajo["id"],
+        "creado": datetime.now().isoformat(),
+        "solicitudes": len(solicitudes),
+        "propuestas": planificadas,
+        "ensambladas": {}
+    }
+    contenedor = get_blob_service_client().get_container_client(BLOB_CONTAINER_NAME)
+    _guardar_estado_batch(_blob_estado_batch(contenedor, trabajo["id"]), estado)
+    return estado
+
+def ensamblar_propuesta_batch(contenedor, batch_id, propuesta, respuestas):
+    """
+    Arma y sube el documento de una propuesta con las respuestas del trabajo batch.
+
+    Las secciones que fallaron en el batch se generan en línea para no dejar el documento incompleto.
+    """
+    inicio = time.perf_counter()
+    document_id, prompt = propuesta["document_id"], propuesta["prompt"]
+    plantilla_compilada = descargar_plantilla(propuesta["plantilla"])
+
+    contenidos, usos, en_linea = {}, [], []
+    for placeholder in propuesta["placeholders"]:
+        if placeholder not in SECCIONES_LLM:
+            contenidos[placeholder] = SECCIONES_LOCALES[placeholder](prompt)
+            continue
+        plan, contenido_tablas = plan_seccion(placeholder, prompt)
+        if plan is None:
+            contenidos[placeholder] = contenido_tablas
+            continue
+        respuesta = respuestas.get(f"{document_id}|{placeholder}") or {"error": "sin respuesta"}
+        if "error" in respuesta:
+            logging.warning(f"Sección {placeholder} de {document_id} fallida en el batch: {respuesta['error']}")
+            contenidos[placeholder] = generar_seccion(placeholder, prompt)
+            en_linea.append(placeholder)
+            continue
+        _, _, postproceso = plan
+        contenidos[placeholder] = postproceso(respuesta["contenido"])
+        usos.append(respuesta["usage"])
+        consumo.registrar_uso(respuesta["usage"])
+
+    info_empresa = extraer_informacion_empresa(prompt)
+    nombre_archivo = nombre_archivo_propuesta(info_empresa, document_id)
+    with crear_stream_temporal() as documento_stream:
+        cambios = secciones.ensamblar_documento(plantilla_compilada, contenidos, reemplazar_placeholder, documento_stream)
+        if not sum(cambios.values()):
+            raise Exception("No se realizaron cambios en el documento")
+        blob_name, transferencia = subir_documento(documento_stream, nombre_archivo)
+
+    plantilla = info_plantilla(plantilla_compilada)
+    tokens = batch_openai.sumar_uso(usos)
+    secciones.guardar(contenedor, blob_name, document_id, contenidos, plantilla)
+    registrar_propuesta(contenedor, construir_registro(
+        document_id, nombre_archivo, blob_name, info_empresa, transferencia, plantilla,
+        {"duracion_total_ms": round((time.perf_counter() - inicio) * 1000, 1)},
+        tokens=tokens, modo="batch", batch_id=batch_id
+    ))
+    return {"blob_name": blob_name, "tokens": tokens, "secciones_en_linea": en_linea}
+
+def ensamblar_batch(batch_id, esperar=True, intervalo=None, al_sondear=None, hilos=8):
+    """
+    Espera el trabajo batch y arma, sube y registra los documentos de sus propuestas.
+
+    El estado se guarda al terminar cada propuesta y las ya ensambladas se omiten, así que un
+    ensamblado interrumpido se reanuda volviendo a llamarlo sin volver a subir documentos.
+
+    :return: Reporte con las propuestas ensambladas, errores, tokens, costo (batch y equivalente
+             en línea) y throughput del trabajo.
+    """
+    config = configuracion_batch()
+    contenedor = get_blob_service_client().get_container_client(BLOB_CONTAINER_NAME)
+    blob_estado = _blob_estado_batch(contenedor, batch_id)
+    estado = json.loads(blob_estado.download_blob().readall())
+
+    trabajo = (
+        batch_openai.esperar(config, batch_id, intervalo=intervalo, al_sondear=al_sondear) if esperar
+        else batch_openai.consultar(config, batch_id)
+    )
+    if trabajo["status"] not in batch_openai.ESTADOS_FINALES:
+        return {"batch_id": batch_id, "status": trabajo["status"], "request_counts": trabajo.get("request_counts")}
+    respuestas = batch_openai.resultados(config, trabajo)
+
+    inicio = time.perf_counter()
+    pendientes = [p for p in estado["propuestas"] if p["document_id"] not in estado["ensambladas"]]
+    errores = {}
+    lock_estado = threading.Lock()
+
+    def una(propuesta):
+        try:
+            resultado = ensamblar_propuesta_batch(contenedor, batch_id, propuesta, respuestas)
+        except Exception as e:
+            logging.error(f"Error ensamblando {propuesta['document_id']} del batch {batch_id}: {str(e)}")
+            with lock_estado:
+                errores[propuesta["document_id"]] = str(e)
+            return
+        # Guardado en orden bajo el lock: una escritura no pisa a otra más reciente
+        with lock_estado:
+            estado["ensambladas"][propuesta["document_id"]] = resultado
+            try:
+                _guardar_estado_batch(blob_estado, estado)
+            except Exception as e:
+                logging.error(f"No se pudo guardar el estado del batch {batch_id}: {str(e)}")
+
+    with ThreadPoolExecutor(max_workers=hilos) as executor:
+        list(executor.map(una, pendientes))
+
+    tokens = batch_openai.sumar_uso(r.get("usage") for r in respuestas.values())
+    duracion_trabajo = (trabajo.get("completed_at") or 0) - (trabajo.get("created_at") or 0)
+    ensambladas = len(estado["ensambladas"])
+    return {
+        "batch_id": batch_id,
+        "status": trabajo["status"],
+        "propuestas": len(estado["propuestas"]),
+        "ensambladas": ensambladas,
+        "errores": errores,
+        "secciones_en_linea": sum(len(r["secciones_en_linea"]) for r in estado["ensambladas"].values()),
+        "tokens": tokens,
+        "costo_usd": batch_openai.costo(tokens, batch_openai.BATCH_FACTOR_COSTO),
+        "costo_en_linea_usd": batch_openai.costo(tokens),
+        "duracion_trabajo_s": duracion_trabajo,
+        "duracion_ensamblado_s": round(time.perf_counter() - inicio, 2),
+        "propuestas_por_hora": round(ensambladas * 3600 / duracion_trabajo, 1) if duracion_trabajo > 0 else None
+    }
 
 # ========== AZURE FUNCTIONS ==========
 
 @app.function_name(name="generar_propuesta")
 @app.route(route="generar_propuesta", methods=["POST"], auth_level=func.AuthLevel.ANONYMOUS)
-def generar_propuesta(req: func.HttpRequest) -> func.HttpResponse:
+async def generar_propuesta(req: func.HttpRequest) -> func.HttpResponse:
     """Endpoint POST para generar propuesta"""
+    # El plazo de la solicitud corre desde que llega (incluye la espera en la cola de admisión)
+    recibida = time.monotonic()
     try:
         # Obtener el prompt del cuerpo de la solicitud
+        seleccion_plantilla = {}
         try:
             req_body = req.get_json()
             if req_body and 'prompt' in req_body:
                 prompt_completo = req_body['prompt']
+                seleccion_plantilla = seleccion_desde_body(req_body)
             else:
                 prompt_completo = req.get_body().decode('utf-8')
         except Exception:
@@ -624,26 +1356,115 @@ def generar_propuesta(req: func.HttpRequest) -> func.HttpResponse:
         # Generar ID único para el documento
         document_id = str(uuid.uuid4())[:8]
         
+        # Solicitudes idénticas o con la misma Idempotency-Key comparten un solo trabajo
+        huella = calcular_huella(prompt_completo, seleccion_plantilla=seleccion_plantilla)
+        clave_idempotencia = obtener_clave(req, huella)
+        
+        async def procesar():
+            # Solo el trabajo nuevo ocupa un lugar; los duplicados esperan su resultado
+            async with admision.admitir_async():
+                return await procesar_propuesta_completa_async(
+                    prompt_completo, document_id, seleccion_plantilla, perfilar=perfilado.solicitado(req),
+                    recibida=recibida
+                )
+        
         try:
             # Procesar la propuesta
-            resultado = procesar_propuesta_completa(prompt_completo, document_id)
+            resultado, origen = await ejecutar_una_vez_async(clave_idempotencia, huella, procesar)
+            parcial = resultado["status"] == "partial"
             
             return func.HttpResponse(
                 json.dumps({
-                    "message": "Propuesta generada exitosamente",
-                    "document_id": document_id,
+                    "message": (
+                        f"Propuesta generada con secciones pendientes por falta de tiempo; se completan con "
+                        f"POST /api/completar_propuesta/{resultado['document_id']}"
+                        if parcial else "Propuesta generada exitosamente"
+                    ),
+                    "document_id": resultado["document_id"],
                     "filename": resultado["filename"],
                     "url_presignada": resultado["url_presignada"],
                     "expira_en_horas": 24,
                     "empresa": resultado["empresa"],
                     "titulo": resultado["titulo"],
                     "cambios_realizados": resultado["cambios_realizados"],
-                    "status": "completed"
+                    "transferencia": resultado["transferencia"],
+                    "plantilla": resultado["plantilla"],
+                    "placeholders_omitidos": resultado["placeholders_omitidos"],
+                    "placeholders_sin_generador": resultado["placeholders_sin_generador"],
+                    "placeholders_pendientes": resultado["placeholders_pendientes"],
+                    "tiempos": resultado["tiempos"],
+                    "tokens": resultado["tokens"],
+                    "perfil": resultado["perfil"],
+                    "sintesis": resultado.get("sintesis"),
+                    "deduplicado": origen != "nuevo",
+                    "origen_resultado": origen,
+                    "status": resultado["status"]
                 }),
                 status_code=200,
                 mimetype="application/json"
             )
             
+        except ConflictoIdempotencia as conflicto:
+            return func.HttpResponse(
+                json.dumps({
+                    "error": str(conflicto),
+                    "document_id": None,
+                    "status": "conflict"
+                }),
+                status_code=422,
+                mimetype="application/json"
+            )
+            
+        except PlantillaNoEncontrada as sin_plantilla:
+            return func.HttpResponse(
+                json.dumps({
+                    "error": str(sin_plantilla),
+                    "document_id": document_id,
+                    "status": "failed"
+                }),
+                status_code=404,
+                mimetype="application/json"
+            )
+            
+        except PresupuestoExcedido as excedido:
+            # El presupuesto diario se recupera al día siguiente; el de la solicitud no
+            return func.HttpResponse(
+                json.dumps({
+                    "error": str(excedido),
+                    "document_id": document_id,
+                    "presupuesto": excedido.alcance,
+                    "status": "budget_exceeded"
+                }),
+                status_code=429 if excedido.alcance == "diario" else 422,
+                mimetype="application/json",
+                headers={"Retry-After": str(excedido.reintentar_en)} if excedido.reintentar_en else None
+            )
+            
+        except CapacidadAgotada as agotada:
+            # Se rechaza antes de llamar a Azure OpenAI; el cliente reintenta después de Retry-After
+            return func.HttpResponse(
+                json.dumps({
+                    "error": str(agotada),
+                    "document_id": None,
+                    "status": "overloaded"
+                }),
+                status_code=agotada.codigo,
+                mimetype="application/json",
+                headers={"Retry-After": str(agotada.reintentar_en)}
+            )
+            
+        except PlazoAgotado as agotado:
+            # Sin tiempo ni para una sección (p. ej. la síntesis de un prompt largo consumió el plazo)
+            return func.HttpResponse(
+                json.dumps({
+                    "error": str(agotado),
+                    "document_id": None,
+                    "status": "timeout"
+                }),
+                status_code=504,
+                mimetype="application/json"
+            )
+            
         except Exception as processing_error:
             return func.HttpResponse(
                 json.dumps({
@@ -665,9 +1486,67 @@ def generar_propuesta(req: func.HttpRequest) -> func.HttpResponse:
             mimetype="application/json"
         )
 
+@app.function_name(name="completar_propuesta")
+@app.route(route="completar_propuesta/{document_id}", methods=["POST"], auth_level=func.AuthLevel.ANONYMOUS)
+def completar_propuesta(req: func.HttpRequest) -> func.HttpResponse:
+    """Endpoint POST para generar las secciones que una propuesta dejó pendientes (status "partial")"""
+    recibida = time.monotonic()
+    document_id = req.route_params.get('document_id')
+    try:
+        with admision.admitir():
+            resultado = completar_pendientes(document_id, recibida=recibida)
+        
+        if resultado is None:
+            return func.HttpResponse(
+                json.dumps({
+                    "error": f"Propuesta {document_id} no encontrada o sin registro de secciones",
+                    "document_id": document_id,
+                    "status": "not_found"
+                }),
+                status_code=404,
+                mimetype="application/json"
+            )
+        return func.HttpResponse(json.dumps(resultado), status_code=200, mimetype="application/json")
+    
+    except PlantillaNoEncontrada as sin_plantilla:
+        return func.HttpResponse(
+            json.dumps({"error": str(sin_plantilla), "document_id": document_id, "status": "failed"}),
+            status_code=404,
+            mimetype="application/json"
+        )
+    except PresupuestoExcedido as excedido:
+        return func.HttpResponse(
+            json.dumps({
+                "error": str(excedido),
+                "document_id": document_id,
+                "presupuesto": excedido.alcance,
+                "status": "budget_exceeded"
+            }),
+            status_code=429 if excedido.alcance == "diario" else 422,
+            mimetype="application/json",
+            headers={"Retry-After": str(excedido.reintentar_en)} if excedido.reintentar_en else None
+        )
+    except CapacidadAgotada as agotada:
+        return func.HttpResponse(
+            json.dumps({"error": str(agotada), "document_id": document_id, "status": "overloaded"}),
+            status_code=agotada.codigo,
+            mimetype="application/json",
+            headers={"Retry-After": str(agotada.reintentar_en)}
+        )
+    except Exception as e:
+        return func.HttpResponse(
+            json.dumps({
+                "error": f"Error completando propuesta: {str(e)}",
+                "document_id": document_id,
+                "status": "failed"
+            }),
+            status_code=500,
+            mimetype="application/json"
+        )
+
 @app.function_name(name="obtener_propuesta")
 @app.route(route="obtener_propuesta/{document_id}", methods=["GET"], auth_level=func.AuthLevel.ANONYMOUS)
-def obtener_propuesta(req: func.HttpRequest) -> func.HttpResponse:
+async def obtener_propuesta(req: func.HttpRequest) -> func.HttpResponse:
     """Endpoint GET para obtener URL del documento generado"""
     try:
         document_id = req.route_params.get('document_id')
@@ -683,37 +1562,69 @@ def obtener_propuesta(req: func.HttpRequest) -> func.HttpResponse:
             )
         
         try:
-            # Buscar documentos que contengan el document_id en la carpeta propuestas/
-            blob_service_client = get_blob_service_client()
-            container_client = blob_service_client.get_container_client(BLOB_CONTAINER_NAME)
+            # Los sondeos repetidos se atienden desde memoria sin consultar Storage
+            clave_cache = f"obtener_propuesta:{document_id}"
+            entrada_cache = cache_http.obtener(clave_cache)
+            if entrada_cache:
+                return cache_http.responder(req, entrada_cache)
             
-            # Buscar blobs que contengan el document_id en la carpeta propuestas/
-            blobs = container_client.list_blobs(name_starts_with=PROPUESTAS_FOLDER)
-            documento_encontrado = None
+            container_client = asincrono.servicio_blob(STORAGE_CONNECTION_STRING).get_container_client(BLOB_CONTAINER_NAME)
             
-            for blob in blobs:
-                if document_id in blob.name and blob.name.endswith('.docx'):
-                    documento_encontrado = blob
-                    break
+            # Buscar primero en el manifiesto; solo las propuestas no indexadas requieren listar la carpeta
+            registro = await buscar_por_id_async(container_client, document_id)
+            if registro:
+                documento_encontrado = {
+                    "blob_name": registro["blob_name"],
+                    "etag": registro.get("etag"),
+                    "size_bytes": registro.get("size_bytes"),
+                    "last_modified": registro.get("creado"),
+                    "empresa": registro.get("empresa"),
+                    "titulo": registro.get("titulo")
+                }
+            else:
+                documento_encontrado = None
+                
+                # Buscar blobs que contengan el document_id en la carpeta propuestas/
+                async for blob in container_client.list_blobs(name_starts_with=PROPUESTAS_FOLDER):
+                    if document_id in blob.name and blob.name.endswith('.docx'):
+                        documento_encontrado = {
+                            "blob_name": blob.name,
+                            "etag": blob.etag,
+                            "size_bytes": blob.size,
+                            "last_modified": blob.last_modified.isoformat() if blob.last_modified else None
+                        }
+                        break
             
             if documento_encontrado:
-                # Generar URL pre-firmada con expiración de 2 horas
-                url_presignada = generar_url_presignada(documento_encontrado.name, expiracion_minutos=120)  # 2 horas
+                # Generar URL pre-firmada con expiración de 2 horas, estable durante la ventana de firma
+                inicio_ventana, fin_ventana = cache_http.ventana_sas()
+                url_presignada = generar_url_presignada(
+                    documento_encontrado["blob_name"], expiracion_minutos=120, fin_ventana=fin_ventana
+                )  # 2 horas
                 
-                return func.HttpResponse(
-                    json.dumps({
-                        "message": "Documento encontrado",
-                        "document_id": document_id,
-                        "filename": documento_encontrado.name.replace(PROPUESTAS_FOLDER, ""),  # Remover prefijo para el filename
-                        "url_presignada": url_presignada,
-                        "expira_en_horas": 2,
-                        "size_bytes": documento_encontrado.size,
-                        "last_modified": documento_encontrado.last_modified.isoformat() if documento_encontrado.last_modified else None,
-                        "status": "found"
-                    }),
-                    status_code=200,
-                    mimetype="application/json"
+                cuerpo = json.dumps({
+                    "message": "Documento encontrado",
+                    "document_id": document_id,
+                    "filename": documento_encontrado["blob_name"].replace(PROPUESTAS_FOLDER, ""),  # Remover prefijo para el filename
+                    "url_presignada": url_presignada,
+                    "expira_en_horas": 2,
+                    "size_bytes": documento_encontrado["size_bytes"],
+                    "last_modified": documento_encontrado["last_modified"],
+                    "empresa": documento_encontrado.get("empresa"),
+                    "titulo": documento_encontrado.get("titulo"),
+                    "status": "found"
+                })
+                
+                # El ETag cambia si cambia el blob o si empieza otra ventana de firma (nueva URL SAS)
+                last_modified = cache_http.parsear_fecha(documento_encontrado["last_modified"])
+                entrada_cache = cache_http.guardar(
+                    clave_cache,
+                    cuerpo,
+                    cache_http.calcular_etag(documento_encontrado["etag"] or documento_encontrado["blob_name"], inicio_ventana),
+                    max(last_modified, inicio_ventana) if last_modified else inicio_ventana,
+                    cache_http.segundos_restantes(fin_ventana)
                 )
+                return cache_http.responder(req, entrada_cache)
             else:
                 return func.HttpResponse(
                     json.dumps({
@@ -746,52 +1657,170 @@ def obtener_propuesta(req: func.HttpRequest) -> func.HttpResponse:
             mimetype="application/json"
         )
 
+def parsear_nombre_propuesta(filename):
+    """
+    Extrae document_id y empresa de 'Propuesta_{empresa}_{document_id}_{YYYYmmdd}_{HHMMSS}.docx'.
+
+    Se interpreta desde la derecha para soportar empresas con guiones bajos. Solo se usa para
+    indexar propuestas generadas antes del manifiesto.
+    """
+    parts = filename[:-len('.docx')].split('_')
+    if len(parts) < 5 or parts[0] != "Propuesta" or not re.fullmatch(r'[0-9a-f]{8}', parts[-3]):
+        return None
+    return {
+        "document_id": parts[-3],
+        "empresa": "_".join(parts[1:-3]),
+        "timestamp": f"{parts[-2]}_{parts[-1]}"
+    }
+
 @app.function_name(name="listar_propuestas")
 @app.route(route="listar_propuestas", methods=["GET"], auth_level=func.AuthLevel.ANONYMOUS)
-def listar_propuestas(req: func.HttpRequest) -> func.HttpResponse:
-    """Endpoint GET para listar todas las propuestas generadas"""
+async def listar_propuestas(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Endpoint GET para listar las propuestas generadas desde el manifiesto.
+
+    Query params opcionales: empresa, desde, hasta (fechas ISO), orden (creado, empresa, titulo,
+    size_bytes, duracion_ms, tokens_total), direccion (asc/desc), limite, pagina y reindexar=true para indexar
+    propuestas anteriores al manifiesto.
+    """
     try:
-        blob_service_client = get_blob_service_client()
+        blob_service_client = asincrono.servicio_blob(STORAGE_CONNECTION_STRING)
         container_client = blob_service_client.get_container_client(BLOB_CONTAINER_NAME)
         
-        # Obtener todos los blobs de la carpeta propuestas/
-        blobs = container_client.list_blobs(name_starts_with=PROPUESTAS_FOLDER)
+        reindexados = None
+        if req.params.get('reindexar') == 'true':
+            # Reindexar es una operación administrativa poco frecuente: usa el cliente síncrono en el executor
+            reindexados = await asincrono.en_executor_io(
+                reindexar_desde_blobs,
+                get_blob_service_client().get_container_client(BLOB_CONTAINER_NAME),
+                PROPUESTAS_FOLDER,
+                parsear_nombre_propuesta
+            )
+            cache_http.invalidar("listar_propuestas:")
+        
+        # Consultas repetidas con los mismos filtros se atienden desde memoria
+        parametros_consulta = {k: v for k, v in req.params.items() if k != 'reindexar'}
+        clave_cache = "listar_propuestas:" + json.dumps(parametros_consulta, sort_keys=True)
+        entrada_cache = cache_http.obtener(clave_cache) if reindexados is None else None
+        if entrada_cache:
+            return cache_http.responder(req, entrada_cache)
+        
+        try:
+            limite = int(req.params.get('limite', 50))
+            pagina = int(req.params.get('pagina', 1))
+            total, registros = await consultar_async(
+                container_client,
+                empresa=req.params.get('empresa'),
+                desde=req.params.get('desde'),
+                hasta=req.params.get('hasta'),
+                orden=req.params.get('orden', 'creado'),
+                descendente=req.params.get('direccion', 'desc').lower() != 'asc',
+                limite=limite,
+                pagina=pagina
+            )
+        except ValueError as parametro_invalido:
+            return func.HttpResponse(
+                json.dumps({"error": f"Parámetros inválidos: {str(parametro_invalido)}"}),
+                status_code=400,
+                mimetype="application/json"
+            )
+        
         documentos = []
+        inicio_ventana, fin_ventana = cache_http.ventana_sas()
+        for registro in registros:
+            # Generar URL pre-firmada solo para los documentos de la página (1 hora de expiración)
+            try:
+                url_presignada = generar_url_presignada(
+                    registro["blob_name"], expiracion_minutos=60, fin_ventana=fin_ventana
+                )
+            except Exception:
+                # Si falla la generación de SAS, usar URL pública (sin garantía de acceso)
+                url_presignada = f"https://{blob_service_client.account_name}.blob.core.windows.net/{BLOB_CONTAINER_NAME}/{registro['blob_name']}"
+            
+            documentos.append({
+                "filename": registro.get("filename"),
+                "full_blob_name": registro["blob_name"],
+                "url_presignada": url_presignada,
+                "expira_en_horas": 1,
+                "size_bytes": registro.get("size_bytes"),
+                "last_modified": registro.get("creado"),
+                "document_id": registro["document_id"],
+                "empresa": registro.get("empresa"),
+                "titulo": registro.get("titulo"),
+                "fecha": registro.get("fecha"),
+                "plantilla": registro.get("plantilla"),
+                "tiempos": registro.get("tiempos"),
+                "tokens": registro.get("tokens")
+            })
         
-        for blob in blobs:
-            if blob.name.endswith('.docx'):
-                # Extraer información del nombre del archivo (sin el prefijo propuestas/)
-                filename_without_prefix = blob.name.replace(PROPUESTAS_FOLDER, "")
-                parts = filename_without_prefix.replace('.docx', '').split('_')
-                
-                # Generar URL pre-firmada para cada documento (1 hora de expiración)
-                try:
-                    url_presignada = generar_url_presignada(blob.name, expiracion_minutos=60)
-                except Exception:
-                    # Si falla la generación de SAS, usar URL pública (sin garantía de acceso)
-                    url_presignada = f"https://{blob_service_client.account_name}.blob.core.windows.net/{BLOB_CONTAINER_NAME}/{blob.name}"
-                
-                documento_info = {
-                    "filename": filename_without_prefix,
-                    "full_blob_name": blob.name,
-                    "url_presignada": url_presignada,
-                    "expira_en_horas": 1,
-                    "size_bytes": blob.size,
-                    "last_modified": blob.last_modified.isoformat() if blob.last_modified else None,
-                    "document_id": parts[2] if len(parts) >= 3 else "unknown",
-                    "timestamp": parts[3] if len(parts) >= 4 else "unknown"
-                }
-                
-                documentos.append(documento_info)
+        respuesta = {
+            "message": "Listado de propuestas",
+            "total_documentos": total,
+            "pagina": pagina,
+            "limite": limite,
+            "documentos": documentos
+        }
+        if reindexados is not None:
+            respuesta["reindexados"] = reindexados
         
-        # Ordenar por fecha de modificación (más reciente primero)
-        documentos.sort(key=lambda x: x['last_modified'] or '', reverse=True)
+        # El ETag cambia si cambian los documentos de la página o empieza otra ventana de firma
+        fechas = [f for f in (cache_http.parsear_fecha(r.get("creado")) for r in registros) if f]
+        entrada_cache = cache_http.guardar(
+            clave_cache,
+            json.dumps(respuesta),
+            cache_http.calcular_etag(
+                total,
+                [(r["document_id"], r.get("etag") or r.get("creado")) for r in registros],
+                parametros_consulta,
+                inicio_ventana
+            ),
+            max(fechas + [inicio_ventana]),
+            min(cache_http.RESPUESTAS_CACHE_TTL, cache_http.segundos_restantes(fin_ventana))
+        )
+        return cache_http.responder(req, entrada_cache)
         
+    except Exception as e:
         return func.HttpResponse(
             json.dumps({
-                "message": "Listado de propuestas",
-                "total_documentos": len(documentos),
-                "documentos": documentos
+                "error": f"Error listando propuestas: {str(e)}",
+                "traceback": traceback.format_exc()
+            }),
+            status_code=500,
+            mimetype="application/json"
+        )
+
+@app.function_name(name="metricas")
+@app.route(route="metricas", methods=["GET"], auth_level=func.AuthLevel.ANONYMOUS)
+def obtener_metricas(req: func.HttpRequest) -> func.HttpResponse:
+    """Endpoint GET con las métricas del proceso (deduplicación, tiempos, salud de Azure OpenAI, etc.)"""
+    return func.HttpResponse(
+        json.dumps(dict(
+            metricas.instantanea(),
+            openai=enrutador_openai.estado_pool(),
+            cache_semantico=cache_semantico.estado(),
+            admision=admision.estado(),
+            rutas=rutas_secciones.estado()
+        )),
+        status_code=200,
+        mimetype="application/json"
+    )
+
+@app.function_name(name="listar_plantillas")
+@app.route(route="listar_plantillas", methods=["GET"], auth_level=func.AuthLevel.ANONYMOUS)
+def listar_plantillas_disponibles(req: func.HttpRequest) -> func.HttpResponse:
+    """Endpoint GET para listar las plantillas disponibles bajo plantilla/"""
+    try:
+        container_client = get_blob_service_client().get_container_client(TEMPLATE_CONTAINER_NAME)
+        plantillas = listar_plantillas(container_client, forzar=req.params.get('refrescar') == 'true')
+        
+        return func.HttpResponse(
+            json.dumps({
+                "message": "Listado de plantillas",
+                "total_plantillas": len(plantillas),
+                "plantillas": [
+                    {"nombre": nombre, "etag": info["etag"], "size_bytes": info["size"]}
+                    for nombre, info in sorted(plantillas.items())
+                ]
             }),
             status_code=200,
             mimetype="application/json"
@@ -800,9 +1829,9 @@ def listar_propuestas(req: func.HttpRequest) -> func.HttpResponse:
     except Exception as e:
         return func.HttpResponse(
             json.dumps({
-                "error": f"Error listando propuestas: {str(e)}",
+                "error": f"Error listando plantillas: {str(e)}",
                 "traceback": traceback.format_exc()
             }),
             status_code=500,
             mimetype="application/json"
-        )
\ No newline at end of file
+        )
@@ -0,0 +1,172 @@
+import os
+import math
+import time
+import asyncio
+import threading
+import contextlib
+import logging
+from collections import deque
+
+from propia import metricas
+
+# Propuestas que genera a la vez cada worker (0 = sin límite); las demás esperan su turno en cola
+ADMISION_MAX_EN_CURSO = int(os.getenv("ADMISION_MAX_EN_CURSO", "8"))
+# Solicitudes en espera antes de rechazar de inmediato con 429
+ADMISION_MAX_COLA = int(os.getenv("ADMISION_MAX_COLA", "16"))
+# Segundos que una solicitud espera turno antes de rechazarse con 503
+ADMISION_ESPERA_SEGUNDOS = float(os.getenv("ADMISION_ESPERA_SEGUNDOS", "15"))
+# Peso de la última duración en el promedio móvil con que se estima Retry-After
+DURACION_ALFA = 0.2
+DURACION_INICIAL_SEGUNDOS = 30.0
+
+_lock = threading.Lock()
+_estado = {"en_curso": 0, "duracion_s": DURACION_INICIAL_SEGUNDOS}
+# Turnos en espera, en orden de llegada: {"concedido", "avisar"}
+_cola = deque()
+
+
+class CapacidadAgotada(Exception):
+    """El worker no tiene capacidad para otra propuesta (429 con la cola llena, 503 al agotar la espera)"""
+
+    def __init__(self, mensaje, codigo, reintentar_en):
+        super().__init__(mensaje)
+        self.codigo = codigo
+        self.reintentar_en = reintentar_en
+
+
+# ========== ESTADO ==========
+
+def _publicar():
+    """Publica la ocupación en las métricas (se llama con _lock tomado)"""
+    metricas.fijar("admision.en_curso", _estado["en_curso"])
+    metricas.fijar("admision.en_cola", len(_cola))
+
+def _reintentar_en():
+    """Segundos estimados hasta que se libere un lugar para una solicitud nueva (se llama con _lock tomado)"""
+    rondas = (len(_cola) + 1) / max(1, ADMISION_MAX_EN_CURSO)
+    return max(1, math.ceil(_estado["duracion_s"] * rondas))
+
+def estado():
+    """Ocupación actual para GET /api/metricas"""
+    with _lock:
+        return {
+            "en_curso": _estado["en_curso"],
+            "en_cola": len(_cola),
+            "max_en_curso": ADMISION_MAX_EN_CURSO,
+            "max_cola": ADMISION_MAX_COLA,
+            "duracion_promedio_s": round(_estado["duracion_s"], 2),
+            "reintentar_en_s": _reintentar_en()
+        }
+
+# ========== TURNOS ==========
+
+def _reservar(avisar):
+    """
+    Ocupa un lugar o se forma en la cola.
+
+    :param avisar: Función sin argumentos que despierta al solicitante cuando se le concede el turno.
+    :return: None si quedó admitido, o el turno en cola.
+    :raises CapacidadAgotada: 429 si la cola está llena.
+    """
+    with _lock:
+        if ADMISION_MAX_EN_CURSO <= 0 or (_estado["en_curso"] < ADMISION_MAX_EN_CURSO and not _cola):
+            _estado["en_curso"] += 1
+            _publicar()
+            metricas.incrementar("admision.admitidas")
+            return None
+        if len(_cola) >= ADMISION_MAX_COLA:
+            reintentar_en = _reintentar_en()
+            metricas.incrementar("admision.rechazadas_cola_llena")
+            raise CapacidadAgotada(
+                f"Capacidad agotada: {_estado['en_curso']} propuestas en curso y {len(_cola)} en espera",
+                429, reintentar_en
+            )
+        turno = {"concedido": False, "avisar": avisar}
+        _cola.append(turno)
+        _publicar()
+        return turno
+
+def _abandonar(turno):
+    """Sale de la cola al agotar la espera; regresa False si el turno se concedió justo antes"""
+    with _lock:
+        if turno["concedido"]:
+            return False
+        _cola.remove(turno)
+        _publicar()
+        return True
+
+def _liberar(duracion_s):
+    """Cede el lugar al primero de la cola o lo libera"""
+    with _lock:
+        _estado["duracion_s"] = DURACION_ALFA * duracion_s + (1 - DURACION_ALFA) * _estado["duracion_s"]
+        if _cola:
+            turno = _cola.popleft()
+            turno["concedido"] = True
+            turno["avisar"]()
+        else:
+            _estado["en_curso"] -= 1
+        _publicar()
+
+def _rechazo_por_espera(espera_inicio):
+    metricas.incrementar("admision.rechazadas_espera")
+    with _lock:
+        reintentar_en = _reintentar_en()
+    logging.warning(f"Solicitud rechazada tras esperar {ADMISION_ESPERA_SEGUNDOS} s un lugar libre")
+    return CapacidadAgotada(
+        f"Capacidad agotada: sin lugar libre después de {round(time.monotonic() - espera_inicio, 1)} s en cola",
+        503, reintentar_en
+    )
+
+def _admitido(espera_inicio, en_cola):
+    if en_cola:
+        metricas.incrementar("admision.admitidas")
+    metricas.observar("admision.espera_ms", round((time.monotonic() - espera_inicio) * 1000, 1))
+    return time.monotonic()
+
+@contextlib.contextmanager
+def admitir():
+    """
+    Ejecuta el bloque solo si hay lugar en el worker, esperando hasta ADMISION_ESPERA_SEGUNDOS.
+
+    :raises CapacidadAgotada: Con el código HTTP (429/503) y los segundos para Retry-After.
+    """
+    espera_inicio = time.monotonic()
+    evento = threading.Event()
+    turno = _reservar(evento.set)
+    if turno is not None and not evento.wait(ADMISION_ESPERA_SEGUNDOS) and _abandonar(turno):
+        raise _rechazo_por_espera(espera_inicio)
+
+    inicio = _admitido(espera_inicio, turno is not None)
+    try:
+        yield
+    finally:
+        _liberar(time.monotonic() - inicio)
+
+def _resolver(futuro):
+    if not futuro.done():
+        futuro.set_result(True)
+
+@contextlib.asynccontextmanager
+async def admitir_async():
+    """Versión asíncrona de admitir: la espera en cola no ocupa un hilo. Comparte los lugares con admitir"""
+    espera_inicio = time.monotonic()
+    loop = asyncio.get_running_loop()
+    futuro = loop.create_future()
+    turno = _reservar(lambda: loop.call_soon_threadsafe(_resolver, futuro))
+    if turno is not None:
+        try:
+            await asyncio.wait_for(asyncio.shield(futuro), ADMISION_ESPERA_SEGUNDOS)
+        except asyncio.TimeoutError:
+            if _abandonar(turno):
+                raise _rechazo_por_espera(espera_inicio)
+        except BaseException:
+            # Solicitud cancelada mientras esperaba: si el turno ya se concedió, se cede al siguiente
+            if not _abandonar(turno):
+                _liberar(0.0)
+            raise
+
+    inicio = _admitido(espera_inicio, turno is not None)
+    try:
+        yield
+    finally:
+        _liberar(time.monotonic() - inicio)
@@ -0,0 +1,137 @@
+import os
+import sys
+import time
+import threading
+import tempfile
+import logging
+from azure.storage.blob import BlobServiceClient
+
+from propia import metricas
+
+# Configuración de transferencias por bloques
+BLOB_TAMANO_BLOQUE = int(os.getenv("BLOB_TAMANO_BLOQUE", str(4 * 1024 * 1024)))
+BLOB_MAX_PUT_UNICO = int(os.getenv("BLOB_MAX_PUT_UNICO", str(4 * 1024 * 1024)))
+BLOB_MAX_CONCURRENCIA = int(os.getenv("BLOB_MAX_CONCURRENCIA", "4"))
+# A partir de este tamaño los documentos se guardan en disco y no en memoria
+BLOB_UMBRAL_MEMORIA = int(os.getenv("BLOB_UMBRAL_MEMORIA", str(8 * 1024 * 1024)))
+
+_lock = threading.Lock()
+_clientes = {}
+
+# ========== CLIENTE ==========
+
+def crear_cliente_servicio(connection_string):
+    """Regresa un BlobServiceClient reutilizable configurado para transferencias por bloques"""
+    if not connection_string:
+        raise Exception("Storage connection string no configurado")
+
+    with _lock:
+        cliente = _clientes.get(connection_string)
+        if cliente is None:
+            cliente = BlobServiceClient.from_connection_string(
+                connection_string,
+                max_block_size=BLOB_TAMANO_BLOQUE,
+                max_single_put_size=BLOB_MAX_PUT_UNICO,
+                max_chunk_get_size=BLOB_TAMANO_BLOQUE,
+                max_single_get_size=BLOB_TAMANO_BLOQUE
+            )
+            _clientes[connection_string] = cliente
+        return cliente
+
+# ========== STREAMS ==========
+
+def crear_stream_temporal():
+    """Stream en memoria que se desborda a disco al superar BLOB_UMBRAL_MEMORIA"""
+    return tempfile.SpooledTemporaryFile(max_size=BLOB_UMBRAL_MEMORIA)
+
+def tamano_stream(stream):
+    """Regresa el tamaño en bytes de un stream con seek"""
+    posicion = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    tamano = stream.tell()
+    stream.seek(posicion)
+    return tamano
+
+def memoria_pico_mb():
+    """
+    Memoria residente máxima del proceso en MB desde que arrancó (None si la plataforma no la
+    expone). Es el pico del worker, no el de una solicitud: no baja entre solicitudes.
+    """
+    try:
+        import resource
+        pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reporta KB, macOS reporta bytes
+        return round(pico / (1024 * 1024) if sys.platform == "darwin" else pico / 1024, 1)
+    except Exception:
+        return None
+
+# ========== TRANSFERENCIAS ==========
+
+def descargar_a_stream(blob_client):
+    """Descarga un blob por bloques directamente a un stream temporal, sin copias intermedias"""
+    inicio = time.perf_counter()
+    stream = crear_stream_temporal()
+
+    descarga = blob_client.download_blob(max_concurrency=BLOB_MAX_CONCURRENCIA)
+    bytes_leidos = descarga.readinto(stream)
+    stream.seek(0)
+
+    duracion_ms = round((time.perf_counter() - inicio) * 1000, 1)
+    metricas.observar("blob.descarga_ms", duracion_ms)
+    metricas.observar("blob.descarga_bytes", bytes_leidos)
+    metricas.fijar("proceso.memoria_pico_mb", memoria_pico_mb())
+    logging.info(f"Blob descargado: {blob_client.blob_name} ({bytes_leidos} bytes en {duracion_ms} ms)")
+
+    return stream
+
+def subir_desde_stream(blob_client, stream):
+    """
+    Sube un stream en bloques paralelos.
+
+    :return: Diccionario con bytes subidos, tiempo de subida y memoria pico del proceso (desde que arrancó).
+    """
+    inicio = time.perf_counter()
+    longitud = tamano_stream(stream)
+    stream.seek(0)
+
+    propiedades = blob_client.upload_blob(
+        stream,
+        length=longitud,
+        overwrite=True,
+        max_concurrency=BLOB_MAX_CONCURRENCIA
+    )
+
+    return _resumen_subida(blob_client, longitud, inicio, propiedades)
+
+def _resumen_subida(blob_client, longitud, inicio, propiedades):
+    duracion_ms = round((time.perf_counter() - inicio) * 1000, 1)
+    pico_mb = memoria_pico_mb()
+    metricas.observar("blob.subida_ms", duracion_ms)
+    metricas.observar("blob.subida_bytes", longitud)
+    metricas.fijar("proceso.memoria_pico_mb", pico_mb)
+    logging.info(f"Blob subido: {blob_client.blob_name} ({longitud} bytes en {duracion_ms} ms, pico del proceso {pico_mb} MB)")
+
+    propiedades = propiedades or {}
+    last_modified = propiedades.get("last_modified")
+    return {
+        "etag": propiedades.get("etag"),
+        "last_modified": last_modified.isoformat() if last_modified else None,
+        "bytes": longitud,
+        "tiempo_subida_ms": duracion_ms,
+        "memoria_pico_proceso_mb": pico_mb
+    }
+
+async def subir_desde_stream_async(blob_client, stream):
+    """Versión de subir_desde_stream para un BlobClient de azure.storage.blob.aio"""
+    inicio = time.perf_counter()
+    longitud = tamano_stream(stream)
+    stream.seek(0)
+
+    propiedades = await blob_client.upload_blob(
+        stream,
+        length=longitud,
+        overwrite=True,
+        max_concurrency=BLOB_MAX_CONCURRENCIA
+    )
+
+    return _resumen_subida(blob_client, longitud, inicio, propiedades)
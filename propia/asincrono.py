@@ -0,0 +1,71 @@
+import os
+import asyncio
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from azure.storage.blob.aio import BlobServiceClient as BlobServiceClientAsync
+
+# Hilos para el trabajo de CPU de los handlers asíncronos (python-docx, XML, SQLite del manifiesto)
+ASYNC_HILOS_CPU = int(os.getenv("ASYNC_HILOS_CPU", "4"))
+# Hilos para el I/O bloqueante sin versión asíncrona (síntesis de prompts largos, descarga de
+# plantillas, subida de perfiles): esperan red por minutos y no deben ocupar los hilos de CPU
+ASYNC_HILOS_IO = int(os.getenv("ASYNC_HILOS_IO", "16"))
+# Conexiones HTTP simultáneas de la sesión compartida (Azure OpenAI)
+ASYNC_MAX_CONEXIONES = int(os.getenv("ASYNC_MAX_CONEXIONES", "100"))
+
+_executor = ThreadPoolExecutor(max_workers=ASYNC_HILOS_CPU, thread_name_prefix="cpu")
+_executor_io = ThreadPoolExecutor(max_workers=ASYNC_HILOS_IO, thread_name_prefix="io")
+# Los clientes asíncronos quedan ligados al event loop en que se crearon
+_sesiones = {}
+_servicios_blob = {}
+
+# ========== EJECUCIÓN ==========
+
+async def _ejecutar(executor, funcion, *args, **kwargs):
+    contexto = contextvars.copy_context()
+    llamada = functools.partial(contexto.run, funcion, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(executor, llamada)
+
+async def en_executor(funcion, *args, **kwargs):
+    """
+    Ejecuta una función síncrona de CPU en el pool de ASYNC_HILOS_CPU hilos, con una copia del
+    contexto de la solicitud (tokens, perfilado).
+    """
+    return await _ejecutar(_executor, funcion, *args, **kwargs)
+
+async def en_executor_io(funcion, *args, **kwargs):
+    """Igual que en_executor, para I/O bloqueante: usa el pool de ASYNC_HILOS_IO hilos"""
+    return await _ejecutar(_executor_io, funcion, *args, **kwargs)
+
+# ========== CLIENTES ==========
+
+def sesion_http():
+    """Sesión aiohttp compartida por todas las solicitudes del event loop actual"""
+    loop = asyncio.get_running_loop()
+    sesion = _sesiones.get(loop)
+    if sesion is None or sesion.closed:
+        sesion = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=ASYNC_MAX_CONEXIONES))
+        _sesiones[loop] = sesion
+    return sesion
+
+def servicio_blob(connection_string):
+    """BlobServiceClient de azure.storage.blob.aio compartido en el event loop actual"""
+    if not connection_string:
+        raise Exception("Storage connection string no configurado")
+    clave = (asyncio.get_running_loop(), connection_string)
+    servicio = _servicios_blob.get(clave)
+    if servicio is None:
+        servicio = BlobServiceClientAsync.from_connection_string(connection_string)
+        _servicios_blob[clave] = servicio
+    return servicio
+
+async def cerrar():
+    """Cierra los clientes del event loop actual (al terminar un benchmark o una prueba)"""
+    loop = asyncio.get_running_loop()
+    sesion = _sesiones.pop(loop, None)
+    if sesion is not None:
+        await sesion.close()
+    for clave in [clave for clave in _servicios_blob if clave[0] is loop]:
+        await _servicios_blob.pop(clave).close()
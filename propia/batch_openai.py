@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import logging
+import requests
+
+from propia import metricas
+
+# Modo offline: las secciones de muchas propuestas se envían como un trabajo de la Batch API de
+# Azure OpenAI, con su propia cuota, en lugar de competir por los TPM del tráfico en línea.
+# El despliegue debe ser de tipo Global Batch; por defecto se usa el endpoint y el despliegue en línea
+AZURE_OPENAI_BATCH_ENDPOINT = os.getenv("AZURE_OPENAI_BATCH_ENDPOINT")
+AZURE_OPENAI_BATCH_DEPLOYMENT = os.getenv("AZURE_OPENAI_BATCH_DEPLOYMENT")
+BATCH_API_VERSION = os.getenv("BATCH_API_VERSION", "2024-10-21")
+BATCH_VENTANA = os.getenv("BATCH_VENTANA", "24h")
+# Segundos entre consultas del estado del trabajo
+BATCH_INTERVALO_SONDEO = float(os.getenv("BATCH_INTERVALO_SONDEO", "60"))
+BATCH_TIMEOUT_SEGUNDOS = float(os.getenv("BATCH_TIMEOUT_SEGUNDOS", "120"))
+
+# Precios en USD por millón de tokens del despliegue en línea (solo para reportar el costo);
+# la Batch API cobra BATCH_FACTOR_COSTO de ese precio
+PRECIO_PROMPT_MTOK = float(os.getenv("OPENAI_PRECIO_PROMPT_MTOK", "0.15"))
+PRECIO_COMPLETION_MTOK = float(os.getenv("OPENAI_PRECIO_COMPLETION_MTOK", "0.60"))
+BATCH_FACTOR_COSTO = float(os.getenv("BATCH_FACTOR_COSTO", "0.5"))
+
+ESTADOS_FINALES = {"completed", "failed", "expired", "cancelled"}
+
+
+class ErrorBatch(Exception):
+    """El trabajo batch no se pudo crear o terminó sin resultados"""
+
+
+# ========== CONFIGURACIÓN ==========
+
+def configuracion(endpoint, deployment, api_key):
+    """Endpoint y despliegue del modo batch (AZURE_OPENAI_BATCH_* o los del modo en línea)"""
+    return {
+        "endpoint": (AZURE_OPENAI_BATCH_ENDPOINT or endpoint).rstrip("/") + "/",
+        "deployment": AZURE_OPENAI_BATCH_DEPLOYMENT or deployment,
+        "api_key": api_key,
+        "api_version": BATCH_API_VERSION
+    }
+
+def _url(config, ruta):
+    return f"{config['endpoint']}openai/{ruta}?api-version={config['api_version']}"
+
+def _verificar(response, operacion):
+    if response.status_code >= 400:
+        raise ErrorBatch(f"Error en {operacion} ({response.status_code}): {response.text[:500]}")
+    return response
+
+# ========== ARCHIVO DE ENTRADA ==========
+
+def construir_jsonl(config, solicitudes):
+    """
+    Archivo de entrada del trabajo: una chat completion por línea.
+
+    :param solicitudes: Lista de (custom_id, messages, max_tokens); custom_id debe ser único.
+    """
+    lineas = [
+        json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/chat/completions",
+            "body": {"model": config["deployment"], "messages": messages, "max_tokens": max_tokens}
+        }, ensure_ascii=False)
+        for custom_id, messages, max_tokens in solicitudes
+    ]
+    return ("\n".join(lineas) + "\n").encode("utf-8")
+
+# ========== TRABAJOS ==========
+
+def enviar(config, solicitudes):
+    """
+    Sube el archivo de entrada y crea el trabajo batch.
+
+    :return: Trabajo tal como lo regresa la API ("id", "status", "input_file_id", ...).
+    """
+    contenido = construir_jsonl(config, solicitudes)
+    headers = {"api-key": config["api_key"]}
+
+    archivo = _verificar(requests.post(
+        _url(config, "files"),
+        headers=headers,
+        data={"purpose": "batch"},
+        files={"file": ("secciones.jsonl", contenido, "application/jsonl")},
+        timeout=BATCH_TIMEOUT_SEGUNDOS
+    ), "la subida del archivo").json()
+
+    trabajo = _verificar(requests.post(
+        _url(config, "batches"),
+        headers=headers,
+        json={"input_file_id": archivo["id"], "endpoint": "/chat/completions", "completion_window": BATCH_VENTANA},
+        timeout=BATCH_TIMEOUT_SEGUNDOS
+    ), "la creación del trabajo").json()
+
+    metricas.incrementar("batch.trabajos")
+    metricas.incrementar("batch.solicitudes", len(solicitudes))
+    logging.info(f"Trabajo batch {trabajo['id']} creado: {len(solicitudes)} solicitudes ({len(contenido)} bytes)")
+    return trabajo
+
+def consultar(config, batch_id):
+    return _verificar(requests.get(
+        _url(config, f"batches/{batch_id}"), headers={"api-key": config["api_key"]}, timeout=BATCH_TIMEOUT_SEGUNDOS
+    ), "la consulta del trabajo").json()
+
+def esperar(config, batch_id, intervalo=None, limite_segundos=None, al_sondear=None):
+    """
+    Consulta el trabajo hasta que llega a un estado final.
+
+    :param al_sondear: Función opcional (trabajo) llamada en cada consulta, p. ej. para reportar avance.
+    :return: Trabajo en estado final.
+    :raises ErrorBatch: Si se alcanza `limite_segundos` antes de terminar.
+    """
+    inicio = time.monotonic()
+    while True:
+        trabajo = consultar(config, batch_id)
+        if al_sondear:
+            al_sondear(trabajo)
+        if trabajo["status"] in ESTADOS_FINALES:
+            return trabajo
+        if limite_segundos is not None and time.monotonic() - inicio > limite_segundos:
+            raise ErrorBatch(f"El trabajo {batch_id} sigue en {trabajo['status']} después de {limite_segundos} s")
+        time.sleep(BATCH_INTERVALO_SONDEO if intervalo is None else intervalo)
+
+def _descargar(config, file_id):
+    return _verificar(requests.get(
+        _url(config, f"files/{file_id}/content"), headers={"api-key": config["api_key"]}, timeout=BATCH_TIMEOUT_SEGUNDOS
+    ), "la descarga de resultados").content
+
+def resultados(config, trabajo):
+    """
+    Resultados de un trabajo terminado, por custom_id.
+
+    :return: {custom_id: {"contenido", "usage"}} para las exitosas y {custom_id: {"error"}} para las fallidas.
+    :raises ErrorBatch: Si el trabajo no terminó con estado completed.
+    """
+    if trabajo["status"] != "completed":
+        raise ErrorBatch(f"El trabajo {trabajo['id']} terminó en {trabajo['status']}: {trabajo.get('errors')}")
+
+    salida = {}
+    for file_id in (trabajo.get("output_file_id"), trabajo.get("error_file_id")):
+        if not file_id:
+            continue
+        for linea in _descargar(config, file_id).decode("utf-8").splitlines():
+            if not linea.strip():
+                continue
+            registro = json.loads(linea)
+            respuesta = registro.get("response") or {}
+            cuerpo = respuesta.get("body") or {}
+            if respuesta.get("status_code") == 200 and cuerpo.get("choices"):
+                salida[registro["custom_id"]] = {
+                    "contenido": (cuerpo["choices"][0]["message"].get("content") or "").strip(),
+                    "usage": cuerpo.get("usage")
+                }
+            else:
+                salida[registro["custom_id"]] = {"error": registro.get("error") or cuerpo.get("error") or respuesta}
+
+    fallidas = sum(1 for r in salida.values() if "error" in r)
+    metricas.incrementar("batch.respuestas", len(salida) - fallidas)
+    metricas.incrementar("batch.fallidas", fallidas)
+    return salida
+
+# ========== COSTO ==========
+
+def sumar_uso(usos):
+    """Suma bloques `usage` con el formato del resumen de consumo"""
+    total = {"llamadas": 0, "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    for usage in usos:
+        if not usage:
+            continue
+        total["llamadas"] += 1
+        total["prompt_tokens"] += usage.get("prompt_tokens") or 0
+        total["completion_tokens"] += usage.get("completion_tokens") or 0
+        total["total_tokens"] += usage.get("total_tokens") or (usage.get("prompt_tokens") or 0) + (usage.get("completion_tokens") or 0)
+    return total
+
+def costo(tokens, factor=1.0):
+    """Costo estimado en USD de un resumen de tokens (factor=BATCH_FACTOR_COSTO para el modo batch)"""
+    usd = (
+        (tokens.get("prompt_tokens") or 0) * PRECIO_PROMPT_MTOK
+        + (tokens.get("completion_tokens") or 0) * PRECIO_COMPLETION_MTOK
+    ) / 1_000_000
+    return round(usd * factor, 6)
@@ -0,0 +1,132 @@
+import os
+import json
+import time
+import math
+import hashlib
+import threading
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+import azure.functions as func
+
+from propia import metricas
+
+# Segundos que una respuesta de lectura se sirve desde memoria sin consultar Storage
+RESPUESTAS_CACHE_TTL = int(os.getenv("RESPUESTAS_CACHE_TTL", "15"))
+RESPUESTAS_CACHE_MAX = int(os.getenv("RESPUESTAS_CACHE_MAX", "1000"))
+# Las URLs SAS se firman por ventanas: dentro de una ventana la URL (y el ETag) no cambian
+SAS_VENTANA_MINUTOS = int(os.getenv("SAS_VENTANA_MINUTOS", "10"))
+
+_lock = threading.Lock()
+# clave -> {"cuerpo", "etag", "last_modified", "max_age_hasta", "expira"}
+_respuestas = {}
+
+# ========== VENTANAS DE FIRMA ==========
+
+def ventana_sas():
+    """Regresa (inicio, fin) en UTC de la ventana de firma actual"""
+    duracion = SAS_VENTANA_MINUTOS * 60
+    inicio = math.floor(time.time() / duracion) * duracion
+    return (
+        datetime.fromtimestamp(inicio, tz=timezone.utc),
+        datetime.fromtimestamp(inicio + duracion, tz=timezone.utc)
+    )
+
+def segundos_restantes(fin):
+    """Segundos que faltan para un instante UTC (mínimo 0)"""
+    return max(0, int((fin - datetime.now(timezone.utc)).total_seconds()))
+
+# ========== VALIDADORES ==========
+
+def calcular_etag(*partes):
+    """ETag débil a partir de los valores que determinan el contenido de la respuesta"""
+    contenido = json.dumps(partes, sort_keys=True, default=str, ensure_ascii=False)
+    return 'W/"' + hashlib.sha1(contenido.encode('utf-8')).hexdigest()[:24] + '"'
+
+def parsear_fecha(valor):
+    """Convierte una fecha ISO o HTTP en datetime UTC (None si no se puede)"""
+    if not valor:
+        return None
+    if isinstance(valor, datetime):
+        fecha = valor
+    else:
+        try:
+            fecha = datetime.fromisoformat(valor)
+        except ValueError:
+            try:
+                fecha = parsedate_to_datetime(valor)
+            except (TypeError, ValueError):
+                return None
+    return fecha if fecha.tzinfo else fecha.replace(tzinfo=timezone.utc)
+
+def no_modificado(req, etag, last_modified):
+    """Evalúa If-None-Match (prioritario) e If-Modified-Since contra los validadores actuales"""
+    if_none_match = req.headers.get('If-None-Match')
+    if if_none_match:
+        etiquetas = [e.strip() for e in if_none_match.split(',')]
+        # Comparación débil: W/"x" equivale a "x"
+        normalizar = lambda e: e[2:] if e.startswith('W/') else e
+        return '*' in etiquetas or normalizar(etag) in [normalizar(e) for e in etiquetas]
+
+    if_modified_since = parsear_fecha(req.headers.get('If-Modified-Since'))
+    if if_modified_since and last_modified:
+        return last_modified.replace(microsecond=0) <= if_modified_since
+    return False
+
+# ========== CACHE EN PROCESO ==========
+
+def obtener(clave):
+    """Regresa la respuesta cacheada vigente para la clave, o None"""
+    with _lock:
+        entrada = _respuestas.get(clave)
+        if entrada and entrada["expira"] > time.monotonic():
+            metricas.incrementar("cache_http.aciertos")
+            return entrada
+        _respuestas.pop(clave, None)
+    metricas.incrementar("cache_http.fallos")
+    return None
+
+def guardar(clave, cuerpo, etag, last_modified, max_age):
+    """Guarda una respuesta por RESPUESTAS_CACHE_TTL, sin exceder su max-age"""
+    entrada = {
+        "cuerpo": cuerpo,
+        "etag": etag,
+        "last_modified": last_modified,
+        "max_age_hasta": time.monotonic() + max_age,
+        "expira": time.monotonic() + min(RESPUESTAS_CACHE_TTL, max_age)
+    }
+    with _lock:
+        if len(_respuestas) >= RESPUESTAS_CACHE_MAX:
+            ahora = time.monotonic()
+            for vencida in [c for c, e in _respuestas.items() if e["expira"] <= ahora] or list(_respuestas)[:1]:
+                del _respuestas[vencida]
+        _respuestas[clave] = entrada
+    return entrada
+
+def invalidar(prefijo):
+    """Descarta las respuestas cacheadas cuya clave empieza con el prefijo"""
+    with _lock:
+        for clave in [c for c in _respuestas if c.startswith(prefijo)]:
+            del _respuestas[clave]
+
+# ========== RESPUESTAS ==========
+
+def responder(req, entrada):
+    """Construye la respuesta 200 o 304 con ETag, Last-Modified y Cache-Control"""
+    max_age = max(0, int(entrada["max_age_hasta"] - time.monotonic()))
+    headers = {
+        "ETag": entrada["etag"],
+        "Cache-Control": f"private, max-age={max_age}, must-revalidate"
+    }
+    if entrada["last_modified"]:
+        headers["Last-Modified"] = format_datetime(entrada["last_modified"].astimezone(timezone.utc), usegmt=True)
+
+    if no_modificado(req, entrada["etag"], entrada["last_modified"]):
+        metricas.incrementar("cache_http.no_modificado")
+        return func.HttpResponse(status_code=304, headers=headers)
+
+    return func.HttpResponse(
+        entrada["cuerpo"],
+        status_code=200,
+        mimetype="application/json",
+        headers=headers
+    )
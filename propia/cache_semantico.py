@@ -0,0 +1,268 @@
+import os
+import re
+import math
+import time
+import difflib
+import hashlib
+import logging
+import operator
+import threading
+from collections import OrderedDict
+
+from propia import metricas, consumo, enrutador_openai
+from propia.consumo import PresupuestoExcedido
+from propia.plazos import PlazoAgotado
+
+# Cache semántica de secciones: reutiliza la respuesta de una solicitud casi idéntica
+# (misma sección, mismo prompt salvo cliente, fechas o montos) en lugar de generarla de nuevo
+CACHE_SEMANTICO_HABILITADO = os.getenv("CACHE_SEMANTICO_HABILITADO", "false").lower() == "true"
+# Similitud coseno mínima entre los embeddings de la entrada nueva y la guardada
+CACHE_SEMANTICO_UMBRAL = float(os.getenv("CACHE_SEMANTICO_UMBRAL", "0.92"))
+CACHE_SEMANTICO_MAX_ENTRADAS = int(os.getenv("CACHE_SEMANTICO_MAX_ENTRADAS", "500"))
+# Límites de la adaptación: cambios puntuales entre ambas entradas y palabras por cambio
+CACHE_SEMANTICO_MAX_CAMBIOS = int(os.getenv("CACHE_SEMANTICO_MAX_CAMBIOS", "12"))
+CACHE_SEMANTICO_MAX_PALABRAS_CAMBIO = int(os.getenv("CACHE_SEMANTICO_MAX_PALABRAS_CAMBIO", "6"))
+# Caracteres de la entrada que se envían al modelo de embeddings
+CACHE_SEMANTICO_MAX_CARACTERES = 24000
+
+PALABRA = re.compile(r"\S+")
+PUNTUACION = ".,;:!?¡¿()[]{}\"'«»"
+
+_lock = threading.Lock()
+# (partición, número) -> {"vector", "entrada", "respuesta", "generacion_ms"}
+_entradas = OrderedDict()
+_contador = 0
+
+# ========== EMBEDDINGS ==========
+
+def _particion(messages, max_tokens):
+    """Las respuestas solo se comparten entre llamadas con las mismas instrucciones de sistema"""
+    sistema = "\n".join(m.get("content", "") for m in messages if m.get("role") == "system")
+    return hashlib.sha256(f"{max_tokens}\n{sistema}".encode("utf-8")).hexdigest()[:16]
+
+def _entrada(messages):
+    """Texto variable de la llamada (mensajes que no son de sistema)"""
+    return "\n".join(m.get("content", "") for m in messages if m.get("role") != "system")
+
+def _normalizar(vector):
+    norma = math.sqrt(sum(valor * valor for valor in vector)) or 1.0
+    return [valor / norma for valor in vector]
+
+def _embeber(pool, texto):
+    """Embedding normalizado del texto, contabilizado en el consumo de tokens de la solicitud"""
+    texto = texto[:CACHE_SEMANTICO_MAX_CARACTERES]
+    estimado = consumo.reservar([{"role": "user", "content": texto}], 0)
+    usage = None
+    try:
+        vectores, usage = enrutador_openai.embeber(pool, [texto])
+    finally:
+        consumo.registrar_uso(usage, estimado)
+    return _normalizar(vectores[0])
+
+async def _embeber_async(pool, texto):
+    """Versión asíncrona de _embeber"""
+    texto = texto[:CACHE_SEMANTICO_MAX_CARACTERES]
+    estimado = consumo.reservar([{"role": "user", "content": texto}], 0)
+    usage = None
+    try:
+        vectores, usage = await enrutador_openai.embeber_async(pool, [texto])
+    finally:
+        consumo.registrar_uso(usage, estimado)
+    return _normalizar(vectores[0])
+
+def _buscar(particion, vector):
+    """Entrada guardada más parecida de la partición: (similitud, clave, entrada)"""
+    mejor = (-1.0, None, None)
+    with _lock:
+        candidatas = [(clave, entrada) for clave, entrada in _entradas.items() if clave[0] == particion]
+    for clave, entrada in candidatas:
+        if len(entrada["vector"]) != len(vector):
+            continue
+        similitud = sum(map(operator.mul, entrada["vector"], vector))
+        if similitud > mejor[0]:
+            mejor = (similitud, clave, entrada)
+    return mejor
+
+def _guardar(particion, vector, entrada, respuesta, generacion_ms):
+    global _contador
+    with _lock:
+        _contador += 1
+        _entradas[(particion, _contador)] = {
+            "vector": vector,
+            "entrada": entrada,
+            "respuesta": respuesta,
+            "generacion_ms": generacion_ms
+        }
+        while len(_entradas) > CACHE_SEMANTICO_MAX_ENTRADAS:
+            _entradas.popitem(last=False)
+        metricas.fijar("cache_semantico.entradas", len(_entradas))
+
+# ========== ADAPTACIÓN ==========
+
+def adaptar(entrada_anterior, entrada_nueva, respuesta):
+    """
+    Ajusta la respuesta guardada a la entrada nueva sustituyendo los cambios puntuales
+    entre ambas entradas (nombre del cliente, fechas, montos).
+
+    :return: Respuesta adaptada, o None si las entradas difieren en algo más que sustituciones
+             cortas o si un cambio con cifras no aparece tal cual en la respuesta (la respuesta
+             pudo derivar algo de ese dato y no se puede ajustar sin generarla de nuevo).
+    """
+    if entrada_anterior == entrada_nueva:
+        return respuesta
+
+    anteriores = [(m.group(), m.start(), m.end()) for m in PALABRA.finditer(entrada_anterior)]
+    nuevas = [(m.group(), m.start(), m.end()) for m in PALABRA.finditer(entrada_nueva)]
+    comparador = difflib.SequenceMatcher(
+        None, [p for p, _, _ in anteriores], [p for p, _, _ in nuevas], autojunk=False
+    )
+
+    sustituciones = {}
+    for operacion, i1, i2, j1, j2 in comparador.get_opcodes():
+        if operacion == "equal":
+            continue
+        # Texto agregado o eliminado cambia el contenido, no solo un dato
+        if operacion != "replace" or max(i2 - i1, j2 - j1) > CACHE_SEMANTICO_MAX_PALABRAS_CAMBIO:
+            return None
+        anterior = entrada_anterior[anteriores[i1][1]:anteriores[i2 - 1][2]].strip(PUNTUACION)
+        nuevo = entrada_nueva[nuevas[j1][1]:nuevas[j2 - 1][2]].strip(PUNTUACION)
+        if not anterior or anterior == nuevo:
+            continue
+        if sustituciones.get(anterior, nuevo) != nuevo:
+            return None
+        sustituciones[anterior] = nuevo
+
+    if len(sustituciones) > CACHE_SEMANTICO_MAX_CAMBIOS:
+        return None
+
+    # Sustitución en una sola pasada (las más largas primero) y solo en palabras completas
+    patron = re.compile(
+        r"(?<!\w)(" + "|".join(re.escape(a) for a in sorted(sustituciones, key=len, reverse=True)) + r")(?!\w)"
+    ) if sustituciones else None
+    if patron is None:
+        return respuesta
+    encontrados = set(patron.findall(respuesta))
+    if any(re.search(r"\d", anterior) and anterior not in encontrados for anterior in sustituciones):
+        return None
+    return patron.sub(lambda m: sustituciones[m.group(1)], respuesta)
+
+# ========== CONSULTA ==========
+
+def _sin_embedding(error):
+    # Sin embedding la llamada sigue su camino normal
+    logging.warning(f"Cache semántica sin embedding: {type(error).__name__}: {str(error)}")
+    metricas.incrementar("cache_semantico.errores_embedding")
+
+def _resolver(particion, entrada, vector, inicio):
+    """Respuesta guardada (adaptada) para la entrada, o None si hay que generarla; registra las métricas"""
+    similitud, clave, guardada = _buscar(particion, vector)
+    if guardada is not None:
+        metricas.observar("cache_semantico.similitud", round(similitud, 4))
+
+    if guardada is not None and similitud >= CACHE_SEMANTICO_UMBRAL:
+        respuesta = adaptar(guardada["entrada"], entrada, guardada["respuesta"])
+        if respuesta is not None:
+            consulta_ms = round((time.perf_counter() - inicio) * 1000, 1)
+            tipo = "reutilizadas" if guardada["entrada"] == entrada else "adaptadas"
+            with _lock:
+                if clave in _entradas:
+                    _entradas.move_to_end(clave)
+            metricas.incrementar(f"cache_semantico.{tipo}")
+            metricas.observar("cache_semantico.consulta_ms", consulta_ms)
+            metricas.observar("cache_semantico.latencia_ahorrada_ms", round(max(0.0, guardada["generacion_ms"] - consulta_ms), 1))
+            _publicar_tasa()
+            logging.info(f"Cache semántica: respuesta {tipo[:-1]} (similitud {similitud:.4f}, {consulta_ms} ms)")
+            return respuesta
+        metricas.incrementar("cache_semantico.adaptaciones_rechazadas")
+
+    metricas.incrementar("cache_semantico.fallos")
+    metricas.observar("cache_semantico.consulta_ms", round((time.perf_counter() - inicio) * 1000, 1))
+    _publicar_tasa()
+    return None
+
+def completar(pool, messages, max_tokens, generar):
+    """
+    Regresa la respuesta de una llamada casi idéntica ya generada (adaptada a la entrada nueva)
+    o, si no hay una suficientemente parecida, llama a `generar(messages)` y guarda el resultado.
+    """
+    if not CACHE_SEMANTICO_HABILITADO:
+        return generar(messages)
+
+    inicio = time.perf_counter()
+    particion = _particion(messages, max_tokens)
+    entrada = _entrada(messages)
+    metricas.incrementar("cache_semantico.consultas")
+
+    try:
+        vector = _embeber(pool, entrada)
+    except (PresupuestoExcedido, PlazoAgotado):
+        raise
+    except Exception as e:
+        _sin_embedding(e)
+        return generar(messages)
+
+    respuesta = _resolver(particion, entrada, vector, inicio)
+    if respuesta is not None:
+        return respuesta
+
+    inicio_generacion = time.perf_counter()
+    respuesta = generar(messages)
+    if respuesta:
+        _guardar(particion, vector, entrada, respuesta, round((time.perf_counter() - inicio_generacion) * 1000, 1))
+    return respuesta
+
+async def completar_async(pool, messages, max_tokens, generar):
+    """Versión asíncrona de completar; `generar` es una corrutina"""
+    if not CACHE_SEMANTICO_HABILITADO:
+        return await generar(messages)
+
+    inicio = time.perf_counter()
+    particion = _particion(messages, max_tokens)
+    entrada = _entrada(messages)
+    metricas.incrementar("cache_semantico.consultas")
+
+    try:
+        vector = await _embeber_async(pool, entrada)
+    except (PresupuestoExcedido, PlazoAgotado):
+        raise
+    except Exception as e:
+        _sin_embedding(e)
+        return await generar(messages)
+
+    respuesta = _resolver(particion, entrada, vector, inicio)
+    if respuesta is not None:
+        return respuesta
+
+    inicio_generacion = time.perf_counter()
+    respuesta = await generar(messages)
+    if respuesta:
+        _guardar(particion, vector, entrada, respuesta, round((time.perf_counter() - inicio_generacion) * 1000, 1))
+    return respuesta
+
+# ========== REPORTE ==========
+
+def _publicar_tasa():
+    consultas = metricas.leer_contador("cache_semantico.consultas")
+    aciertos = metricas.leer_contador("cache_semantico.reutilizadas") + metricas.leer_contador("cache_semantico.adaptadas")
+    metricas.fijar("cache_semantico.tasa_aciertos", round(aciertos / consultas, 3) if consultas else None)
+
+def estado():
+    """Configuración y efectividad de la cache semántica en este proceso"""
+    with _lock:
+        entradas = len(_entradas)
+    consultas = metricas.leer_contador("cache_semantico.consultas")
+    reutilizadas = metricas.leer_contador("cache_semantico.reutilizadas")
+    adaptadas = metricas.leer_contador("cache_semantico.adaptadas")
+    observaciones = metricas.instantanea()["observaciones"]
+    return {
+        "habilitado": CACHE_SEMANTICO_HABILITADO,
+        "umbral": CACHE_SEMANTICO_UMBRAL,
+        "entradas": entradas,
+        "consultas": consultas,
+        "reutilizadas": reutilizadas,
+        "adaptadas": adaptadas,
+        "adaptaciones_rechazadas": metricas.leer_contador("cache_semantico.adaptaciones_rechazadas"),
+        "tasa_aciertos": round((reutilizadas + adaptadas) / consultas, 3) if consultas else None,
+        "similitud": observaciones.get("cache_semantico.similitud", {"conteo": 0}),
+        "latencia_ahorrada_ms": observaciones.get("cache_semantico.latencia_ahorrada_ms", {"conteo": 0})
+    }
@@ -0,0 +1,209 @@
+import os
+import json
+import threading
+import contextvars
+from datetime import datetime, timezone, timedelta
+
+from propia import metricas
+
+# Presupuestos de tokens (0 = sin límite)
+TOKENS_PRESUPUESTO_SOLICITUD = int(os.getenv("TOKENS_PRESUPUESTO_SOLICITUD", "0"))
+TOKENS_PRESUPUESTO_DIARIO = int(os.getenv("TOKENS_PRESUPUESTO_DIARIO", "0"))
+# Caracteres por token para estimar el prompt antes de enviarlo
+CARACTERES_POR_TOKEN = 4
+
+_lock = threading.Lock()
+# Consumo del día (UTC) en este proceso: {"fecha", "consumidos", "reservados"}
+_diario = {"fecha": None, "consumidos": 0, "reservados": 0}
+
+# Acumulador de la propuesta en curso y sección a la que se atribuyen las llamadas
+_acumulador = contextvars.ContextVar("consumo_acumulador", default=None)
+_etiqueta = contextvars.ContextVar("consumo_etiqueta", default=None)
+
+
+class PresupuestoExcedido(Exception):
+    """La llamada excedería el presupuesto de tokens de la solicitud o del día"""
+
+    def __init__(self, mensaje, alcance, reintentar_en=None):
+        super().__init__(mensaje)
+        self.alcance = alcance
+        self.reintentar_en = reintentar_en
+
+
+# ========== CONTEXTO DE LA SOLICITUD ==========
+
+def iniciar():
+    """
+    Abre el acumulador de tokens de una propuesta en el contexto actual.
+
+    Falla de inmediato si el presupuesto diario ya se agotó, antes de hacer cualquier trabajo.
+    """
+    with _lock:
+        _renovar_dia()
+        if TOKENS_PRESUPUESTO_DIARIO and _diario["consumidos"] >= TOKENS_PRESUPUESTO_DIARIO:
+            _rechazar("diario", f"Presupuesto diario de tokens agotado ({TOKENS_PRESUPUESTO_DIARIO})")
+
+    acumulador = {
+        "lock": threading.Lock(),
+        "llamadas": 0,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "cached_tokens": 0,
+        "total_tokens": 0,
+        "reservados": 0,
+        "secciones": {}
+    }
+    _acumulador.set(acumulador)
+    _etiqueta.set(None)
+    return acumulador
+
+def etiquetar(etiqueta):
+    """Atribuye las llamadas siguientes del contexto actual a una sección"""
+    _etiqueta.set(etiqueta)
+
+def etiqueta_actual():
+    """Sección a la que se atribuyen las llamadas del contexto actual (None fuera de una sección)"""
+    return _etiqueta.get()
+
+def resumen(acumulador=None):
+    """Totales de la propuesta y desglose por sección"""
+    acumulador = acumulador or _acumulador.get()
+    if acumulador is None:
+        return None
+    with acumulador["lock"]:
+        return {
+            "llamadas": acumulador["llamadas"],
+            "prompt_tokens": acumulador["prompt_tokens"],
+            "completion_tokens": acumulador["completion_tokens"],
+            "cached_tokens": acumulador["cached_tokens"],
+            "total_tokens": acumulador["total_tokens"],
+            "por_seccion": {seccion: dict(uso) for seccion, uso in acumulador["secciones"].items()}
+        }
+
+# ========== PRESUPUESTOS ==========
+
+def _renovar_dia():
+    """Reinicia el consumo diario al cambiar la fecha UTC (se llama con _lock tomado)"""
+    hoy = datetime.now(timezone.utc).date()
+    if _diario["fecha"] != hoy:
+        _diario.update({"fecha": hoy, "consumidos": 0, "reservados": 0})
+
+def _segundos_para_manana():
+    ahora = datetime.now(timezone.utc)
+    manana = datetime.combine(ahora.date() + timedelta(days=1), datetime.min.time(), tzinfo=timezone.utc)
+    return int((manana - ahora).total_seconds()) + 1
+
+def _rechazar(alcance, mensaje):
+    metricas.incrementar(f"tokens.presupuesto_excedido.{alcance}")
+    raise PresupuestoExcedido(mensaje, alcance, _segundos_para_manana() if alcance == "diario" else None)
+
+def estimar_tokens(messages, max_tokens):
+    """Estimación conservadora de una llamada: prompt aproximado más el máximo de la respuesta"""
+    caracteres = len(json.dumps(messages, ensure_ascii=False))
+    return caracteres // CARACTERES_POR_TOKEN + max_tokens
+
+def estimar_uso(messages, texto):
+    """Bloque `usage` aproximado para respuestas sin conteo del servicio (p. ej. transmisiones cortadas)"""
+    prompt_tokens = len(json.dumps(messages, ensure_ascii=False)) // CARACTERES_POR_TOKEN
+    completion_tokens = -(-len(texto or "") // CARACTERES_POR_TOKEN)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "estimado": True
+    }
+
+def reservar(messages, max_tokens):
+    """
+    Reserva la estimación de una llamada contra los presupuestos antes de enviarla.
+
+    :return: Tokens reservados; se liberan en registrar_uso.
+    :raises PresupuestoExcedido: Si la llamada no cabe en el presupuesto restante.
+    """
+    estimado = estimar_tokens(messages, max_tokens)
+    acumulador = _acumulador.get()
+
+    if acumulador is not None and TOKENS_PRESUPUESTO_SOLICITUD:
+        with acumulador["lock"]:
+            comprometidos = acumulador["total_tokens"] + acumulador["reservados"]
+            if comprometidos + estimado > TOKENS_PRESUPUESTO_SOLICITUD:
+                _rechazar(
+                    "solicitud",
+                    f"La llamada ({estimado} tokens estimados) excede el presupuesto de la solicitud "
+                    f"({comprometidos}/{TOKENS_PRESUPUESTO_SOLICITUD} comprometidos)"
+                )
+            acumulador["reservados"] += estimado
+
+    with _lock:
+        _renovar_dia()
+        comprometidos = _diario["consumidos"] + _diario["reservados"]
+        if TOKENS_PRESUPUESTO_DIARIO and comprometidos + estimado > TOKENS_PRESUPUESTO_DIARIO:
+            if acumulador is not None and TOKENS_PRESUPUESTO_SOLICITUD:
+                with acumulador["lock"]:
+                    acumulador["reservados"] -= estimado
+            _rechazar(
+                "diario",
+                f"La llamada ({estimado} tokens estimados) excede el presupuesto diario "
+                f"({comprometidos}/{TOKENS_PRESUPUESTO_DIARIO} comprometidos)"
+            )
+        _diario["reservados"] += estimado
+
+    return estimado
+
+# ========== REGISTRO DE CONSUMO ==========
+
+def registrar_uso(usage, estimado=0):
+    """
+    Libera la reserva de una llamada y acumula el bloque `usage` de la respuesta
+    (None si la llamada falló) en la propuesta, la sección, el día y las métricas.
+    """
+    usage = usage or {}
+    prompt_tokens = usage.get("prompt_tokens") or 0
+    completion_tokens = usage.get("completion_tokens") or 0
+    cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+    total_tokens = usage.get("total_tokens") or prompt_tokens + completion_tokens
+
+    with _lock:
+        _renovar_dia()
+        _diario["reservados"] = max(0, _diario["reservados"] - estimado)
+        _diario["consumidos"] += total_tokens
+        consumo_diario = _diario["consumidos"]
+
+    acumulador = _acumulador.get()
+    if acumulador is not None:
+        seccion = _etiqueta.get() or "sin_seccion"
+        with acumulador["lock"]:
+            if TOKENS_PRESUPUESTO_SOLICITUD:
+                acumulador["reservados"] = max(0, acumulador["reservados"] - estimado)
+            if usage:
+                acumulador["llamadas"] += 1
+                acumulador["prompt_tokens"] += prompt_tokens
+                acumulador["completion_tokens"] += completion_tokens
+                acumulador["cached_tokens"] += cached_tokens
+                acumulador["total_tokens"] += total_tokens
+                uso_seccion = acumulador["secciones"].setdefault(
+                    seccion, {"llamadas": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0, "total_tokens": 0}
+                )
+                uso_seccion["llamadas"] += 1
+                uso_seccion["prompt_tokens"] += prompt_tokens
+                uso_seccion["completion_tokens"] += completion_tokens
+                uso_seccion["cached_tokens"] += cached_tokens
+                uso_seccion["total_tokens"] += total_tokens
+
+    if usage:
+        metricas.incrementar("tokens.prompt", prompt_tokens)
+        metricas.incrementar("tokens.completion", completion_tokens)
+        metricas.incrementar("tokens.cached", cached_tokens)
+        metricas.incrementar("tokens.total", total_tokens)
+        metricas.fijar("tokens.consumo_diario", consumo_diario)
+        if TOKENS_PRESUPUESTO_DIARIO:
+            metricas.fijar("tokens.presupuesto_diario_restante", max(0, TOKENS_PRESUPUESTO_DIARIO - consumo_diario))
+
+def cerrar(acumulador=None):
+    """Publica las métricas por propuesta y regresa el resumen"""
+    datos = resumen(acumulador)
+    if datos:
+        metricas.observar("tokens.por_propuesta", datos["total_tokens"])
+        for seccion, uso in datos["por_seccion"].items():
+            metricas.incrementar(f"tokens.seccion.{seccion}", uso["total_tokens"])
+    return datos
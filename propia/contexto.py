@@ -0,0 +1,92 @@
+import re
+import time
+import threading
+import contextvars
+from datetime import datetime
+
+from propia import metricas
+
+# Patrones de empresa, fecha y título. Empiezan con caracteres distintos ("para"/"de"/"empresa",
+# un dígito, "#"), así que la primera coincidencia de su alternancia es la primera aparición de
+# alguno de ellos, la misma que daría re.search con ese patrón solo.
+PATRON_EMPRESA = r'(?i:para\s+|de\s+|empresa\s+)(?P<empresa>(?i:[A-Z][a-zA-Z\s&]+(?:SA\s+de\s+CV|S\.A\.|Inc\.|Corp\.|Ltd\.)?))'
+PATRON_FECHA = r'(?P<fecha>\d{1,2}\s+de\s+\w+\s+de\s+\d{4}|\d{1,2}/\d{1,2}/\d{4})'
+PATRON_TITULO = r'#\s*(?P<titulo>.*?)(?:\n|$)'
+PATRONES = {"empresa": PATRON_EMPRESA, "fecha": PATRON_FECHA, "titulo": PATRON_TITULO}
+# Alternancia precompilada para cada conjunto de campos que faltan por encontrar
+_ALTERNANCIAS = {
+    frozenset(campos): re.compile("|".join(PATRONES[campo] for campo in campos))
+    for campos in (
+        ("empresa", "fecha", "titulo"), ("empresa", "fecha"), ("empresa", "titulo"), ("fecha", "titulo"),
+        ("empresa",), ("fecha",), ("titulo",)
+    )
+}
+
+# Contexto de la solicitud en curso: {"prompts", "lock", "info", "duracion_ms"}
+_contexto = contextvars.ContextVar("contexto_solicitud", default=None)
+
+# ========== EXTRACCIÓN ==========
+
+def extraer(prompt_completo):
+    """
+    Empresa, fecha y título del prompt en una sola pasada: cada búsqueda sigue desde la última
+    coincidencia y ya sin los campos encontrados, así que el texto se recorre una vez (lineal en
+    su longitud) y se deja de recorrer en cuanto aparecen los tres. Los campos que no aparecen
+    toman un valor por defecto.
+
+    :return: {"empresa", "fecha", "titulo"}.
+    """
+    inicio = time.perf_counter()
+    encontrados = {}
+    posicion = 0
+    while len(encontrados) < len(PATRONES):
+        faltantes = frozenset(PATRONES) - set(encontrados)
+        coincidencia = _ALTERNANCIAS[faltantes].search(prompt_completo, posicion)
+        if coincidencia is None:
+            break
+        campo = next(campo for campo in faltantes if coincidencia.group(campo) is not None)
+        encontrados[campo] = coincidencia.group(campo)
+        posicion = coincidencia.start() + 1
+
+    info = {
+        'empresa': encontrados['empresa'].strip() if 'empresa' in encontrados else 'Cliente Estimado',
+        'fecha': encontrados.get('fecha') or datetime.now().strftime('%d de %B de %Y'),
+        'titulo': encontrados['titulo'].strip() if 'titulo' in encontrados else 'Propuesta Técnica'
+    }
+    metricas.observar("contexto.extraccion_ms", round((time.perf_counter() - inicio) * 1000, 3))
+    return info
+
+# ========== CONTEXTO DE LA SOLICITUD ==========
+
+def iniciar(prompt_completo):
+    """
+    Abre el contexto de una solicitud en el contexto actual. La extracción se hace la primera
+    vez que se consulta (la etapa "empresa" del pipeline) y la comparten todas las etapas.
+    """
+    contexto = {"prompts": [prompt_completo], "lock": threading.Lock(), "info": None, "duracion_ms": None}
+    _contexto.set(contexto)
+    return contexto
+
+def asociar(texto):
+    """Registra un texto derivado del prompt de la solicitud (su síntesis) para que comparta el contexto"""
+    contexto = _contexto.get()
+    if contexto is not None and not any(texto is prompt for prompt in contexto["prompts"]):
+        contexto["prompts"].append(texto)
+
+def info_empresa(prompt_completo):
+    """
+    Empresa, fecha y título de la solicitud en curso si `prompt_completo` es su prompt (o su
+    síntesis); fuera de una solicitud, o con otro texto, se extraen del texto recibido.
+    """
+    contexto = _contexto.get()
+    # Identidad y no igualdad: compararlo con == recorrería otra vez el prompt completo
+    if contexto is None or not any(prompt_completo is prompt for prompt in contexto["prompts"]):
+        return extraer(prompt_completo)
+    with contexto["lock"]:
+        if contexto["info"] is None:
+            inicio = time.perf_counter()
+            contexto["info"] = extraer(contexto["prompts"][0])
+            contexto["duracion_ms"] = round((time.perf_counter() - inicio) * 1000, 3)
+        else:
+            metricas.incrementar("contexto.reutilizado")
+    return dict(contexto["info"])
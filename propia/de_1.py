@@ -1,15 +1,26 @@
 import azure.functions as func
 import os
 import re
-import requests
-from docx import Document
 from docx.shared import Pt
 from datetime import datetime, timedelta
-from io import BytesIO
 import json
 import traceback
 import logging
-from azure.storage.blob import BlobServiceClient, generate_blob_sas, BlobSasPermissions
+import threading
+import uuid
+import time
+from azure.storage.blob import generate_blob_sas, BlobSasPermissions
+from propia.almacenamiento import crear_cliente_servicio, crear_stream_temporal, subir_desde_stream
+from propia.pipeline import etapa, ejecutar_grafo
+from propia import metricas, consumo, enrutador_openai, perfilado, motor_xml, cache_semantico, sintesis, render_procesos, secciones, admision, rutas_secciones, tablas, plazos, contexto
+from propia.plantillas import (
+    obtener_compilada, copiar_plantilla, info_plantilla, planificar_placeholders, seleccion_desde_body, PlantillaNoEncontrada
+)
+from propia.manifiesto import construir_registro, registrar_propuesta, buscar_por_id
+from propia.idempotencia import calcular_huella, obtener_clave, ejecutar_una_vez, ConflictoIdempotencia
+from propia.consumo import PresupuestoExcedido
+from propia.plazos import PlazoAgotado
+from propia.admision import CapacidadAgotada
 
 # Configuración de Azure OpenAI
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT", "https://chabot-inventario-talento-aistudio.openai.azure.com/")
@@ -21,34 +32,37 @@ API_VERSION = os.getenv("API_VERSION", "2024-02-15-preview")
 AZURE_STORAGE_CONNECTION_STRING = os.getenv("STORAGE_CONNECTION_STRING")
 PLANTILLA_CONTAINER = "propia"
 PROPUESTAS_CONTAINER = "propia"
-PLANTILLA_BLOB_NAME = "plantilla/Plantilla-Propuesta.docx"
 PROPUESTAS_FOLDER = "propuestas/"
 
+# Placeholders genéricos (personalizados sin contenido fijo) que se generan en una misma llamada
+PLACEHOLDERS_LOTE_TAMANO = int(os.getenv("PLACEHOLDERS_LOTE_TAMANO", "5"))
+
 # ========== FUNCIONES AUXILIARES ==========
 
 def call_azure_openai(messages, max_tokens=1000):
     """Función para llamar a Azure OpenAI"""
     try:
-        api_url = f"{AZURE_OPENAI_ENDPOINT}openai/deployments/{DEPLOYMENT_NAME}/chat/completions?api-version={API_VERSION}"
-
-        headers = {
-            "Content-Type": "application/json",
-            "api-key": AZURE_OPENAI_API_KEY
-        }
+        # Despliegues disponibles (AZURE_OPENAI_POOL o el endpoint único configurado)
+        pool = enrutador_openai.obtener_pool(AZURE_OPENAI_ENDPOINT, DEPLOYMENT_NAME, AZURE_OPENAI_API_KEY, API_VERSION)
+        # Despliegue, max_tokens y temperatura de la sección en curso (RUTAS_SECCIONES y presupuesto aprendido)
+        ruta = rutas_secciones.resolver(pool, max_tokens)
 
-        data = {
-            "messages": messages,
-            "max_tokens": max_tokens
-        }
+        def generar(messages):
+            # Fallar antes de enviar si la llamada no cabe en el presupuesto de tokens
+            estimado = consumo.reservar(messages, ruta["max_tokens"])
+            usage = None
+            try:
+                # Con OPENAI_STREAMING la respuesta se corta al llegar al límite de párrafos de la sección
+                contenido, usage = rutas_secciones.completar(ruta, messages)
+                return contenido
+            finally:
+                consumo.registrar_uso(usage, estimado)
 
-        response = requests.post(api_url, headers=headers, json=data)
-
-        if response.status_code == 200:
-            return response.json()['choices'][0]['message']['content'].strip()
-        else:
-            logging.error(f"Error en Azure OpenAI: {response.status_code}, {response.text}")
-            return None
+        # Con CACHE_SEMANTICO_HABILITADO, una llamada casi idéntica ya generada se reutiliza
+        return cache_semantico.completar(pool, messages, max_tokens, generar)
 
+    except (PresupuestoExcedido, PlazoAgotado):
+        raise
     except Exception as e:
         logging.error(f"Error llamando a Azure OpenAI: {traceback.format_exc()}")
         return None
@@ -88,6 +102,18 @@ def limpiar_formato_markdown_mejorado(texto):
 
 # ========== FUNCIONES DE GENERACIÓN DE CONTENIDO ==========
 
+def generar_seccion_tabular(placeholder, prompt_completo):
+    """Arma [EQUIPO] o [INVERSION] de las tablas del prompt sin el LLM (None si el prompt no las trae)"""
+    contenido_tablas = tablas.formatear(placeholder, prompt_completo)
+    if contenido_tablas is None:
+        return None
+    narrativa = tablas.mensajes_narrativa(placeholder, prompt_completo)
+    if narrativa is None:
+        return contenido_tablas
+    messages, max_tokens = narrativa
+    contenido = call_azure_openai(messages, max_tokens=max_tokens)
+    return tablas.combinar(limpiar_formato_markdown_mejorado(contenido) if contenido else None, contenido_tablas)
+
 def generar_resumen_ejecutivo(prompt_completo):
     """Genera contenido específico para resumen ejecutivo"""
     messages = [
@@ -164,6 +190,10 @@ IMPORTANTE:
 
 def generar_estructura_equipo(prompt_completo):
     """Genera contenido específico para estructura del equipo"""
+    contenido_tablas = generar_seccion_tabular("[EQUIPO]", prompt_completo)
+    if contenido_tablas is not None:
+        return contenido_tablas
+    
     messages = [
         {
             "role": "system",
@@ -190,6 +220,10 @@ IMPORTANTE:
 
 def generar_inversion_detallada(prompt_completo):
     """Genera contenido específico para inversión detallada"""
+    contenido_tablas = generar_seccion_tabular("[INVERSION]", prompt_completo)
+    if contenido_tablas is not None:
+        return contenido_tablas
+    
     messages = [
         {
             "role": "system",
@@ -266,6 +300,70 @@ IMPORTANTE:
     contenido = call_azure_openai(messages, max_tokens=1000)
     return limpiar_formato_markdown_mejorado(contenido) if contenido else None
 
+def parsear_lote_generico(respuesta, placeholders):
+    """Extrae {placeholder: texto} de la respuesta JSON de un lote; ignora claves no solicitadas o vacías"""
+    if not respuesta:
+        return {}
+    
+    # Tolerar que el modelo envuelva el JSON en un bloque de código o agregue texto alrededor
+    inicio, fin = respuesta.find('{'), respuesta.rfind('}')
+    if inicio == -1 or fin <= inicio:
+        return {}
+    try:
+        secciones = json.loads(respuesta[inicio:fin + 1])
+    except ValueError:
+        return {}
+    if not isinstance(secciones, dict):
+        return {}
+    
+    return {
+        placeholder: limpiar_formato_markdown_mejorado(secciones[placeholder])
+        for placeholder in placeholders
+        if isinstance(secciones.get(placeholder), str) and secciones[placeholder].strip()
+    }
+
+def generar_contenido_generico_lote(prompt_completo, placeholders):
+    """
+    Genera varias secciones personalizadas en una sola llamada.
+
+    :return: Diccionario {placeholder: contenido} solo con las secciones que se pudieron parsear;
+             las faltantes deben generarse individualmente con generar_contenido_generico.
+    """
+    lista_placeholders = ", ".join(placeholders)
+    messages = [
+        {
+            "role": "system",
+            "content": f"""Eres un consultor experto en propuestas técnicas. Genera contenido profesional para varias secciones de un documento Word.
+
+IMPORTANTE:
+- Conserva TODOS los números, fechas, porcentajes, montos y datos cuantitativos
+- Si hay información tabular, conviértela a bullets (•) estructurados
+- Usa formato: "• Elemento: Descripción - Datos: valores específicos"
+- NO uses formato Markdown tabla (|---|) ni headers (#)
+- Escribe en párrafos corridos y listas con bullets para Word
+- Usa un estilo profesional y ejecutivo
+- Incluye TODA la información numérica disponible
+- Responde ÚNICAMENTE con un objeto JSON válido, sin texto adicional
+- Las claves del JSON deben ser exactamente: {lista_placeholders}
+- Cada valor es el texto completo de esa sección (usa \\n para separar párrafos)"""
+        },
+        {
+            "role": "user",
+            "content": f"Genera contenido para las secciones {lista_placeholders} basándote en esta información, conservando TODOS los números y datos específicos:\n\n{prompt_completo}"
+        }
+    ]
+    
+    metricas.incrementar("placeholders.lote_llamadas")
+    respuesta = call_azure_openai(messages, max_tokens=1000 * len(placeholders))
+    secciones = parsear_lote_generico(respuesta, placeholders)
+    
+    faltantes = [p for p in placeholders if p not in secciones]
+    if faltantes:
+        metricas.incrementar("placeholders.lote_fallback", len(faltantes))
+        logging.warning(f"Lote sin contenido parseable para {faltantes}; se generarán individualmente")
+    
+    return secciones
+
 # ========== FUNCIONES DE PROCESAMIENTO DE DOCUMENTOS ==========
 
 def set_font_format(run, font_name="Arial Nova Cond", font_size=11.5):
@@ -350,36 +448,32 @@ def replace_in_textboxes(doc, old_text, new_text):
     
     return replacements_made
 
-# ========== FUNCIONES DE EXTRACCIÓN Y UTILIDADES ==========
+def reemplazar_placeholder(doc, placeholder, contenido_generado):
+    """Reemplaza un placeholder en párrafos, tablas y cuadros de texto; regresa el número de reemplazos"""
+    # Con MOTOR_RENDER=xml la sustitución se hace al guardar, sobre el XML ya normalizado
+    if motor_xml.es_documento(doc):
+        return motor_xml.reemplazar(doc, placeholder, contenido_generado)
 
-def extraer_informacion_empresa(prompt_completo):
-    """Extrae información específica de la empresa del prompt"""
-    empresa_pattern = r'(?:para\s+|de\s+|empresa\s+)([A-Z][a-zA-Z\s&]+(?:SA\s+de\s+CV|S\.A\.|Inc\.|Corp\.|Ltd\.)?)'
-    fecha_pattern = r'(\d{1,2}\s+de\s+\w+\s+de\s+\d{4}|\d{1,2}/\d{1,2}/\d{4})'
-    titulo_pattern = r'#\s*(.*?)(?:\n|$)'
-    
-    info = {
-        'empresa': 'Cliente Estimado',
-        'fecha': datetime.now().strftime('%d de %B de %Y'),
-        'titulo': 'Propuesta Técnica'
-    }
+    replacements_for_this_item = 0
     
-    # Extraer nombre de empresa
-    empresa_match = re.search(empresa_pattern, prompt_completo, re.IGNORECASE)
-    if empresa_match:
-        info['empresa'] = empresa_match.group(1).strip()
+    # 1. Buscar en párrafos normales
+    for paragraph in doc.paragraphs:
+        if replace_in_paragraph(paragraph, placeholder, contenido_generado):
+            replacements_for_this_item += 1
     
-    # Extraer fecha
-    fecha_match = re.search(fecha_pattern, prompt_completo)
-    if fecha_match:
-        info['fecha'] = fecha_match.group(1)
+    # 2. Buscar en tablas
+    replacements_for_this_item += replace_in_tables(doc, placeholder, contenido_generado)
     
-    # Extraer título del documento
-    titulo_match = re.search(titulo_pattern, prompt_completo)
-    if titulo_match:
-        info['titulo'] = titulo_match.group(1).strip()
+    # 3. Buscar en cuadros de texto
+    replacements_for_this_item += replace_in_textboxes(doc, placeholder, contenido_generado)
     
-    return info
+    return replacements_for_this_item
+
+# ========== FUNCIONES DE EXTRACCIÓN Y UTILIDADES ==========
+
+def extraer_informacion_empresa(prompt_completo):
+    """Extrae información específica de la empresa del prompt (una sola vez por propuesta, ver contexto)"""
+    return contexto.info_empresa(prompt_completo)
 
 def generar_carta_presentacion(prompt_completo):
     """Genera contenido específico para carta de presentación"""
@@ -433,45 +527,41 @@ def generar_titulo_fecha(prompt_completo):
 
 # ========== FUNCIONES DE AZURE STORAGE ==========
 
-def descargar_plantilla():
-    """Descarga la plantilla desde Azure Blob Storage"""
+def descargar_plantilla(seleccion_plantilla=None):
+    """Obtiene la plantilla seleccionada desde la cache de plantillas compiladas (documento y placeholders)"""
     try:
-        blob_service_client = BlobServiceClient.from_connection_string(AZURE_STORAGE_CONNECTION_STRING)
-        blob_client = blob_service_client.get_blob_client(container=PLANTILLA_CONTAINER, blob=PLANTILLA_BLOB_NAME)
+        blob_service_client = crear_cliente_servicio(AZURE_STORAGE_CONNECTION_STRING)
+        container_client = blob_service_client.get_container_client(PLANTILLA_CONTAINER)
         
-        # Descargar el blob en memoria
-        plantilla_stream = BytesIO()
-        blob_data = blob_client.download_blob()
-        plantilla_stream.write(blob_data.readall())
-        plantilla_stream.seek(0)
-        
-        return plantilla_stream
+        # Solo se descarga y parsea la primera vez por (nombre, ETag)
+        return obtener_compilada(container_client, **(seleccion_plantilla or {}))
+    except PlantillaNoEncontrada:
+        raise
     except Exception as e:
         logging.error(f"Error descargando plantilla: {traceback.format_exc()}")
         return None
 
 def subir_a_blob_storage(nombre_archivo, contenido):
-    """Sube archivo al Blob Storage"""
+    """Sube archivo al Blob Storage en bloques paralelos; regresa (url, estadísticas de subida)"""
     try:
-        blob_service_client = BlobServiceClient.from_connection_string(AZURE_STORAGE_CONNECTION_STRING)
+        blob_service_client = crear_cliente_servicio(AZURE_STORAGE_CONNECTION_STRING)
         # Añadir la carpeta propuestas/ al nombre del blob
         blob_name = f"{PROPUESTAS_FOLDER}{nombre_archivo}"
         blob_client = blob_service_client.get_blob_client(container=PROPUESTAS_CONTAINER, blob=blob_name)
         
-        contenido.seek(0)
-        blob_client.upload_blob(contenido, overwrite=True)
+        transferencia = subir_desde_stream(blob_client, contenido)
         
-        return f"https://{blob_client.account_name}.blob.core.windows.net/{PROPUESTAS_CONTAINER}/{blob_name}"
+        return f"https://{blob_client.account_name}.blob.core.windows.net/{PROPUESTAS_CONTAINER}/{blob_name}", transferencia
     except Exception as e:
         logging.error(f"Error subiendo archivo: {traceback.format_exc()}")
-        return None
+        return None, None
 
-def generar_url_presignada(nombre_archivo, expiracion_minutos=60):
+def generar_url_presignada(nombre_archivo, expiracion_minutos=60, carpeta=PROPUESTAS_FOLDER):
     """Genera una URL pre-firmada (SAS) para acceder al archivo"""
     try:
-        blob_service_client = BlobServiceClient.from_connection_string(AZURE_STORAGE_CONNECTION_STRING)
-        # Añadir la carpeta propuestas/ al nombre del blob
-        blob_name = f"{PROPUESTAS_FOLDER}{nombre_archivo}"
+        blob_service_client = crear_cliente_servicio(AZURE_STORAGE_CONNECTION_STRING)
+        # Añadir la carpeta (propuestas/ por defecto) al nombre del blob
+        blob_name = f"{carpeta}{nombre_archivo}"
         blob_client = blob_service_client.get_blob_client(container=PROPUESTAS_CONTAINER, blob=blob_name)
 
         sas_token = generate_blob_sas(
@@ -491,113 +581,389 @@ def generar_url_presignada(nombre_archivo, expiracion_minutos=60):
 
 # ========== FUNCIÓN PRINCIPAL DE PROCESAMIENTO ==========
 
-def procesar_propuesta_completa(prompt_completo, placeholders_personalizados=None):
-    """Procesa una propuesta completa"""
+# Generador de cada placeholder conocido de la plantilla
+GENERADORES_SECCIONES = {
+    "[RESUMEN]": generar_resumen_ejecutivo,
+    "[ALCANCE]": generar_alcance_minimo,
+    "[PLAN_TRABAJO]": generar_plan_trabajo,
+    "[EQUIPO]": generar_estructura_equipo,
+    "[INVERSION]": generar_inversion_detallada,
+    "[SUPUESTOS]": generar_supuestos_condiciones,
+    "[CARTA_PRESENTACION]": generar_carta_presentacion,
+    "[titulo]": lambda prompt: generar_titulo_fecha(prompt).split('\n')[0],
+    "[fecha]": lambda prompt: generar_titulo_fecha(prompt).split('\n')[1]
+}
+
+def procesar_propuesta_completa(prompt_completo, placeholders_personalizados=None, seleccion_plantilla=None,
+                                placeholders_genericos=None, perfilar=False, recibida=None):
+    """
+    Procesa una propuesta completa como un grafo de etapas.
+
+    La copia de la plantilla, la extracción de la empresa y las secciones se ejecutan en paralelo;
+    cada sección se reemplaza en el documento en cuanto termina. Solo se generan los placeholders
+    presentes en la plantilla, y los que no tienen generador usan generar_contenido_generico.
     
-    # Descargar plantilla
-    plantilla_stream = descargar_plantilla()
-    if not plantilla_stream:
-        raise Exception("No se pudo descargar la plantilla")
+    Los placeholders genéricos (`placeholders_genericos` y los autogenerados) se agrupan en lotes
+    de PLACEHOLDERS_LOTE_TAMANO secciones por llamada; su función en `placeholders_personalizados`
+    solo se usa como respaldo individual cuando el lote no se puede parsear.
     
-    logging.info(f"Procesando propuesta: {len(prompt_completo)} caracteres")
+    Con RENDER_PROCESOS el documento se ensambla en el pool de procesos cuando terminan todas
+    las secciones, en lugar de reemplazar cada una en los hilos del pipeline.
     
-    # Extraer información de la empresa
-    info_empresa = extraer_informacion_empresa(prompt_completo)
-    logging.info(f"Empresa: {info_empresa['empresa']}, Fecha: {info_empresa['fecha']}, Título: {info_empresa['titulo']}")
+    Con `perfilar` el pipeline se ejecuta bajo el perfilador de muestreo y el perfil se sube
+    bajo perfiles/{document_id}/.
+    
+    Las llamadas al LLM se ajustan al plazo de la solicitud (plazos, desde `recibida`); las secciones
+    que no alcanzan se omiten del documento y se reportan en placeholders_pendientes.
+    """
+    # Tokens de la propuesta (falla de inmediato si el presupuesto diario está agotado)
+    acumulador_tokens = consumo.iniciar()
+    plazo = plazos.iniciar(recibida)
+    # Empresa, fecha y título se extraen una vez del prompt original (etapa "empresa")
+    contexto.iniciar(prompt_completo)
+    
+    # Prompts largos: las secciones se generan a partir de una síntesis del proyecto
+    prompt_completo, info_sintesis = sintesis.preparar(
+        prompt_completo,
+        call_azure_openai,
+        lambda: crear_cliente_servicio(AZURE_STORAGE_CONNECTION_STRING).get_container_client(PROPUESTAS_CONTAINER)
+    )
+    contexto.asociar(prompt_completo)
+    
+    # Plantilla compilada (en cache) para conocer sus placeholders antes de generar
+    plantilla_compilada = descargar_plantilla(seleccion_plantilla)
+    if plantilla_compilada is None:
+        raise Exception("No se pudo descargar la plantilla")
+    
+    # Identificador corto del documento (mismo formato que los endpoints de consulta)
+    document_id = str(uuid.uuid4())[:8]
+    logging.info(f"Procesando propuesta {document_id}: {len(prompt_completo)} caracteres")
     
     # Definir placeholders con funciones de generación
-    placeholders_config = {
-        "[RESUMEN]": generar_resumen_ejecutivo,
-        "[ALCANCE]": generar_alcance_minimo,
-        "[PLAN_TRABAJO]": generar_plan_trabajo,
-        "[EQUIPO]": generar_estructura_equipo,
-        "[INVERSION]": generar_inversion_detallada,
-        "[SUPUESTOS]": generar_supuestos_condiciones,
-        "[CARTA_PRESENTACION]": generar_carta_presentacion,
-        "[titulo]": lambda prompt: generar_titulo_fecha(prompt).split('\n')[0],
-        "[fecha]": lambda prompt: generar_titulo_fecha(prompt).split('\n')[1]
-    }
+    placeholders_config = dict(GENERADORES_SECCIONES)
     
     # Agregar placeholders personalizados si se proporcionan
     if placeholders_personalizados:
         placeholders_config.update(placeholders_personalizados)
     
-    # Cargar documento
-    doc = Document(plantilla_stream)
-    cambios_totales = 0
+    # No pagar completions para placeholders que la plantilla no contiene
+    placeholders_config, placeholders_omitidos, placeholders_autogenerados = planificar_placeholders(
+        placeholders_config, plantilla_compilada["placeholders"], personalizados=placeholders_personalizados or {}
+    )
     
-    # Procesar cada placeholder
-    for placeholder, funcion_generadora in placeholders_config.items():
+    # Placeholders de la plantilla sin generador: usar la función genérica
+    for placeholder in placeholders_autogenerados:
+        placeholders_config[placeholder] = lambda prompt, p=placeholder: generar_contenido_generico(prompt, p)
+    if placeholders_autogenerados:
+        metricas.incrementar("placeholders.autogenerados", len(placeholders_autogenerados))
+        logging.info(f"Placeholders sin generador, se usa contenido genérico: {placeholders_autogenerados}")
+    
+    # Agrupar los placeholders genéricos en lotes
+    genericos_solicitados = set(placeholders_genericos or []) | set(placeholders_autogenerados)
+    genericos = [placeholder for placeholder in placeholders_config if placeholder in genericos_solicitados]
+    lotes = {}
+    if len(genericos) > 1:
+        tamano_lote = max(1, PLACEHOLDERS_LOTE_TAMANO)
+        for indice in range(0, len(genericos), tamano_lote):
+            lote = genericos[indice:indice + tamano_lote]
+            if len(lote) > 1:
+                lotes[f"lote:{indice // tamano_lote}"] = lote
+    lote_de_placeholder = {placeholder: nombre for nombre, lote in lotes.items() for placeholder in lote}
+    
+    # Los reemplazos modifican el mismo documento, así que se serializan entre sí
+    lock_documento = threading.Lock()
+    procesos = render_procesos.habilitado()
+    
+    def obtener_empresa(entradas):
+        # Extraer información de la empresa
+        info_empresa = extraer_informacion_empresa(prompt_completo)
+        logging.info(f"Empresa: {info_empresa['empresa']}, Fecha: {info_empresa['fecha']}, Título: {info_empresa['titulo']}")
+        return info_empresa
+    
+    def generar_lote(placeholders):
+        consumo.etiquetar(",".join(placeholders))
+        try:
+            return generar_contenido_generico_lote(prompt_completo, placeholders)
+        except PresupuestoExcedido:
+            raise
+        except Exception as e:
+            logging.error(f"Error generando lote {placeholders}: {traceback.format_exc()}")
+            return {}
+    
+    def generar(placeholder, funcion_generadora, entradas):
         logging.info(f"Procesando: {placeholder}")
         
+        # Tomar la sección del lote si se pudo parsear
+        nombre_lote = lote_de_placeholder.get(placeholder)
+        if nombre_lote and entradas[nombre_lote].get(placeholder):
+            return entradas[nombre_lote][placeholder]
+        
+        consumo.etiquetar(placeholder)
         try:
             # Generar contenido específico
             contenido_generado = funcion_generadora(prompt_completo)
-            
-            if not contenido_generado:
-                logging.warning(f"No se pudo generar contenido para {placeholder}")
-                continue
-            
-            logging.info(f"Contenido generado: {len(contenido_generado)} caracteres")
-            
-            replacements_for_this_item = 0
-            
-            # 1. Buscar en párrafos normales
-            for paragraph in doc.paragraphs:
-                if replace_in_paragraph(paragraph, placeholder, contenido_generado):
-                    replacements_for_this_item += 1
-            
-            # 2. Buscar en tablas
-            table_replacements = replace_in_tables(doc, placeholder, contenido_generado)
-            replacements_for_this_item += table_replacements
-            
-            # 3. Buscar en cuadros de texto
-            textbox_replacements = replace_in_textboxes(doc, placeholder, contenido_generado)
-            replacements_for_this_item += textbox_replacements
-            
-            if replacements_for_this_item > 0:
-                logging.info(f"Realizados {replacements_for_this_item} reemplazos para {placeholder}")
-                cambios_totales += replacements_for_this_item
-            else:
-                logging.warning(f"No se encontró el placeholder {placeholder} en el documento")
-                
+        except PresupuestoExcedido:
+            raise
+        except PlazoAgotado:
+            plazos.marcar_pendiente(placeholder)
+            return None
+        except Exception as e:
+            logging.error(f"Error procesando {placeholder}: {traceback.format_exc()}")
+            return None
+        
+        if not contenido_generado:
+            logging.warning(f"No se pudo generar contenido para {placeholder}")
+            return None
+        
+        logging.info(f"Contenido generado para {placeholder}: {len(contenido_generado)} caracteres")
+        return contenido_generado
+    
+    def reemplazar(placeholder, entradas):
+        doc, _ = entradas["plantilla"]
+        contenido_generado = entradas[f"seccion:{placeholder}"]
+        if not contenido_generado:
+            return 0
+        
+        try:
+            with lock_documento:
+                replacements_for_this_item = reemplazar_placeholder(doc, placeholder, contenido_generado)
         except Exception as e:
             logging.error(f"Error procesando {placeholder}: {traceback.format_exc()}")
+            return 0
+        
+        if replacements_for_this_item > 0:
+            logging.info(f"Realizados {replacements_for_this_item} reemplazos para {placeholder}")
+        else:
+            logging.warning(f"No se encontró el placeholder {placeholder} en el documento")
+        return replacements_for_this_item
     
-    if cambios_totales == 0:
-        raise Exception("No se realizaron cambios en el documento")
+    def copiar_documento():
+        if procesos:
+            return None, info_plantilla(plantilla_compilada)
+        with perfilado.medir_memoria("plantilla.copia"):
+            return copiar_plantilla(plantilla_compilada)
     
-    # Guardar documento en memoria
-    output_stream = BytesIO()
-    doc.save(output_stream)
+    def guardar_y_subir(entradas):
+        doc, _ = entradas["plantilla"]
+        info_empresa = entradas["empresa"]
+        if procesos:
+            contenidos = {placeholder: entradas[f"seccion:{placeholder}"] for placeholder in placeholders_config}
+            docx_bytes, cambios = render_procesos.renderizar(plantilla_compilada, contenidos, reemplazar_placeholder)
+            for placeholder in (p for p, contenido in contenidos.items() if contenido and not cambios.get(p)):
+                logging.warning(f"No se encontró el placeholder {placeholder} en el documento")
+            cambios_totales = sum(cambios.values())
+        else:
+            cambios_totales = sum(entradas[f"reemplazo:{placeholder}"] for placeholder in placeholders_config)
+        
+        if cambios_totales == 0:
+            if plazos.pendientes(plazo):
+                raise PlazoAgotado("Plazo de la solicitud agotado sin ninguna sección generada")
+            raise Exception("No se realizaron cambios en el documento")
+        
+        # Generar nombre de archivo
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        empresa_clean = re.sub(r'[^\w\s-]', '', info_empresa['empresa']).strip()[:20]
+        nombre_archivo = f"Propuesta_{empresa_clean}_{document_id}_{timestamp}.docx"
+        
+        # Guardar documento (en memoria hasta el umbral, después en disco) y subirlo a Blob Storage
+        with crear_stream_temporal() as output_stream:
+            with perfilado.medir_memoria("doc.save"):
+                if procesos:
+                    output_stream.write(docx_bytes)
+                elif motor_xml.es_documento(doc):
+                    motor_xml.guardar(doc, output_stream)
+                else:
+                    doc.save(output_stream)
+            url_archivo, transferencia = subir_a_blob_storage(nombre_archivo, output_stream)
+        
+        if not url_archivo:
+            raise Exception("Error al subir el archivo a Azure Blob Storage")
+        
+        # Textos de las secciones junto al documento, para renderizarlo de nuevo sin el LLM
+        secciones.guardar(
+            crear_cliente_servicio(AZURE_STORAGE_CONNECTION_STRING).get_container_client(PROPUESTAS_CONTAINER),
+            f"{PROPUESTAS_FOLDER}{nombre_archivo}",
+            document_id,
+            {placeholder: entradas[f"seccion:{placeholder}"] for placeholder in placeholders_config},
+            info_plantilla(plantilla_compilada),
+            pendientes=plazos.pendientes(plazo),
+            prompt=prompt_completo
+        )
+        
+        logging.info(f"Documento guardado: {nombre_archivo}")
+        logging.info(f"Total de reemplazos realizados: {cambios_totales}")
+        
+        return {"nombre_archivo": nombre_archivo, "transferencia": transferencia}
     
-    # Generar nombre de archivo
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    empresa_clean = re.sub(r'[^\w\s-]', '', info_empresa['empresa']).strip()[:20]
-    nombre_archivo = f"Propuesta_{empresa_clean}_{timestamp}.docx"
+    etapas = {
+        # Obtener copia editable de la plantilla compilada
+        "plantilla": etapa(lambda entradas: copiar_documento()),
+        "empresa": etapa(obtener_empresa)
+    }
+    for nombre_lote, lote in lotes.items():
+        etapas[nombre_lote] = etapa(lambda entradas, l=lote: generar_lote(l))
+    for placeholder, funcion_generadora in placeholders_config.items():
+        dependencias = [lote_de_placeholder[placeholder]] if placeholder in lote_de_placeholder else []
+        # Carta, título y fecha usan los datos de la empresa: esperan a la etapa que los extrae
+        if placeholder in ("[CARTA_PRESENTACION]", "[titulo]", "[fecha]"):
+            dependencias.append("empresa")
+        etapas[f"seccion:{placeholder}"] = etapa(
+            lambda entradas, p=placeholder, f=funcion_generadora: generar(p, f, entradas),
+            dependencias=dependencias
+        )
+        if not procesos:
+            etapas[f"reemplazo:{placeholder}"] = etapa(
+                lambda entradas, p=placeholder: reemplazar(p, entradas),
+                dependencias=("plantilla", f"seccion:{placeholder}")
+            )
+    etapas["guardar_subir"] = etapa(
+        guardar_y_subir,
+        dependencias=["plantilla", "empresa"]
+        + [f"seccion:{placeholder}" for placeholder in placeholders_config]
+        + ([] if procesos else [f"reemplazo:{placeholder}" for placeholder in placeholders_config])
+    )
+    # Generar URL pre-firmada
+    etapas["firmar"] = etapa(
+        lambda entradas: generar_url_presignada(entradas["guardar_subir"]["nombre_archivo"]),
+        dependencias=("guardar_subir",)
+    )
     
-    # Subir a Blob Storage
-    url_archivo = subir_a_blob_storage(nombre_archivo, output_stream)
-    if not url_archivo:
-        raise Exception("Error al subir el archivo a Azure Blob Storage")
+    sesion_perfil = perfilado.iniciar(f"generar_documento:{document_id}") if perfilar else None
+    try:
+        resultados, reporte = ejecutar_grafo(etapas, nombre_pipeline="generar_documento")
+    finally:
+        perfilado.detener(sesion_perfil)
+    tokens = consumo.cerrar(acumulador_tokens)
+    pendientes = plazos.pendientes(plazo)
+    container_client = crear_cliente_servicio(AZURE_STORAGE_CONNECTION_STRING).get_container_client(PROPUESTAS_CONTAINER)
     
-    logging.info(f"Documento guardado: {nombre_archivo}")
-    logging.info(f"Total de reemplazos realizados: {cambios_totales}")
+    # Registrar la propuesta en el manifiesto consultable
+    registrar_propuesta(
+        container_client,
+        construir_registro(
+            document_id,
+            resultados["guardar_subir"]["nombre_archivo"],
+            f"{PROPUESTAS_FOLDER}{resultados['guardar_subir']['nombre_archivo']}",
+            resultados["empresa"],
+            resultados["guardar_subir"]["transferencia"],
+            resultados["plantilla"][1],
+            reporte,
+            tokens=tokens,
+            **({"placeholders_pendientes": pendientes} if pendientes else {})
+        )
+    )
     
-    # Generar URL pre-firmada
-    url_presignada = generar_url_presignada(nombre_archivo)
+    # Subir el perfil de la solicitud y enlazarlo en la respuesta
+    perfil = None
+    if sesion_perfil:
+        try:
+            blobs_perfil = perfilado.subir(container_client, sesion_perfil, document_id, tiempos=reporte, tokens=tokens)
+            perfil = {
+                clave: generar_url_presignada(blob_name, expiracion_minutos=1440, carpeta="")
+                for clave, blob_name in blobs_perfil.items()
+            }
+        except Exception as e:
+            logging.error(f"No se pudo subir el perfil de {document_id}: {traceback.format_exc()}")
     
-    return url_presignada
+    return {
+        "document_id": document_id,
+        "url": resultados["firmar"],
+        "empresa": resultados["empresa"],
+        "transferencia": resultados["guardar_subir"]["transferencia"],
+        "plantilla": resultados["plantilla"][1],
+        "placeholders_omitidos": placeholders_omitidos,
+        "placeholders_autogenerados": placeholders_autogenerados,
+        "placeholders_pendientes": pendientes,
+        "tiempos": reporte,
+        "tokens": tokens,
+        "perfil": perfil,
+        "sintesis": info_sintesis
+    }
+
+# ========== COMPLETAR PROPUESTAS PARCIALES ==========
+
+def generar_pendiente(placeholder, prompt_completo):
+    """Genera una sección pendiente; regresa None si de nuevo no alcanza el plazo o falla"""
+    funcion_generadora = GENERADORES_SECCIONES.get(placeholder) or (
+        lambda prompt: generar_contenido_generico(prompt, placeholder)
+    )
+    consumo.etiquetar(placeholder)
+    try:
+        return funcion_generadora(prompt_completo) or None
+    except PresupuestoExcedido:
+        raise
+    except PlazoAgotado:
+        plazos.marcar_pendiente(placeholder)
+        return None
+    except Exception as e:
+        logging.error(f"Error completando {placeholder}: {traceback.format_exc()}")
+        return None
+
+def completar_pendientes(document_id, recibida=None):
+    """
+    Genera las secciones que una propuesta dejó pendientes al agotarse su plazo y sube de nuevo el
+    documento, en el mismo blob y con el mismo document_id. Las secciones se generan en paralelo
+    con un plazo nuevo; las que tampoco alcanzan siguen pendientes.
+
+    Los placeholders sin generador propio (incluidos los personalizados que no eran texto) se
+    generan con la función genérica, igual que en generar_documento.
+
+    :return: Resultado con las secciones completadas y las pendientes, o None si la propuesta no
+             existe o no tiene registro de secciones.
+    """
+    contenedor = crear_cliente_servicio(AZURE_STORAGE_CONNECTION_STRING).get_container_client(PROPUESTAS_CONTAINER)
+    registro = buscar_por_id(contenedor, document_id)
+    if registro is None:
+        return None
+    
+    acumulador_tokens = consumo.iniciar()
+    plazos.iniciar(recibida)
+    # La misma plantilla con que se generó (su versión vigente)
+    plantilla_compilada = descargar_plantilla({"nombre": (registro.get("plantilla") or {}).get("nombre")})
+    if plantilla_compilada is None:
+        raise Exception("No se pudo descargar la plantilla")
+    
+    def generar(pendientes, prompt_completo):
+        # Carta, título y fecha comparten la extracción de la empresa
+        contexto.iniciar(prompt_completo)
+        etapas = {
+            placeholder: etapa(lambda entradas, p=placeholder: generar_pendiente(p, prompt_completo))
+            for placeholder in pendientes
+        }
+        resultados, _ = ejecutar_grafo(etapas, nombre_pipeline="completar_propuesta")
+        return resultados
+    
+    resumen = secciones.completar(
+        contenedor, registro["blob_name"], plantilla_compilada, reemplazar_placeholder, generar
+    )
+    tokens = consumo.cerrar(acumulador_tokens)
+    if resumen is None:
+        return None
+    
+    return {
+        "document_id": document_id,
+        "blob_name": registro["blob_name"],
+        "url": generar_url_presignada(registro["blob_name"], expiracion_minutos=1440, carpeta=""),
+        "completadas": resumen["completadas"],
+        "placeholders_pendientes": resumen["pendientes"],
+        "transferencia": resumen["transferencia"],
+        "tokens": tokens,
+        "status": "partial" if resumen["pendientes"] else "completed"
+    }
 
 # ========== FUNCIÓN PRINCIPAL DE AZURE FUNCTION ==========
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
+    # El plazo de la solicitud corre desde que llega (incluye la espera en la cola de admisión)
+    recibida = time.monotonic()
     try:
         logging.info("Inicio de la función de generación de propuestas")
         
         # Intentar obtener el contenido de diferentes formas
         prompt_completo = None
         placeholders_personalizados = None
+        placeholders_genericos = []
+        seleccion_plantilla = {}
         
         # Primero intentar obtener JSON
         try:
@@ -605,6 +971,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             if req_body:
                 prompt_completo = req_body.get('prompt')
                 placeholders_personalizados = req_body.get('placeholders_personalizados', None)
+                seleccion_plantilla = seleccion_desde_body(req_body)
         except ValueError:
             # Si no es JSON, intentar obtener como texto plano
             logging.info("No se recibió JSON válido, intentando como texto plano")
@@ -627,6 +994,10 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 mimetype='application/json'
             )
         
+        # Solicitudes idénticas o con la misma Idempotency-Key comparten un solo trabajo
+        huella = calcular_huella(prompt_completo, placeholders_personalizados, seleccion_plantilla)
+        clave_idempotencia = obtener_clave(req, huella)
+        
         # Si se proporcionan placeholders personalizados, convertirlos en funciones
         if placeholders_personalizados:
             placeholders_funciones = {}
@@ -635,15 +1006,59 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 if isinstance(contenido, str):
                     placeholders_funciones[placeholder] = lambda prompt, c=contenido: c
                 else:
-                    # Si es otro tipo, usar función genérica
+                    # Si es otro tipo, usar función genérica (agrupada en lotes; esta función es el respaldo)
                     placeholders_funciones[placeholder] = lambda prompt, p=placeholder: generar_contenido_generico(prompt, p)
+                    placeholders_genericos.append(placeholder)
             placeholders_personalizados = placeholders_funciones
         
         logging.info(f"Procesando propuesta con prompt de {len(prompt_completo)} caracteres")
         
-        # Procesar la propuesta
-        url_presignada = procesar_propuesta_completa(prompt_completo, placeholders_personalizados)
+        def procesar():
+            # Solo el trabajo nuevo ocupa un lugar; los duplicados esperan su resultado
+            with admision.admitir():
+                return procesar_propuesta_completa(
+                    prompt_completo, placeholders_personalizados, seleccion_plantilla, placeholders_genericos,
+                    perfilar=perfilado.solicitado(req), recibida=recibida
+                )
         
+        # Procesar la propuesta (o adjuntarse a una idéntica en curso)
+        try:
+            resultado, origen = ejecutar_una_vez(clave_idempotencia, huella, procesar)
+        except ConflictoIdempotencia as conflicto:
+            return func.HttpResponse(
+                json.dumps({"error": str(conflicto)}),
+                status_code=422,
+                mimetype='application/json'
+            )
+        except PlantillaNoEncontrada as sin_plantilla:
+            return func.HttpResponse(
+                json.dumps({"error": str(sin_plantilla)}),
+                status_code=404,
+                mimetype='application/json'
+            )
+        except PresupuestoExcedido as excedido:
+            # El presupuesto diario se recupera al día siguiente; el de la solicitud no
+            return func.HttpResponse(
+                json.dumps({"error": str(excedido), "presupuesto": excedido.alcance}),
+                status_code=429 if excedido.alcance == "diario" else 422,
+                mimetype='application/json',
+                headers={"Retry-After": str(excedido.reintentar_en)} if excedido.reintentar_en else None
+            )
+        except CapacidadAgotada as agotada:
+            return func.HttpResponse(
+                json.dumps({"error": str(agotada)}),
+                status_code=agotada.codigo,
+                mimetype='application/json',
+                headers={"Retry-After": str(agotada.reintentar_en)}
+            )
+        except PlazoAgotado as agotado:
+            return func.HttpResponse(
+                json.dumps({"error": str(agotado)}),
+                status_code=504,
+                mimetype='application/json'
+            )
+        
+        url_presignada = resultado["url"]
         if not url_presignada:
             return func.HttpResponse(
                 json.dumps({"error": "Error generando la propuesta"}),
@@ -651,15 +1066,31 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 mimetype='application/json'
             )
         
-        # Extraer información de la empresa para la respuesta
-        info_empresa = extraer_informacion_empresa(prompt_completo)
+        # Información de la empresa extraída por el pipeline
+        info_empresa = resultado["empresa"]
         
         response_data = {
+            "document_id": resultado["document_id"],
             "url": url_presignada,
             "empresa": info_empresa['empresa'],
             "fecha": info_empresa['fecha'],
             "titulo": info_empresa['titulo'],
-            "mensaje": "Propuesta generada exitosamente"
+            "mensaje": (
+                "Propuesta generada sin algunas secciones por falta de tiempo; para generarlas envía "
+                f"POST /api/completar_propuesta/{resultado['document_id']}"
+                if resultado["placeholders_pendientes"] else "Propuesta generada exitosamente"
+            ),
+            "status": "partial" if resultado["placeholders_pendientes"] else "completed",
+            "deduplicado": origen != "nuevo",
+            "transferencia": resultado["transferencia"],
+            "plantilla": resultado["plantilla"],
+            "placeholders_omitidos": resultado["placeholders_omitidos"],
+            "placeholders_autogenerados": resultado["placeholders_autogenerados"],
+            "placeholders_pendientes": resultado["placeholders_pendientes"],
+            "tiempos": resultado["tiempos"],
+            "tokens": resultado["tokens"],
+            "perfil": resultado["perfil"],
+            "sintesis": resultado.get("sintesis")
         }
         
         logging.info(f"Propuesta generada exitosamente: {url_presignada}")
@@ -681,4 +1112,61 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             }),
             status_code=500,
             mimetype='application/json'
-        )
\ No newline at end of file
+        )
+
+def completar(req: func.HttpRequest) -> func.HttpResponse:
+    """Genera las secciones que una propuesta dejó pendientes (status "partial")"""
+    recibida = time.monotonic()
+    document_id = req.route_params.get('document_id')
+    try:
+        with admision.admitir():
+            resultado = completar_pendientes(document_id, recibida=recibida)
+        
+        if resultado is None:
+            return func.HttpResponse(
+                json.dumps({
+                    "error": f"Propuesta {document_id} no encontrada o sin registro de secciones",
+                    "document_id": document_id,
+                    "status": "not_found"
+                }),
+                status_code=404,
+                mimetype='application/json'
+            )
+        return func.HttpResponse(json.dumps(resultado), status_code=200, mimetype='application/json')
+    
+    except PlantillaNoEncontrada as sin_plantilla:
+        return func.HttpResponse(
+            json.dumps({"error": str(sin_plantilla), "document_id": document_id, "status": "failed"}),
+            status_code=404,
+            mimetype='application/json'
+        )
+    except PresupuestoExcedido as excedido:
+        return func.HttpResponse(
+            json.dumps({
+                "error": str(excedido),
+                "document_id": document_id,
+                "presupuesto": excedido.alcance,
+                "status": "budget_exceeded"
+            }),
+            status_code=429 if excedido.alcance == "diario" else 422,
+            mimetype='application/json',
+            headers={"Retry-After": str(excedido.reintentar_en)} if excedido.reintentar_en else None
+        )
+    except CapacidadAgotada as agotada:
+        return func.HttpResponse(
+            json.dumps({"error": str(agotada), "document_id": document_id, "status": "overloaded"}),
+            status_code=agotada.codigo,
+            mimetype='application/json',
+            headers={"Retry-After": str(agotada.reintentar_en)}
+        )
+    except Exception as e:
+        logging.error(f"Error completando la propuesta {document_id}: {traceback.format_exc()}")
+        return func.HttpResponse(
+            json.dumps({
+                "error": f"Error completando propuesta: {str(e)}",
+                "document_id": document_id,
+                "status": "failed"
+            }),
+            status_code=500,
+            mimetype='application/json'
+        )
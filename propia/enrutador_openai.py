@@ -0,0 +1,524 @@
+import os
+import json
+import time
+import random
+import logging
+import asyncio
+import threading
+import aiohttp
+import requests
+
+from propia import metricas, asincrono, plazos
+
+# Pool de despliegues como lista JSON:
+# [{"nombre": "eastus", "endpoint": "https://...", "deployment": "gpt-4o-mini",
+#   "api_key_env": "OPENAI_KEY_EASTUS", "api_version": "2024-02-15-preview"}, ...]
+# Si no se configura, el pool es el despliegue único de AZURE_OPENAI_ENDPOINT / DEPLOYMENT_NAME
+AZURE_OPENAI_POOL = os.getenv("AZURE_OPENAI_POOL")
+OPENAI_TIMEOUT_SEGUNDOS = float(os.getenv("OPENAI_TIMEOUT_SEGUNDOS", "120"))
+# Despliegue de embeddings (cada endpoint del pool puede indicar su propio "deployment_embeddings")
+EMBEDDINGS_DEPLOYMENT = os.getenv("EMBEDDINGS_DEPLOYMENT", "text-embedding-3-small")
+# Fallos consecutivos que abren el circuito de un endpoint
+CIRCUITO_FALLOS = int(os.getenv("CIRCUITO_FALLOS", "5"))
+# Segundos que un circuito abierto espera antes de dejar pasar una prueba (semiabierto)
+CIRCUITO_ENFRIAMIENTO_SEGUNDOS = float(os.getenv("CIRCUITO_ENFRIAMIENTO_SEGUNDOS", "30"))
+# Peso de la última latencia en el promedio móvil exponencial
+LATENCIA_ALFA = 0.3
+
+CERRADO, ABIERTO, SEMIABIERTO = "cerrado", "abierto", "semiabierto"
+
+_lock = threading.Lock()
+# nombre -> estado del endpoint (latencia, cuota, circuito)
+_estado = {}
+# clave de configuración -> lista de endpoints
+_pools = {}
+
+
+class ErrorCliente(Exception):
+    """Error 4xx de la solicitud (no se reintenta en otro endpoint)"""
+
+
+class TransmisionInterrumpida(Exception):
+    """La conexión se cortó a mitad de una respuesta transmitida (no se reintenta en otro endpoint)"""
+
+
+# ========== CONFIGURACIÓN DEL POOL ==========
+
+def obtener_pool(endpoint, deployment, api_key, api_version):
+    """
+    Regresa los endpoints configurados en AZURE_OPENAI_POOL, o el despliegue
+    único indicado por los parámetros si no hay pool.
+    """
+    clave = (AZURE_OPENAI_POOL, endpoint, deployment, api_version)
+    with _lock:
+        if clave in _pools:
+            return _pools[clave]
+
+    if AZURE_OPENAI_POOL:
+        pool = []
+        for indice, config in enumerate(json.loads(AZURE_OPENAI_POOL)):
+            pool.append({
+                "nombre": config.get("nombre") or f"endpoint{indice}",
+                "endpoint": config["endpoint"].rstrip("/") + "/",
+                "deployment": config.get("deployment", deployment),
+                "deployment_embeddings": config.get("deployment_embeddings", EMBEDDINGS_DEPLOYMENT),
+                "api_key": os.getenv(config["api_key_env"]) if config.get("api_key_env") else config.get("api_key", api_key),
+                "api_version": config.get("api_version", api_version)
+            })
+    else:
+        pool = [{
+            "nombre": "principal",
+            "endpoint": endpoint,
+            "deployment": deployment,
+            "deployment_embeddings": EMBEDDINGS_DEPLOYMENT,
+            "api_key": api_key,
+            "api_version": api_version
+        }]
+
+    _registrar_pool(clave, pool)
+    return pool
+
+def pool_con_deployment(pool, deployment):
+    """
+    El mismo pool con otro despliegue de chat en cada endpoint (p. ej. uno más rápido para
+    secciones simples). Cada endpoint/despliegue lleva su propio circuito, latencia y cuota.
+    """
+    if all(config["deployment"] == deployment for config in pool):
+        return pool
+    clave = ("deployment", deployment, tuple(config["nombre"] for config in pool))
+    with _lock:
+        if clave in _pools:
+            return _pools[clave]
+
+    derivado = [
+        dict(config, nombre=f"{config['nombre']}/{deployment}", deployment=deployment)
+        for config in pool
+    ]
+    _registrar_pool(clave, derivado)
+    return derivado
+
+def pool_embeddings(pool):
+    """
+    El pool para embeddings: los mismos endpoints con el despliegue de embeddings, cada uno con su
+    propio circuito, latencia y cuota, para que un 429 o un 5xx de embeddings no abra el circuito
+    de las completions ni su cuota se mezcle con la de chat.
+    """
+    clave = ("embeddings", tuple((config["nombre"], config["deployment_embeddings"]) for config in pool))
+    with _lock:
+        if clave in _pools:
+            return _pools[clave]
+
+    derivado = [
+        dict(config, nombre=f"{config['nombre']}/{config['deployment_embeddings']}")
+        for config in pool
+    ]
+    _registrar_pool(clave, derivado)
+    return derivado
+
+def _registrar_pool(clave, pool):
+    with _lock:
+        _pools[clave] = pool
+        for config in pool:
+            _estado.setdefault(config["nombre"], {
+                "circuito": CERRADO,
+                "fallos_consecutivos": 0,
+                "abierto_hasta": 0.0,
+                "prueba_en_curso": False,
+                "latencia_ms": None,
+                "en_vuelo": 0,
+                "cuota_restante": None,
+                "cuota_maxima": None
+            })
+
+# ========== SELECCIÓN ==========
+
+def _disponible(estado, ahora):
+    """Indica si el endpoint acepta una solicitud (se llama con _lock tomado)"""
+    if estado["circuito"] == CERRADO:
+        return True
+    if estado["circuito"] == ABIERTO and ahora >= estado["abierto_hasta"]:
+        estado["circuito"] = SEMIABIERTO
+        estado["prueba_en_curso"] = False
+    return estado["circuito"] == SEMIABIERTO and not estado["prueba_en_curso"]
+
+def _puntaje(estado):
+    """Menor es mejor: latencia observada, solicitudes en vuelo y fracción de cuota restante"""
+    latencia = estado["latencia_ms"] if estado["latencia_ms"] is not None else 0.0
+    puntaje = (latencia + 1.0) * (1 + estado["en_vuelo"])
+    if estado["cuota_restante"] is not None and estado["cuota_maxima"]:
+        puntaje /= max(0.05, estado["cuota_restante"] / estado["cuota_maxima"])
+    return puntaje
+
+def _elegir(pool, descartados):
+    """Toma el endpoint disponible con mejor puntaje y lo marca en vuelo"""
+    ahora = time.monotonic()
+    with _lock:
+        candidatos = [
+            config for config in pool
+            if config["nombre"] not in descartados and _disponible(_estado[config["nombre"]], ahora)
+        ]
+        if not candidatos:
+            return None
+        # Los endpoints sin latencia medida se prueban primero; el empate se rompe al azar
+        elegido = min(candidatos, key=lambda config: (_puntaje(_estado[config["nombre"]]), random.random()))
+        estado = _estado[elegido["nombre"]]
+        if estado["circuito"] == SEMIABIERTO:
+            estado["prueba_en_curso"] = True
+        estado["en_vuelo"] += 1
+        return elegido
+
+# ========== RESULTADOS ==========
+
+def _registrar_exito(nombre, duracion_ms, cuota_restante):
+    with _lock:
+        estado = _estado[nombre]
+        estado["en_vuelo"] -= 1
+        estado["fallos_consecutivos"] = 0
+        if estado["circuito"] != CERRADO:
+            logging.info(f"Circuito de {nombre} cerrado tras una prueba exitosa")
+        estado["circuito"] = CERRADO
+        estado["prueba_en_curso"] = False
+        estado["latencia_ms"] = duracion_ms if estado["latencia_ms"] is None else (
+            LATENCIA_ALFA * duracion_ms + (1 - LATENCIA_ALFA) * estado["latencia_ms"]
+        )
+        if cuota_restante is not None:
+            estado["cuota_restante"] = cuota_restante
+            estado["cuota_maxima"] = max(estado["cuota_maxima"] or 0, cuota_restante)
+    metricas.incrementar(f"openai.{nombre}.exitos")
+    metricas.observar(f"openai.{nombre}.latencia_ms", duracion_ms)
+    _publicar(nombre)
+
+def _registrar_fallo(nombre, motivo, reintentar_en=None):
+    """Cuenta un fallo; abre el circuito tras CIRCUITO_FALLOS seguidos, en una prueba fallida o por cuota agotada"""
+    with _lock:
+        estado = _estado[nombre]
+        estado["en_vuelo"] -= 1
+        estado["fallos_consecutivos"] += 1
+        abrir = (
+            estado["circuito"] == SEMIABIERTO
+            or estado["fallos_consecutivos"] >= CIRCUITO_FALLOS
+            or reintentar_en is not None
+        )
+        nueva_apertura = abrir and estado["circuito"] != ABIERTO
+        if abrir:
+            estado["circuito"] = ABIERTO
+            estado["prueba_en_curso"] = False
+            estado["abierto_hasta"] = time.monotonic() + (reintentar_en or CIRCUITO_ENFRIAMIENTO_SEGUNDOS)
+        if reintentar_en is not None:
+            estado["cuota_restante"] = 0
+    if nueva_apertura:
+        metricas.incrementar(f"openai.{nombre}.aperturas")
+        logging.warning(f"Circuito de {nombre} abierto ({motivo})")
+    metricas.incrementar(f"openai.{nombre}.errores")
+    _publicar(nombre)
+
+def _liberar(nombre):
+    """Libera el endpoint sin contar éxito ni fallo (errores del cliente)"""
+    with _lock:
+        estado = _estado[nombre]
+        estado["en_vuelo"] -= 1
+        estado["prueba_en_curso"] = False
+
+def _publicar(nombre):
+    """Publica la salud del endpoint como indicadores"""
+    with _lock:
+        estado = dict(_estado[nombre])
+    metricas.fijar(f"openai.{nombre}.circuito", estado["circuito"])
+    metricas.fijar(f"openai.{nombre}.latencia_ewma_ms", round(estado["latencia_ms"], 1) if estado["latencia_ms"] is not None else None)
+    metricas.fijar(f"openai.{nombre}.cuota_restante", estado["cuota_restante"])
+    metricas.fijar(f"openai.{nombre}.fallos_consecutivos", estado["fallos_consecutivos"])
+
+def estado_pool():
+    """Salud de todos los endpoints conocidos"""
+    ahora = time.monotonic()
+    with _lock:
+        return {
+            nombre: {
+                "circuito": estado["circuito"],
+                "latencia_ewma_ms": round(estado["latencia_ms"], 1) if estado["latencia_ms"] is not None else None,
+                "en_vuelo": estado["en_vuelo"],
+                "cuota_restante": estado["cuota_restante"],
+                "fallos_consecutivos": estado["fallos_consecutivos"],
+                "reabre_en_segundos": round(max(0.0, estado["abierto_hasta"] - ahora), 1) if estado["circuito"] == ABIERTO else None
+            }
+            for nombre, estado in _estado.items()
+        }
+
+# ========== ENVÍO ==========
+
+def _solicitud(config, operacion):
+    """URL y headers de la operación ("chat/completions" o "embeddings") en un endpoint"""
+    deployment = config["deployment_embeddings"] if operacion == "embeddings" else config["deployment"]
+    api_url = (
+        f"{config['endpoint']}openai/deployments/{deployment}"
+        f"/{operacion}?api-version={config['api_version']}"
+    )
+    return api_url, {"Content-Type": "application/json", "api-key": config["api_key"]}
+
+def _evaluar(nombre, operacion, status, headers, texto, duracion_ms):
+    """
+    Registra el resultado de una respuesta HTTP en el estado del endpoint.
+
+    :return: None si fue exitosa, o el error con el que se intenta el siguiente endpoint.
+    :raises ErrorCliente: Ante un 4xx distinto de 429.
+    """
+    if status == 200:
+        cuota = headers.get("x-ratelimit-remaining-tokens")
+        try:
+            cuota = int(cuota) if cuota is not None else None
+        except ValueError:
+            cuota = None
+        _registrar_exito(nombre, duracion_ms, cuota)
+        return None
+
+    if status == 429:
+        try:
+            reintentar_en = float(headers.get("Retry-After", CIRCUITO_ENFRIAMIENTO_SEGUNDOS))
+        except ValueError:
+            reintentar_en = CIRCUITO_ENFRIAMIENTO_SEGUNDOS
+        _registrar_fallo(nombre, "cuota agotada (429)", reintentar_en)
+    elif status >= 500:
+        _registrar_fallo(nombre, f"HTTP {status}")
+    else:
+        _liberar(nombre)
+        raise ErrorCliente(f"Error Azure OpenAI ({nombre}): {status}, {texto}")
+    return f"{nombre}: {status}, {texto[:200]}"
+
+def _sin_endpoint(errores):
+    metricas.incrementar("openai.sin_endpoint_disponible")
+    if not errores:
+        return Exception("Ningún endpoint de Azure OpenAI disponible (circuitos abiertos)")
+    return Exception(f"Todos los endpoints de Azure OpenAI fallaron: {'; '.join(errores)}")
+
+def _cortada_por_plazo(nombre):
+    """Libera el endpoint de una llamada que cortó el plazo de la solicitud (el endpoint no falló)"""
+    _liberar(nombre)
+    metricas.incrementar("plazos.llamadas_cortadas")
+    return plazos.agotado()
+
+def _enviar(pool, operacion, data, consumir=None):
+    """
+    Envía la operación ("chat/completions" o "embeddings") al mejor endpoint disponible del pool.
+
+    Ante errores 5xx, 429, timeouts o errores de conexión se intenta con el siguiente
+    endpoint; los 4xx restantes se propagan sin reintentar.
+
+    Cada intento espera a lo más lo que queda del plazo de la solicitud (plazos); un timeout
+    recortado por el plazo no cuenta como falla del endpoint y se propaga como PlazoAgotado.
+
+    :param consumir: Si se indica, la respuesta se transmite y `consumir(response)` lee el cuerpo
+                     de la respuesta exitosa (la latencia registrada es la de los encabezados).
+    """
+    descartados = set()
+    errores = []
+
+    while True:
+        timeout = plazos.timeout_llamada(OPENAI_TIMEOUT_SEGUNDOS)
+        config = _elegir(pool, descartados)
+        if config is None:
+            raise _sin_endpoint(errores)
+        nombre = config["nombre"]
+        descartados.add(nombre)
+        api_url, headers = _solicitud(config, operacion)
+
+        inicio = time.perf_counter()
+        try:
+            response = requests.post(
+                api_url, headers=headers, json=data, timeout=timeout, stream=consumir is not None
+            )
+        except requests.Timeout as e:
+            if timeout < OPENAI_TIMEOUT_SEGUNDOS:
+                raise _cortada_por_plazo(nombre)
+            _registrar_fallo(nombre, f"{type(e).__name__}: {str(e)}")
+            errores.append(f"{nombre}: {type(e).__name__}")
+            continue
+        except requests.RequestException as e:
+            _registrar_fallo(nombre, f"{type(e).__name__}: {str(e)}")
+            errores.append(f"{nombre}: {type(e).__name__}")
+            continue
+        duracion_ms = round((time.perf_counter() - inicio) * 1000, 1)
+
+        if consumir is not None and response.status_code == 200:
+            _evaluar(nombre, operacion, 200, response.headers, "", duracion_ms)
+            # Una transmisión iniciada no se reintenta en otro endpoint: parte del texto ya se entregó.
+            # Cerrar la respuesta antes del final cancela la generación.
+            with response:
+                try:
+                    return consumir(response)
+                except requests.RequestException as e:
+                    if plazos.vencido():
+                        raise plazos.agotado()
+                    raise TransmisionInterrumpida(f"Transmisión de {nombre} interrumpida: {type(e).__name__}: {str(e)}")
+
+        error = _evaluar(nombre, operacion, response.status_code, response.headers, response.text, duracion_ms)
+        if error is None:
+            return response.json()
+        errores.append(error)
+
+async def _enviar_async(pool, operacion, data, consumir=None):
+    """Igual que _enviar, con la sesión aiohttp compartida (no bloquea el event loop); `consumir` es una corrutina"""
+    descartados = set()
+    errores = []
+
+    while True:
+        timeout = plazos.timeout_llamada(OPENAI_TIMEOUT_SEGUNDOS)
+        config = _elegir(pool, descartados)
+        if config is None:
+            raise _sin_endpoint(errores)
+        nombre = config["nombre"]
+        descartados.add(nombre)
+        api_url, headers = _solicitud(config, operacion)
+
+        inicio = time.perf_counter()
+        try:
+            async with asincrono.sesion_http().post(
+                api_url, headers=headers, json=data, timeout=aiohttp.ClientTimeout(total=timeout)
+            ) as response:
+                status, headers_respuesta = response.status, response.headers
+                if consumir is None or status != 200:
+                    texto = await response.text()
+                else:
+                    _evaluar(nombre, operacion, 200, headers_respuesta, "", round((time.perf_counter() - inicio) * 1000, 1))
+                    try:
+                        return await consumir(response)
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        if isinstance(e, asyncio.TimeoutError) and timeout < OPENAI_TIMEOUT_SEGUNDOS:
+                            raise plazos.agotado()
+                        raise TransmisionInterrumpida(f"Transmisión de {nombre} interrumpida: {type(e).__name__}: {str(e)}")
+        except asyncio.TimeoutError as e:
+            if timeout < OPENAI_TIMEOUT_SEGUNDOS:
+                raise _cortada_por_plazo(nombre)
+            _registrar_fallo(nombre, f"{type(e).__name__}: {str(e)}")
+            errores.append(f"{nombre}: {type(e).__name__}")
+            continue
+        except aiohttp.ClientError as e:
+            _registrar_fallo(nombre, f"{type(e).__name__}: {str(e)}")
+            errores.append(f"{nombre}: {type(e).__name__}")
+            continue
+        duracion_ms = round((time.perf_counter() - inicio) * 1000, 1)
+
+        error = _evaluar(nombre, operacion, status, headers_respuesta, texto, duracion_ms)
+        if error is None:
+            return json.loads(texto)
+        errores.append(error)
+
+def _cuerpo(messages, max_tokens, temperature, stream=False):
+    datos = {"messages": messages, "max_tokens": max_tokens}
+    # Sin temperatura explícita se usa la del despliegue
+    if temperature is not None:
+        datos["temperature"] = temperature
+    if stream:
+        datos["stream"] = True
+    return datos
+
+def completar(pool, messages, max_tokens, temperature=None):
+    """
+    Envía una chat completion al mejor endpoint disponible del pool.
+
+    :return: Cuerpo JSON de la respuesta.
+    :raises ErrorCliente: Si el endpoint rechaza la solicitud con un 4xx distinto de 429.
+    """
+    return _enviar(pool, "chat/completions", _cuerpo(messages, max_tokens, temperature))
+
+async def completar_async(pool, messages, max_tokens, temperature=None):
+    """Versión asíncrona de completar"""
+    return await _enviar_async(pool, "chat/completions", _cuerpo(messages, max_tokens, temperature))
+
+# ========== TRANSMISIÓN (SSE) ==========
+
+def _nueva_transmision():
+    """Respuesta con la forma de una chat completion, que se llena a medida que llegan los eventos"""
+    return {
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": ""}, "finish_reason": None}],
+        "usage": None,
+        "cancelada": False,
+        "primer_fragmento_ms": None
+    }
+
+def _procesar_evento(respuesta, linea, al_recibir, inicio):
+    """
+    Procesa una línea del stream SSE.
+
+    :return: True si la transmisión terminó ([DONE]) o `al_recibir` pidió cancelarla.
+    """
+    if isinstance(linea, bytes):
+        linea = linea.decode("utf-8")
+    linea = linea.strip()
+    if not linea.startswith("data:"):
+        return False
+    datos = linea[len("data:"):].strip()
+    if datos == "[DONE]":
+        return True
+
+    evento = json.loads(datos)
+    if evento.get("usage"):
+        respuesta["usage"] = evento["usage"]
+    # El primer evento de Azure solo trae los resultados del filtro de contenido (sin choices)
+    for eleccion in evento.get("choices") or []:
+        if eleccion.get("finish_reason"):
+            respuesta["choices"][0]["finish_reason"] = eleccion["finish_reason"]
+        texto = (eleccion.get("delta") or {}).get("content")
+        if not texto:
+            continue
+        if respuesta["primer_fragmento_ms"] is None:
+            respuesta["primer_fragmento_ms"] = round((time.perf_counter() - inicio) * 1000, 1)
+        respuesta["choices"][0]["message"]["content"] += texto
+        if al_recibir(texto):
+            respuesta["cancelada"] = True
+            return True
+    return False
+
+def completar_stream(pool, messages, max_tokens, al_recibir, temperature=None):
+    """
+    Chat completion transmitida: `al_recibir(texto)` se llama con cada fragmento y, si regresa
+    True, se cierra la conexión (el servicio deja de generar).
+
+    :return: Respuesta con la forma de completar(), más "cancelada" y "primer_fragmento_ms".
+             "usage" es None si el servicio no lo envió (p. ej. al cancelar).
+    """
+    inicio = time.perf_counter()
+
+    def consumir(response):
+        respuesta = _nueva_transmision()
+        for linea in response.iter_lines(chunk_size=None):
+            if _procesar_evento(respuesta, linea, al_recibir, inicio):
+                break
+            # El timeout de requests es por lectura: el plazo de la transmisión completa se vigila aquí
+            if plazos.vencido():
+                raise plazos.agotado()
+        return respuesta
+
+    return _enviar(pool, "chat/completions", _cuerpo(messages, max_tokens, temperature, stream=True), consumir)
+
+async def completar_stream_async(pool, messages, max_tokens, al_recibir, temperature=None):
+    """Versión asíncrona de completar_stream"""
+    inicio = time.perf_counter()
+
+    async def consumir(response):
+        respuesta = _nueva_transmision()
+        async for linea in response.content:
+            if _procesar_evento(respuesta, linea, al_recibir, inicio):
+                break
+        if respuesta["cancelada"]:
+            response.close()
+        return respuesta
+
+    return await _enviar_async(pool, "chat/completions", _cuerpo(messages, max_tokens, temperature, stream=True), consumir)
+
+def _vectores(respuesta):
+    datos = sorted(respuesta["data"], key=lambda d: d["index"])
+    return [d["embedding"] for d in datos], respuesta.get("usage")
+
+def embeber(pool, textos):
+    """
+    Calcula los embeddings de una lista de textos con el despliegue de embeddings del pool
+    (con su propio estado por endpoint, ver pool_embeddings).
+
+    :return: Tupla (lista de vectores en el orden de `textos`, usage).
+    :raises ErrorCliente: Si el endpoint rechaza la solicitud con un 4xx distinto de 429.
+    """
+    return _vectores(_enviar(pool_embeddings(pool), "embeddings", {"input": textos}))
+
+async def embeber_async(pool, textos):
+    """Versión asíncrona de embeber"""
+    return _vectores(await _enviar_async(pool_embeddings(pool), "embeddings", {"input": textos}))
@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+import logging
+
+from propia import metricas
+
+# Tiempo que un resultado completado se sirve desde memoria
+IDEMPOTENCIA_TTL_SEGUNDOS = int(os.getenv("IDEMPOTENCIA_TTL_SEGUNDOS", "600"))
+# Tiempo máximo que una solicitud duplicada espera al trabajo en vuelo
+IDEMPOTENCIA_ESPERA_SEGUNDOS = int(os.getenv("IDEMPOTENCIA_ESPERA_SEGUNDOS", "300"))
+IDEMPOTENCIA_MAX_RESULTADOS = int(os.getenv("IDEMPOTENCIA_MAX_RESULTADOS", "500"))
+
+_lock = threading.Lock()
+# clave -> {"evento", "huella", "resultado", "error"}
+_en_vuelo = {}
+# clave -> {"huella", "resultado", "expira"}
+_resultados = {}
+
+
+class ConflictoIdempotencia(Exception):
+    """La misma Idempotency-Key se reutilizó con un cuerpo distinto"""
+
+
+# ========== CLAVES ==========
+
+def calcular_huella(prompt_completo, placeholders_personalizados=None, seleccion_plantilla=None):
+    """Calcula la huella del contenido de una solicitud de propuesta"""
+    contenido = json.dumps(
+        {
+            "prompt": prompt_completo.strip(),
+            "placeholders": placeholders_personalizados or {},
+            "plantilla": seleccion_plantilla or {}
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str
+    )
+    return hashlib.sha256(contenido.encode('utf-8')).hexdigest()
+
+def obtener_clave(req, huella):
+    """Usa el header Idempotency-Key si existe; si no, la huella del contenido"""
+    clave_header = req.headers.get('Idempotency-Key') if req.headers else None
+    if clave_header and clave_header.strip():
+        return f"key:{clave_header.strip()}"
+    return f"hash:{huella}"
+
+# ========== ALMACÉN DE RESULTADOS ==========
+
+def _purgar_expirados(ahora):
+    """Elimina resultados vencidos y recorta el almacén al tamaño máximo"""
+    for clave in [c for c, r in _resultados.items() if r["expira"] <= ahora]:
+        del _resultados[clave]
+
+    if len(_resultados) > IDEMPOTENCIA_MAX_RESULTADOS:
+        sobrantes = sorted(_resultados.items(), key=lambda item: item[1]["expira"])
+        for clave, _ in sobrantes[:len(_resultados) - IDEMPOTENCIA_MAX_RESULTADOS]:
+            del _resultados[clave]
+
+def _registrar_origen(origen):
+    """Actualiza los contadores y la tasa de deduplicación"""
+    metricas.incrementar(f"idempotencia.{origen}")
+    total = sum(metricas.leer_contador(f"idempotencia.{o}") for o in ("nuevo", "en_vuelo", "almacenado"))
+    duplicados = metricas.leer_contador("idempotencia.en_vuelo") + metricas.leer_contador("idempotencia.almacenado")
+    metricas.fijar("idempotencia.tasa_deduplicacion", round(duplicados / total, 4) if total else 0.0)
+
+# ========== EJECUCIÓN ÚNICA ==========
+
+def _reservar(clave, huella):
+    """
+    Determina el papel de la solicitud para la clave.
+
+    :return: Tupla ("almacenado", resultado), ("en_vuelo", trabajo) o ("nuevo", trabajo).
+    """
+    with _lock:
+        ahora = time.monotonic()
+        _purgar_expirados(ahora)
+
+        almacenado = _resultados.get(clave)
+        if almacenado:
+            if almacenado["huella"] != huella:
+                raise ConflictoIdempotencia("La Idempotency-Key ya se usó con un contenido distinto")
+            _registrar_origen("almacenado")
+            return "almacenado", almacenado["resultado"]
+
+        trabajo = _en_vuelo.get(clave)
+        if trabajo:
+            if trabajo["huella"] != huella:
+                raise ConflictoIdempotencia("La Idempotency-Key ya se usó con un contenido distinto")
+            logging.info(f"Solicitud duplicada adjuntada al trabajo en vuelo {clave}")
+            _registrar_origen("en_vuelo")
+            return "en_vuelo", trabajo
+
+        trabajo = {"evento": threading.Event(), "huella": huella, "resultado": None, "error": None}
+        _en_vuelo[clave] = trabajo
+    _registrar_origen("nuevo")
+    return "nuevo", trabajo
+
+def _esperar(trabajo):
+    """Espera el trabajo en vuelo de otra solicitud y regresa su resultado"""
+    if not trabajo["evento"].wait(IDEMPOTENCIA_ESPERA_SEGUNDOS):
+        raise Exception("Tiempo de espera agotado esperando el trabajo en vuelo")
+    if trabajo["error"] is not None:
+        raise trabajo["error"]
+    return trabajo["resultado"]
+
+def _almacenable(resultado):
+    """
+    Solo se almacena una propuesta terminada: con URL firmada y sin secciones pendientes. Una
+    propuesta sin URL (falló la firma) o parcial (se agotó el plazo) se trata como un error.
+    """
+    url = resultado.get("url", resultado.get("url_presignada"))
+    return bool(url) and resultado.get("status") != "partial" and not resultado.get("placeholders_pendientes")
+
+def _terminar(clave, huella, trabajo, resultado=None, error=None):
+    """Publica el resultado (o el error, que no se almacena) a las solicitudes adjuntas"""
+    if error is None:
+        trabajo["resultado"] = resultado
+        if _almacenable(resultado):
+            with _lock:
+                _resultados[clave] = {
+                    "huella": huella,
+                    "resultado": resultado,
+                    "expira": time.monotonic() + IDEMPOTENCIA_TTL_SEGUNDOS
+                }
+        else:
+            # Las solicitudes adjuntas reciben el resultado, pero un reintento posterior vuelve a ejecutar
+            metricas.incrementar("idempotencia.no_almacenado")
+    else:
+        # Los errores no se almacenan: un reintento posterior vuelve a ejecutar
+        trabajo["error"] = error
+    with _lock:
+        _en_vuelo.pop(clave, None)
+    trabajo["evento"].set()
+
+def ejecutar_una_vez(clave, huella, funcion):
+    """
+    Ejecuta `funcion` una sola vez por clave.
+
+    Las solicitudes concurrentes con la misma clave se adjuntan al trabajo en vuelo
+    y las posteriores reciben el resultado almacenado mientras no expire.
+
+    :return: Tupla (resultado, origen) con origen "nuevo", "en_vuelo" o "almacenado".
+    """
+    origen, valor = _reservar(clave, huella)
+    if origen == "almacenado":
+        return valor, origen
+    if origen == "en_vuelo":
+        return _esperar(valor), origen
+
+    try:
+        resultado = funcion()
+    except BaseException as e:
+        _terminar(clave, huella, valor, error=e)
+        raise
+    _terminar(clave, huella, valor, resultado=resultado)
+    return resultado, "nuevo"
+
+async def ejecutar_una_vez_async(clave, huella, corrutina):
+    """
+    Versión asíncrona de ejecutar_una_vez: `corrutina` es una función sin argumentos que
+    regresa la corrutina a ejecutar. Comparte el estado con la versión síncrona.
+    """
+    origen, valor = _reservar(clave, huella)
+    if origen == "almacenado":
+        return valor, origen
+    if origen == "en_vuelo":
+        # Los duplicados son poco frecuentes: la espera ocupa un hilo del executor por defecto
+        return await asyncio.get_running_loop().run_in_executor(None, _esperar, valor), origen
+
+    try:
+        resultado = await corrutina()
+    except BaseException as e:
+        _terminar(clave, huella, valor, error=e)
+        raise
+    _terminar(clave, huella, valor, resultado=resultado)
+    return resultado, "nuevo"
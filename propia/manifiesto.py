@@ -0,0 +1,436 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import logging
+from datetime import datetime, timezone
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotFoundError, ResourceExistsError, HttpResponseError
+from azure.storage.blob import StorageErrorCode
+
+from propia import metricas
+
+# El manifiesto es un append blob JSONL (fuente de verdad compartida entre instancias)
+# indexado localmente en SQLite para consultas filtradas, ordenadas y paginadas
+MANIFIESTO_BLOB_NAME = os.getenv("MANIFIESTO_BLOB_NAME", "propuestas/manifiesto.jsonl")
+# Segundos entre sincronizaciones del índice local con el blob
+MANIFIESTO_TTL_SYNC = int(os.getenv("MANIFIESTO_TTL_SYNC", "15"))
+# Bloques máximos de un append blob (límite de Azure Storage); cada registro es un bloque. Al
+# llenarse un segmento se sigue en manifiesto.1.jsonl, manifiesto.2.jsonl, ...
+MANIFIESTO_MAX_BLOQUES = 50000
+
+COLUMNAS_ORDEN = {"creado", "empresa", "titulo", "size_bytes", "duracion_ms", "tokens_total"}
+
+_lock = threading.Lock()
+_conexion = None
+# contenedor -> {"segmento", "offset", "ultima_sync"}
+_estado_sync = {}
+# contenedor -> segmento donde se agregan los registros nuevos
+_segmento_escritura = {}
+
+def nombre_segmento(numero):
+    """Blob del segmento `numero` del manifiesto: el 0 es MANIFIESTO_BLOB_NAME"""
+    if numero == 0:
+        return MANIFIESTO_BLOB_NAME
+    base, extension = os.path.splitext(MANIFIESTO_BLOB_NAME)
+    return f"{base}.{numero}{extension}"
+
+# ========== ÍNDICE LOCAL ==========
+
+def _obtener_conexion():
+    """Crea (una vez) el índice SQLite en memoria del proceso"""
+    global _conexion
+    if _conexion is None:
+        _conexion = sqlite3.connect(":memory:", check_same_thread=False)
+        _conexion.execute("""
+            CREATE TABLE IF NOT EXISTS propuestas (
+                contenedor TEXT NOT NULL,
+                document_id TEXT NOT NULL,
+                filename TEXT,
+                blob_name TEXT,
+                empresa TEXT,
+                titulo TEXT,
+                fecha TEXT,
+                creado TEXT,
+                size_bytes INTEGER,
+                plantilla TEXT,
+                plantilla_etag TEXT,
+                duracion_ms REAL,
+                tokens_total INTEGER,
+                registro TEXT,
+                PRIMARY KEY (contenedor, document_id)
+            )
+        """)
+        _conexion.execute("CREATE INDEX IF NOT EXISTS idx_empresa ON propuestas (contenedor, empresa)")
+        _conexion.execute("CREATE INDEX IF NOT EXISTS idx_creado ON propuestas (contenedor, creado)")
+    return _conexion
+
+def _indexar(contenedor, registro):
+    """Inserta o reemplaza un registro en el índice local (se llama con _lock tomado)"""
+    plantilla = registro.get("plantilla") or {}
+    _obtener_conexion().execute(
+        """
+        INSERT OR REPLACE INTO propuestas
+            (contenedor, document_id, filename, blob_name, empresa, titulo, fecha, creado,
+             size_bytes, plantilla, plantilla_etag, duracion_ms, tokens_total, registro)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
+            contenedor,
+            registro["document_id"],
+            registro.get("filename"),
+            registro.get("blob_name"),
+            registro.get("empresa"),
+            registro.get("titulo"),
+            registro.get("fecha"),
+            registro.get("creado"),
+            registro.get("size_bytes"),
+            plantilla.get("nombre"),
+            plantilla.get("etag"),
+            (registro.get("tiempos") or {}).get("duracion_total_ms"),
+            (registro.get("tokens") or {}).get("total_tokens"),
+            json.dumps(registro, ensure_ascii=False)
+        )
+    )
+
+# ========== SINCRONIZACIÓN CON BLOB STORAGE ==========
+
+def _pendiente_sync(contenedor, forzar):
+    """Regresa (estado, ahora) si toca sincronizar el contenedor, o None si el índice está vigente"""
+    ahora = time.monotonic()
+    with _lock:
+        estado = _estado_sync.setdefault(contenedor, {"segmento": 0, "offset": 0, "ultima_sync": None})
+        if not forzar and estado["ultima_sync"] is not None and ahora - estado["ultima_sync"] < MANIFIESTO_TTL_SYNC:
+            return None
+        return estado, ahora
+
+def _posicion(estado):
+    """Segmento y offset hasta donde el índice ya leyó el manifiesto"""
+    with _lock:
+        return estado["segmento"], estado["offset"]
+
+def _reiniciar_indice(contenedor, estado, segmento, offset):
+    """El manifiesto se recreó: reconstruir el índice completo desde el primer segmento"""
+    with _lock:
+        # Otra sincronización avanzó desde que se leyó la posición: no es una recreación
+        if (estado["segmento"], estado["offset"]) != (segmento, offset):
+            return
+        logging.warning("El manifiesto es más pequeño que el offset local; se reconstruye el índice")
+        _obtener_conexion().execute("DELETE FROM propuestas WHERE contenedor = ?", (contenedor,))
+        estado["segmento"], estado["offset"] = 0, 0
+
+def _aplicar_sync(contenedor, estado, segmento, offset, nuevos):
+    """
+    Indexa las líneas completas leídas desde (segmento, offset) y avanza el offset.
+
+    Varias sincronizaciones del mismo contenedor pueden correr a la vez (hilos o handlers async);
+    solo avanza la primera que aplica su lectura desde esa posición, las demás la descartan.
+    """
+    # Solo se consumen líneas completas; un append en curso se leerá en la siguiente sincronización
+    consumidos = nuevos.rfind(b"\n") + 1
+    registros = []
+    for linea in nuevos[:consumidos].splitlines():
+        if linea.strip():
+            try:
+                registros.append(json.loads(linea))
+            except ValueError:
+                logging.warning(f"Línea inválida en el manifiesto: {linea[:200]!r}")
+
+    with _lock:
+        if (estado["segmento"], estado["offset"]) != (segmento, offset):
+            metricas.incrementar("manifiesto.sync_descartada")
+            return
+        for registro in registros:
+            if registro.get("document_id"):
+                _indexar(contenedor, registro)
+        estado["offset"] = offset + consumidos
+        _obtener_conexion().commit()
+
+    if registros:
+        metricas.incrementar("manifiesto.registros_sincronizados", len(registros))
+
+def _siguiente_segmento(estado, segmento, propiedades):
+    """
+    Pasa al siguiente segmento si el actual está lleno y ya se leyó completo.
+
+    :return: True si hay otro segmento por leer.
+    """
+    lleno = (getattr(propiedades, "append_blob_committed_block_count", None) or 0) >= MANIFIESTO_MAX_BLOQUES
+    with _lock:
+        if estado["segmento"] != segmento:
+            # Otra sincronización ya pasó al siguiente segmento
+            return True
+        if not lleno or estado["offset"] < propiedades.size:
+            return False
+        estado["segmento"] += 1
+        estado["offset"] = 0
+    return True
+
+def _terminar_sync(estado, ahora):
+    with _lock:
+        estado["ultima_sync"] = ahora
+
+def sincronizar(container_client, forzar=False):
+    """Lee de los segmentos del manifiesto solo los registros nuevos desde el último offset"""
+    contenedor = container_client.container_name
+    pendiente = _pendiente_sync(contenedor, forzar)
+    if pendiente is None:
+        return
+    estado, ahora = pendiente
+
+    while True:
+        segmento, offset = _posicion(estado)
+        blob_client = container_client.get_blob_client(nombre_segmento(segmento))
+        try:
+            propiedades = blob_client.get_blob_properties()
+        except ResourceNotFoundError:
+            break
+        if propiedades.size < offset:
+            _reiniciar_indice(contenedor, estado, segmento, offset)
+            continue
+        longitud = propiedades.size - offset
+        if longitud > 0:
+            nuevos = blob_client.download_blob(offset=offset, length=longitud).readall()
+            _aplicar_sync(contenedor, estado, segmento, offset, nuevos)
+        if not _siguiente_segmento(estado, segmento, propiedades):
+            break
+    _terminar_sync(estado, ahora)
+
+async def sincronizar_async(container_client, forzar=False):
+    """Versión de sincronizar para un ContainerClient de azure.storage.blob.aio"""
+    contenedor = container_client.container_name
+    pendiente = _pendiente_sync(contenedor, forzar)
+    if pendiente is None:
+        return
+    estado, ahora = pendiente
+
+    while True:
+        segmento, offset = _posicion(estado)
+        blob_client = container_client.get_blob_client(nombre_segmento(segmento))
+        try:
+            propiedades = await blob_client.get_blob_properties()
+        except ResourceNotFoundError:
+            break
+        if propiedades.size < offset:
+            _reiniciar_indice(contenedor, estado, segmento, offset)
+            continue
+        longitud = propiedades.size - offset
+        if longitud > 0:
+            descarga = await blob_client.download_blob(offset=offset, length=longitud)
+            _aplicar_sync(contenedor, estado, segmento, offset, await descarga.readall())
+        if not _siguiente_segmento(estado, segmento, propiedades):
+            break
+    _terminar_sync(estado, ahora)
+
+def construir_registro(document_id, filename, blob_name, info_empresa, transferencia, plantilla, tiempos, **extra):
+    """Arma el registro del manifiesto con los datos de una propuesta recién generada"""
+    registro = {
+        "document_id": document_id,
+        "filename": filename,
+        "blob_name": blob_name,
+        "empresa": info_empresa.get("empresa"),
+        "titulo": info_empresa.get("titulo"),
+        "fecha": info_empresa.get("fecha"),
+        "creado": datetime.now(timezone.utc).isoformat(),
+        "size_bytes": (transferencia or {}).get("bytes"),
+        "etag": (transferencia or {}).get("etag"),
+        "plantilla": plantilla,
+        "tiempos": {
+            "duracion_total_ms": (tiempos or {}).get("duracion_total_ms"),
+            "etapa_limitante": (tiempos or {}).get("etapa_limitante"),
+            "etapas_ms": {nombre: t["duracion_ms"] for nombre, t in ((tiempos or {}).get("etapas") or {}).items()}
+        }
+    }
+    registro.update(extra)
+    return registro
+
+def _linea(registro):
+    registro = dict(registro)
+    registro.setdefault("creado", datetime.now(timezone.utc).isoformat())
+    return registro, (json.dumps(registro, ensure_ascii=False) + "\n").encode("utf-8")
+
+def _registrado(contenedor, registro):
+    with _lock:
+        _indexar(contenedor, registro)
+        _obtener_conexion().commit()
+    metricas.incrementar("manifiesto.registros_escritos")
+
+def _error_registro(registro, error):
+    metricas.incrementar("manifiesto.errores")
+    logging.error(f"Error registrando la propuesta {registro.get('document_id')} en el manifiesto: {str(error)}")
+
+def _segmento_actual(contenedor):
+    """Segmento donde escribir: el último conocido por esta instancia al escribir o sincronizar"""
+    with _lock:
+        return max(_segmento_escritura.get(contenedor, 0), (_estado_sync.get(contenedor) or {}).get("segmento", 0))
+
+def _segmento_lleno(contenedor, segmento, error):
+    """
+    Indica si el error es el límite de bloques del append blob; en ese caso los registros
+    siguientes van al segmento que sigue.
+    """
+    if not isinstance(error, HttpResponseError) or error.error_code != StorageErrorCode.BLOCK_COUNT_EXCEEDS_LIMIT:
+        return False
+    with _lock:
+        _segmento_escritura[contenedor] = max(_segmento_escritura.get(contenedor, 0), segmento + 1)
+    metricas.incrementar("manifiesto.segmentos_llenos")
+    logging.info(f"Segmento del manifiesto lleno: {nombre_segmento(segmento)}; se continúa en {nombre_segmento(segmento + 1)}")
+    return True
+
+def registrar_propuesta(container_client, registro):
+    """
+    Agrega el registro de una propuesta al manifiesto (append blob) y al índice local.
+
+    Los errores se registran en el log sin interrumpir la generación del documento.
+    """
+    registro, linea = _linea(registro)
+    contenedor = container_client.container_name
+
+    try:
+        segmento = _segmento_actual(contenedor)
+        while True:
+            blob_client = container_client.get_blob_client(nombre_segmento(segmento))
+            try:
+                try:
+                    blob_client.append_block(linea)
+                except ResourceNotFoundError:
+                    try:
+                        blob_client.create_append_blob(match_condition=MatchConditions.IfMissing)
+                    except ResourceExistsError:
+                        pass  # Otra instancia lo creó primero
+                    blob_client.append_block(linea)
+                break
+            except HttpResponseError as e:
+                if not _segmento_lleno(contenedor, segmento, e):
+                    raise
+                segmento += 1
+        _registrado(contenedor, registro)
+    except Exception as e:
+        _error_registro(registro, e)
+
+    return registro
+
+async def registrar_propuesta_async(container_client, registro):
+    """Versión de registrar_propuesta para un ContainerClient de azure.storage.blob.aio"""
+    registro, linea = _linea(registro)
+    contenedor = container_client.container_name
+
+    try:
+        segmento = _segmento_actual(contenedor)
+        while True:
+            blob_client = container_client.get_blob_client(nombre_segmento(segmento))
+            try:
+                try:
+                    await blob_client.append_block(linea)
+                except ResourceNotFoundError:
+                    try:
+                        await blob_client.create_append_blob(match_condition=MatchConditions.IfMissing)
+                    except ResourceExistsError:
+                        pass  # Otra instancia lo creó primero
+                    await blob_client.append_block(linea)
+                break
+            except HttpResponseError as e:
+                if not _segmento_lleno(contenedor, segmento, e):
+                    raise
+                segmento += 1
+        _registrado(contenedor, registro)
+    except Exception as e:
+        _error_registro(registro, e)
+
+    return registro
+
+# ========== CONSULTAS ==========
+
+def consultar(container_client, empresa=None, desde=None, hasta=None, orden="creado", descendente=True,
+              limite=50, pagina=1):
+    """
+    Consulta el índice de propuestas.
+
+    :param empresa: Filtro por nombre de empresa (contiene, sin distinguir mayúsculas).
+    :param desde: Fecha ISO mínima de creación (inclusive).
+    :param hasta: Fecha ISO máxima de creación (inclusive; 'YYYY-MM-DD' incluye todo el día).
+    :return: Tupla (total de coincidencias, registros de la página solicitada).
+    """
+    sincronizar(container_client)
+    return _consultar_indice(container_client.container_name, empresa, desde, hasta, orden, descendente, limite, pagina)
+
+async def consultar_async(container_client, empresa=None, desde=None, hasta=None, orden="creado", descendente=True,
+                          limite=50, pagina=1):
+    """Versión de consultar para un ContainerClient de azure.storage.blob.aio"""
+    await sincronizar_async(container_client)
+    return _consultar_indice(container_client.container_name, empresa, desde, hasta, orden, descendente, limite, pagina)
+
+def _consultar_indice(contenedor, empresa, desde, hasta, orden, descendente, limite, pagina):
+    if orden not in COLUMNAS_ORDEN:
+        raise ValueError(f"Orden no soportado: {orden}. Opciones: {sorted(COLUMNAS_ORDEN)}")
+    limite = max(1, min(int(limite), 500))
+    pagina = max(1, int(pagina))
+
+    condiciones = ["contenedor = ?"]
+    parametros = [contenedor]
+    if empresa:
+        condiciones.append("empresa LIKE ? COLLATE NOCASE")
+        parametros.append(f"%{empresa}%")
+    if desde:
+        condiciones.append("creado >= ?")
+        parametros.append(desde)
+    if hasta:
+        condiciones.append("creado <= ?")
+        parametros.append(hasta + "T23:59:59.999999+00:00" if len(hasta) == 10 else hasta)
+    where = " AND ".join(condiciones)
+
+    with _lock:
+        conexion = _obtener_conexion()
+        total = conexion.execute(f"SELECT COUNT(*) FROM propuestas WHERE {where}", parametros).fetchone()[0]
+        filas = conexion.execute(
+            f"SELECT registro FROM propuestas WHERE {where} "
+            f"ORDER BY {orden} {'DESC' if descendente else 'ASC'}, document_id LIMIT ? OFFSET ?",
+            parametros + [limite, (pagina - 1) * limite]
+        ).fetchall()
+
+    return total, [json.loads(fila[0]) for fila in filas]
+
+def buscar_por_id(container_client, document_id):
+    """Regresa el registro de una propuesta por su document_id, o None"""
+    sincronizar(container_client)
+    return _buscar_indice(container_client.container_name, document_id)
+
+async def buscar_por_id_async(container_client, document_id):
+    """Versión de buscar_por_id para un ContainerClient de azure.storage.blob.aio"""
+    await sincronizar_async(container_client)
+    return _buscar_indice(container_client.container_name, document_id)
+
+def _buscar_indice(contenedor, document_id):
+    with _lock:
+        fila = _obtener_conexion().execute(
+            "SELECT registro FROM propuestas WHERE contenedor = ? AND document_id = ?",
+            (contenedor, document_id)
+        ).fetchone()
+    return json.loads(fila[0]) if fila else None
+
+def reindexar_desde_blobs(container_client, prefijo, parsear_nombre):
+    """
+    Agrega al manifiesto los .docx bajo `prefijo` generados antes de que existiera.
+
+    :param parsear_nombre: Función nombre_archivo -> dict parcial (document_id, empresa, ...) o None.
+    :return: Número de registros agregados.
+    """
+    sincronizar(container_client, forzar=True)
+    agregados = 0
+    for blob in container_client.list_blobs(name_starts_with=prefijo):
+        if not blob.name.endswith('.docx'):
+            continue
+        datos = parsear_nombre(blob.name[len(prefijo):])
+        if not datos or not datos.get("document_id") or buscar_por_id(container_client, datos["document_id"]):
+            continue
+        registrar_propuesta(container_client, dict(
+            datos,
+            filename=blob.name[len(prefijo):],
+            blob_name=blob.name,
+            size_bytes=blob.size,
+            creado=blob.last_modified.isoformat() if blob.last_modified else None,
+            reindexado=True
+        ))
+        agregados += 1
+    return agregados
@@ -0,0 +1,66 @@
+import threading
+from collections import defaultdict, deque
+
+# Número máximo de observaciones que se conservan por métrica
+MAX_OBSERVACIONES = 1000
+
+_lock = threading.Lock()
+_contadores = defaultdict(int)
+_indicadores = {}
+_observaciones = defaultdict(lambda: deque(maxlen=MAX_OBSERVACIONES))
+
+# ========== REGISTRO DE MÉTRICAS ==========
+
+def incrementar(nombre, valor=1):
+    """Incrementa un contador acumulado"""
+    with _lock:
+        _contadores[nombre] += valor
+
+def fijar(nombre, valor):
+    """Fija el valor actual de un indicador (gauge)"""
+    with _lock:
+        _indicadores[nombre] = valor
+
+def observar(nombre, valor):
+    """Registra una observación (latencias, tamaños) para calcular percentiles"""
+    with _lock:
+        _observaciones[nombre].append(valor)
+
+def leer_contador(nombre):
+    """Regresa el valor actual de un contador"""
+    with _lock:
+        return _contadores.get(nombre, 0)
+
+def _percentil(valores_ordenados, p):
+    """Percentil por rango más cercano sobre una lista ya ordenada"""
+    if not valores_ordenados:
+        return None
+    indice = max(0, min(len(valores_ordenados) - 1, int(round(p / 100.0 * len(valores_ordenados))) - 1))
+    return valores_ordenados[indice]
+
+def resumir(valores):
+    """Resume una serie de observaciones en conteo, promedio y percentiles"""
+    ordenados = sorted(valores)
+    if not ordenados:
+        return {"conteo": 0}
+    return {
+        "conteo": len(ordenados),
+        "promedio": round(sum(ordenados) / len(ordenados), 4),
+        "p50": _percentil(ordenados, 50),
+        "p95": _percentil(ordenados, 95),
+        "p99": _percentil(ordenados, 99),
+        "max": ordenados[-1]
+    }
+
+def instantanea():
+    """Regresa una copia serializable de todas las métricas del proceso"""
+    with _lock:
+        contadores = dict(_contadores)
+        indicadores = dict(_indicadores)
+        observaciones = {nombre: list(valores) for nombre, valores in _observaciones.items()}
+
+    return {
+        "contadores": contadores,
+        "indicadores": indicadores,
+        "observaciones": {nombre: resumir(valores) for nombre, valores in observaciones.items()}
+    }
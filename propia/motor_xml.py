@@ -0,0 +1,248 @@
+import io
+import re
+import copy
+import time
+import zipfile
+import logging
+from xml.sax.saxutils import escape
+from lxml import etree
+
+from propia import metricas
+
+# Motor de render que trabaja directamente sobre word/document.xml, sin el modelo de python-docx.
+#
+# Al compilar la plantilla se normalizan los placeholders partidos en varios runs (cada
+# placeholder queda solo en un run que conserva su formato) y el XML se serializa una vez en
+# segmentos de bytes. Renderizar es concatenar segmentos con el contenido escapado y agregarlo
+# a un zip base que ya contiene el resto de las partes comprimidas.
+
+PARTE_DOCUMENTO = "word/document.xml"
+W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+XML_SPACE = "{http://www.w3.org/XML/1998/namespace}space"
+DECLARACION_XML = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\r\n'
+
+# Caracteres de control que no son válidos en XML 1.0
+CARACTERES_INVALIDOS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+# Marca de posición de cada placeholder en el XML serializado (caracteres de uso privado)
+MARCA = re.compile('\\ue000(\\d+)\\ue001')
+
+# ========== COMPILACIÓN ==========
+
+def _parrafo_de(elemento):
+    """Párrafo (w:p) más cercano que contiene al elemento"""
+    for ancestro in elemento.iterancestors(W + "p"):
+        return ancestro
+    return None
+
+def _textos_del_parrafo(parrafo):
+    """w:t de los runs propios del párrafo (excluye párrafos anidados en cuadros de texto)"""
+    return [
+        t for t in parrafo.iter(W + "t")
+        if t.getparent() is not None and t.getparent().tag == W + "r" and _parrafo_de(t) is parrafo
+    ]
+
+def _aislado(t, placeholder):
+    """Indica si el placeholder ya ocupa solo un run (únicamente w:rPr y su w:t)"""
+    run = t.getparent()
+    hijos = [hijo for hijo in run if hijo.tag != W + "rPr"]
+    return t.text == placeholder and hijos == [t]
+
+def _nuevo_run(run, texto):
+    """Run con el mismo formato (w:rPr) que `run` y un solo w:t"""
+    nuevo = etree.Element(run.tag, nsmap=run.nsmap)
+    propiedades = run.find(W + "rPr")
+    if propiedades is not None:
+        nuevo.append(copy.deepcopy(propiedades))
+    t = etree.SubElement(nuevo, W + "t")
+    t.text = texto
+    t.set(XML_SPACE, "preserve")
+    return nuevo
+
+def _aislar(textos, texto_completo, inicio, fin):
+    """
+    Deja el placeholder texto_completo[inicio:fin] solo en un run con el formato del run
+    donde empieza; el texto de los runs siguientes que formaba parte del placeholder se elimina.
+    """
+    # Ubicar los w:t donde empieza y termina el placeholder
+    posicion = 0
+    ubicaciones = []
+    for t in textos:
+        longitud = len(t.text or "")
+        ubicaciones.append((t, posicion, posicion + longitud))
+        posicion += longitud
+
+    primero = next(i for i, (_, a, b) in enumerate(ubicaciones) if a <= inicio < b)
+    ultimo = next(i for i, (_, a, b) in enumerate(ubicaciones) if a < fin <= b)
+
+    # Quitar el resto del placeholder de los w:t siguientes
+    for t, a, b in ubicaciones[primero + 1:ultimo + 1]:
+        t.text = (t.text or "")[max(0, fin - a):] if b > fin else ""
+        if not t.text:
+            run = t.getparent()
+            run.remove(t)
+            if all(hijo.tag == W + "rPr" for hijo in run):
+                run.getparent().remove(run)
+
+    # Partir el run inicial en: antes, placeholder, después (mismo formato)
+    t, a, _ = ubicaciones[primero]
+    run = t.getparent()
+    texto = t.text or ""
+    antes = texto[:inicio - a]
+    despues = texto[fin - a:] if ultimo == primero else ""
+    hijos = list(run)
+    indice_t = hijos.index(t)
+
+    previo = etree.Element(run.tag, nsmap=run.nsmap)
+    siguiente = etree.Element(run.tag, nsmap=run.nsmap)
+    propiedades = run.find(W + "rPr")
+    for destino in (previo, siguiente):
+        if propiedades is not None:
+            destino.append(copy.deepcopy(propiedades))
+    for hijo in hijos[:indice_t]:
+        if hijo.tag != W + "rPr":
+            previo.append(hijo)
+    if antes:
+        _agregar_texto(previo, antes)
+    if despues:
+        _agregar_texto(siguiente, despues)
+    for hijo in hijos[indice_t + 1:]:
+        siguiente.append(hijo)
+
+    padre = run.getparent()
+    posicion_run = padre.index(run)
+    padre.remove(run)
+    nuevos = [
+        r for r in (previo, _nuevo_run(run, texto_completo[inicio:fin]), siguiente)
+        if any(hijo.tag != W + "rPr" for hijo in r)
+    ]
+    for desplazamiento, nuevo in enumerate(nuevos):
+        padre.insert(posicion_run + desplazamiento, nuevo)
+
+def _agregar_texto(run, texto):
+    t = etree.SubElement(run, W + "t")
+    t.text = texto
+    t.set(XML_SPACE, "preserve")
+
+def normalizar(raiz, patron):
+    """Aísla cada placeholder de todos los párrafos (cuerpo, tablas y cuadros de texto) en su propio run"""
+    for parrafo in list(raiz.iter(W + "p")):
+        while True:
+            textos = _textos_del_parrafo(parrafo)
+            texto_completo = "".join(t.text or "" for t in textos)
+            if "[" not in texto_completo:
+                break
+            pendiente = None
+            for coincidencia in patron.finditer(texto_completo):
+                inicio, fin = coincidencia.span()
+                posicion = 0
+                for t in textos:
+                    longitud = len(t.text or "")
+                    if posicion == inicio and longitud == fin - inicio and _aislado(t, coincidencia.group()):
+                        break
+                    posicion += longitud
+                else:
+                    pendiente = (inicio, fin)
+                    break
+            if pendiente is None:
+                break
+            _aislar(textos, texto_completo, pendiente[0], pendiente[1])
+
+def compilar(contenido_docx, patron):
+    """
+    Compila una plantilla .docx para el motor XML.
+
+    :param contenido_docx: Bytes o stream del .docx.
+    :param patron: Expresión regular de placeholders.
+    :return: Diccionario con los segmentos del documento, los placeholders y el zip base.
+    """
+    inicio = time.perf_counter()
+    if isinstance(contenido_docx, bytes):
+        contenido_docx = io.BytesIO(contenido_docx)
+
+    with zipfile.ZipFile(contenido_docx) as paquete:
+        raiz = etree.fromstring(paquete.read(PARTE_DOCUMENTO))
+
+        normalizar(raiz, patron)
+
+        # Reemplazar cada placeholder aislado por una marca numerada antes de serializar
+        ranuras = []
+        for t in raiz.iter(W + "t"):
+            if t.text and patron.fullmatch(t.text) and _aislado(t, t.text):
+                t.set(XML_SPACE, "preserve")
+                ranuras.append(t.text)
+                t.text = f"\ue000{len(ranuras) - 1}\ue001"
+
+        prefijo = raiz.prefix or "w"
+        xml = DECLARACION_XML + etree.tostring(raiz, encoding="unicode")
+        partes = MARCA.split(xml)
+        segmentos = [parte.encode("utf-8") if i % 2 == 0 else ranuras[int(parte)] for i, parte in enumerate(partes)]
+
+        # Zip base con todas las partes excepto el documento, comprimido una sola vez
+        base = io.BytesIO()
+        with zipfile.ZipFile(base, "w", zipfile.ZIP_DEFLATED) as salida:
+            for info in paquete.infolist():
+                if info.filename != PARTE_DOCUMENTO:
+                    salida.writestr(info, paquete.read(info.filename), compress_type=zipfile.ZIP_DEFLATED)
+
+    conteo = {}
+    for placeholder in ranuras:
+        conteo[placeholder] = conteo.get(placeholder, 0) + 1
+
+    duracion_ms = round((time.perf_counter() - inicio) * 1000, 1)
+    metricas.observar("motor_xml.compilacion_ms", duracion_ms)
+    logging.info(f"Plantilla compilada para el motor XML: {len(ranuras)} placeholders en {duracion_ms} ms")
+
+    return {
+        "segmentos": segmentos,
+        "conteo": conteo,
+        "placeholders": frozenset(conteo),
+        "zip_base": base.getvalue(),
+        "prefijo": prefijo
+    }
+
+# ========== RENDER ==========
+
+def nuevo_documento(compilada):
+    """Documento editable del motor XML: solo guarda el contenido de cada placeholder"""
+    return {"motor": "xml", "compilada": compilada, "contenidos": {}}
+
+def es_documento(documento):
+    """Indica si el documento pertenece al motor XML (y no es un Document de python-docx)"""
+    return isinstance(documento, dict) and documento.get("motor") == "xml"
+
+def reemplazar(documento, placeholder, contenido):
+    """Asigna el contenido de un placeholder; regresa el número de apariciones en la plantilla"""
+    apariciones = documento["compilada"]["conteo"].get(placeholder, 0)
+    if apariciones:
+        documento["contenidos"][placeholder] = contenido
+    return apariciones
+
+def _texto_xml(texto, prefijo):
+    """Escapa el texto; los saltos de línea y tabuladores se vuelven w:br y w:tab dentro del mismo run"""
+    texto = escape(CARACTERES_INVALIDOS.sub("", texto))
+    cierre, apertura = f"</{prefijo}:t>", f'<{prefijo}:t xml:space="preserve">'
+    texto = texto.replace("\r\n", "\n").replace("\n", f"{cierre}<{prefijo}:br/>{apertura}")
+    return texto.replace("\t", f"{cierre}<{prefijo}:tab/>{apertura}")
+
+def renderizar_xml(documento):
+    """Bytes de word/document.xml con los contenidos asignados"""
+    compilada = documento["compilada"]
+    contenidos = documento["contenidos"]
+    prefijo = compilada["prefijo"]
+    partes = []
+    for segmento in compilada["segmentos"]:
+        if isinstance(segmento, bytes):
+            partes.append(segmento)
+        else:
+            # Los placeholders sin contenido conservan su texto original
+            partes.append(_texto_xml(contenidos.get(segmento, segmento), prefijo).encode("utf-8"))
+    return b"".join(partes)
+
+def guardar(documento, stream):
+    """Escribe el .docx en el stream: copia el zip base y agrega el documento renderizado"""
+    inicio = time.perf_counter()
+    stream.write(documento["compilada"]["zip_base"])
+    stream.seek(0)
+    with zipfile.ZipFile(stream, "a", zipfile.ZIP_DEFLATED) as paquete:
+        paquete.writestr(PARTE_DOCUMENTO, renderizar_xml(documento))
+    metricas.observar("motor_xml.render_ms", round((time.perf_counter() - inicio) * 1000, 1))
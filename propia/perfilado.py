@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import tracemalloc
+import contextlib
+import contextvars
+from collections import Counter
+
+from propia import metricas
+
+# Perfilar todas las solicitudes (solo para diagnóstico puntual)
+PERFILADO_HABILITADO = os.getenv("PERFILADO_HABILITADO", "false").lower() == "true"
+# Permitir activar el perfilado por solicitud con el header X-Perfilar: true. Apagado por defecto:
+# los endpoints son anónimos, el perfilado (tracemalloc, muestreo de pilas) frena a todas las
+# solicitudes del worker y la respuesta trae URLs de los perfiles internos
+PERFILADO_PERMITIR_HEADER = os.getenv("PERFILADO_PERMITIR_HEADER", "false").lower() == "true"
+PERFILADO_INTERVALO_MS = float(os.getenv("PERFILADO_INTERVALO_MS", "5"))
+# Cuadros de pila que guarda tracemalloc por asignación
+PERFILADO_CUADROS_MEMORIA = int(os.getenv("PERFILADO_CUADROS_MEMORIA", "10"))
+PERFILADO_PREFIJO = os.getenv("PERFILADO_PREFIJO", "perfiles/")
+
+_lock = threading.Lock()
+# tracemalloc es global: se inicia con la primera sesión activa y se detiene con la última
+_sesiones_activas = 0
+_sesion = contextvars.ContextVar("perfilado_sesion", default=None)
+_sin_perfilado = contextlib.nullcontext()
+
+# ========== ACTIVACIÓN ==========
+
+def solicitado(req):
+    """Indica si la solicitud debe perfilarse (setting global o header X-Perfilar)"""
+    if PERFILADO_HABILITADO:
+        return True
+    if not PERFILADO_PERMITIR_HEADER or not req.headers:
+        return False
+    return (req.headers.get('X-Perfilar') or "").lower() in ("1", "true")
+
+def iniciar(nombre):
+    """
+    Inicia una sesión de perfilado en el contexto actual: un hilo muestrea las pilas
+    de los hilos de la solicitud y tracemalloc registra las asignaciones.
+    """
+    sesion = {
+        "nombre": nombre,
+        "lock": threading.Lock(),
+        "hilos": {threading.get_ident()},
+        "pilas": Counter(),
+        "muestras": 0,
+        "memoria": [],
+        "detener": threading.Event(),
+        "inicio": time.perf_counter(),
+        "duracion_ms": None
+    }
+    global _sesiones_activas
+    with _lock:
+        _sesiones_activas += 1
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(PERFILADO_CUADROS_MEMORIA)
+        elif _sesiones_activas == 1:
+            tracemalloc.reset_peak()
+
+    sesion["muestreador"] = threading.Thread(
+        target=_muestrear, args=(sesion,), name=f"perfilado-{nombre}", daemon=True
+    )
+    sesion["muestreador"].start()
+    sesion["token"] = _sesion.set(sesion)
+    metricas.incrementar("perfilado.sesiones")
+    logging.info(f"Perfilado activo para {nombre}")
+    return sesion
+
+def detener(sesion):
+    """Detiene el muestreo y tracemalloc (se puede llamar más de una vez)"""
+    if sesion is None or sesion["detener"].is_set():
+        return
+    sesion["detener"].set()
+    sesion["muestreador"].join()
+    try:
+        _sesion.reset(sesion["token"])
+    except ValueError:
+        _sesion.set(None)  # Se detuvo desde otro contexto
+    sesion["duracion_ms"] = round((time.perf_counter() - sesion["inicio"]) * 1000, 1)
+    global _sesiones_activas
+    with _lock:
+        sesion["memoria_pico_traza_kb"] = round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+        _sesiones_activas -= 1
+        if _sesiones_activas == 0:
+            tracemalloc.stop()
+
+# ========== CAPTURA ==========
+
+def hilo_perfilado():
+    """Incluye el hilo actual en el muestreo mientras dura el bloque (sin costo si no hay sesión)"""
+    sesion = _sesion.get()
+    if sesion is None or sesion["detener"].is_set():
+        return _sin_perfilado
+    return _hilo_registrado(sesion)
+
+@contextlib.contextmanager
+def _hilo_registrado(sesion):
+    ident = threading.get_ident()
+    with sesion["lock"]:
+        sesion["hilos"].add(ident)
+    try:
+        yield
+    finally:
+        with sesion["lock"]:
+            sesion["hilos"].discard(ident)
+
+def medir_memoria(etiqueta):
+    """Toma instantáneas de tracemalloc antes y después del bloque (sin costo si no hay sesión)"""
+    sesion = _sesion.get()
+    if sesion is None or sesion["detener"].is_set():
+        return _sin_perfilado
+    return _diferencia_memoria(sesion, etiqueta)
+
+@contextlib.contextmanager
+def _diferencia_memoria(sesion, etiqueta):
+    antes = tracemalloc.take_snapshot()
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        despues = tracemalloc.take_snapshot()
+        diferencias = despues.compare_to(antes, "lineno")
+        with sesion["lock"]:
+            sesion["memoria"].append({
+                "etiqueta": etiqueta,
+                "duracion_ms": round((time.perf_counter() - inicio) * 1000, 1),
+                "neto_kb": round(sum(d.size_diff for d in diferencias) / 1024, 1),
+                "principales": [
+                    {
+                        "ubicacion": f"{d.traceback[0].filename}:{d.traceback[0].lineno}",
+                        "diferencia_kb": round(d.size_diff / 1024, 1),
+                        "bloques": d.count_diff
+                    }
+                    for d in diferencias[:15]
+                ]
+            })
+
+def _muestrear(sesion):
+    """Cada PERFILADO_INTERVALO_MS toma la pila de los hilos registrados"""
+    intervalo = PERFILADO_INTERVALO_MS / 1000
+    while not sesion["detener"].wait(intervalo):
+        cuadros = sys._current_frames()
+        with sesion["lock"]:
+            hilos = list(sesion["hilos"])
+        for ident in hilos:
+            cuadro = cuadros.get(ident)
+            pila = []
+            while cuadro is not None:
+                codigo = cuadro.f_code
+                pila.append(f"{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{codigo.co_firstlineno})")
+                cuadro = cuadro.f_back
+            if pila:
+                sesion["pilas"][";".join(reversed(pila))] += 1
+        sesion["muestras"] += 1
+
+# ========== REPORTE ==========
+
+def construir_reporte(sesion, **extra):
+    """Resumen del perfil: funciones con más muestras propias e inclusivas y diferencias de memoria"""
+    propias, inclusivas = Counter(), Counter()
+    for pila, conteo in sesion["pilas"].items():
+        funciones = pila.split(";")
+        propias[funciones[-1]] += conteo
+        for funcion in set(funciones):
+            inclusivas[funcion] += conteo
+    total = sum(sesion["pilas"].values()) or 1
+
+    reporte = {
+        "nombre": sesion["nombre"],
+        "duracion_ms": sesion["duracion_ms"],
+        "intervalo_ms": PERFILADO_INTERVALO_MS,
+        "muestras": sesion["muestras"],
+        "funciones_propias": [
+            {"funcion": funcion, "muestras": conteo, "porcentaje": round(conteo / total * 100, 1)}
+            for funcion, conteo in propias.most_common(25)
+        ],
+        "funciones_inclusivas": [
+            {"funcion": funcion, "muestras": conteo, "porcentaje": round(conteo / total * 100, 1)}
+            for funcion, conteo in inclusivas.most_common(25)
+        ],
+        "memoria": sesion["memoria"],
+        "memoria_pico_traza_kb": sesion.get("memoria_pico_traza_kb")
+    }
+    reporte.update(extra)
+    return reporte
+
+def subir(container_client, sesion, identificador, **extra):
+    """
+    Sube el reporte JSON y las pilas en formato colapsado (compatible con flamegraph.pl
+    y speedscope) bajo PERFILADO_PREFIJO.
+
+    :return: Diccionario {"reporte": blob_name, "pilas": blob_name}.
+    """
+    detener(sesion)
+    prefijo = f"{PERFILADO_PREFIJO}{identificador}/"
+    reporte = construir_reporte(sesion, **extra)
+    pilas = "\n".join(f"{pila} {conteo}" for pila, conteo in sesion["pilas"].most_common())
+
+    blobs = {"reporte": f"{prefijo}perfil.json", "pilas": f"{prefijo}pilas.folded"}
+    container_client.get_blob_client(blobs["reporte"]).upload_blob(
+        json.dumps(reporte, ensure_ascii=False, default=str).encode("utf-8"), overwrite=True
+    )
+    container_client.get_blob_client(blobs["pilas"]).upload_blob(pilas.encode("utf-8"), overwrite=True)
+    logging.info(f"Perfil de {identificador} subido a {prefijo} ({sesion['muestras']} muestras)")
+    return blobs
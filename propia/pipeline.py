@@ -0,0 +1,227 @@
+import os
+import time
+import asyncio
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from propia import metricas, perfilado, asincrono
+
+# Hilos por solicitud para ejecutar etapas independientes (llamadas LLM, Storage)
+PIPELINE_MAX_HILOS = int(os.getenv("PIPELINE_MAX_HILOS", "8"))
+
+# ========== DEFINICIÓN DEL GRAFO ==========
+
+def etapa(funcion, dependencias=(), opcional=False):
+    """
+    Define una etapa del pipeline.
+
+    :param funcion: Recibe un diccionario {dependencia: resultado} y regresa el resultado de la etapa.
+    :param dependencias: Nombres de las etapas que deben terminar antes.
+    :param opcional: Si falla, se registra el error y sus dependientes reciben None en lugar de abortar.
+    """
+    return {"funcion": funcion, "dependencias": tuple(dependencias), "opcional": opcional}
+
+def validar_grafo(etapas):
+    """Verifica que las dependencias existan y que no haya ciclos"""
+    for nombre, definicion in etapas.items():
+        for dependencia in definicion["dependencias"]:
+            if dependencia not in etapas:
+                raise Exception(f"La etapa {nombre} depende de {dependencia}, que no existe")
+
+    visitadas, en_curso = set(), set()
+
+    def visitar(nombre):
+        if nombre in en_curso:
+            raise Exception(f"Ciclo detectado en el pipeline en la etapa {nombre}")
+        if nombre in visitadas:
+            return
+        en_curso.add(nombre)
+        for dependencia in etapas[nombre]["dependencias"]:
+            visitar(dependencia)
+        en_curso.discard(nombre)
+        visitadas.add(nombre)
+
+    for nombre in etapas:
+        visitar(nombre)
+
+# ========== REPORTE ==========
+
+def calcular_ruta_critica(etapas, tiempos):
+    """
+    Reconstruye la ruta crítica: desde la etapa que terminó al último, retrocede
+    siempre por la dependencia que terminó más tarde (la que retrasó su inicio).
+    """
+    terminadas = [nombre for nombre in etapas if nombre in tiempos]
+    if not terminadas:
+        return []
+
+    actual = max(terminadas, key=lambda nombre: tiempos[nombre]["fin_ms"])
+    ruta = [actual]
+    while True:
+        dependencias = [d for d in etapas[actual]["dependencias"] if d in tiempos]
+        if not dependencias:
+            break
+        actual = max(dependencias, key=lambda nombre: tiempos[nombre]["fin_ms"])
+        ruta.append(actual)
+
+    return list(reversed(ruta))
+
+# ========== EJECUCIÓN ==========
+
+def _reportar(etapas, tiempos, errores, duracion_total_ms, nombre_pipeline, resultados):
+    """Calcula la ruta crítica, publica las métricas del pipeline y arma el reporte"""
+    ruta_critica = calcular_ruta_critica(etapas, tiempos)
+    etapa_limitante = max(ruta_critica, key=lambda nombre: tiempos[nombre]["duracion_ms"]) if ruta_critica else None
+
+    for nombre, tiempo in tiempos.items():
+        metricas.observar(f"{nombre_pipeline}.etapa.{nombre.split(':')[0]}_ms", tiempo["duracion_ms"])
+    metricas.observar(f"{nombre_pipeline}.total_ms", duracion_total_ms)
+    if etapa_limitante:
+        metricas.incrementar(f"{nombre_pipeline}.limitante.{etapa_limitante.split(':')[0]}")
+
+    reporte = {
+        "duracion_total_ms": duracion_total_ms,
+        "ruta_critica": [
+            {"etapa": nombre, "duracion_ms": tiempos[nombre]["duracion_ms"]}
+            for nombre in ruta_critica
+        ],
+        "etapa_limitante": etapa_limitante,
+        "etapas": tiempos,
+        "errores": errores
+    }
+    logging.info(f"{nombre_pipeline}: {duracion_total_ms} ms, ruta crítica {' -> '.join(ruta_critica)}")
+
+    return resultados, reporte
+
+def ejecutar_grafo(etapas, max_hilos=PIPELINE_MAX_HILOS, nombre_pipeline="pipeline"):
+    """
+    Ejecuta un grafo de etapas iniciando cada una en cuanto sus dependencias terminan.
+
+    :return: Tupla (resultados, reporte). El reporte incluye tiempos por etapa,
+             la ruta crítica y la etapa que más aporta a la latencia.
+    """
+    validar_grafo(etapas)
+
+    inicio_pipeline = time.perf_counter()
+    resultados = {}
+    tiempos = {}
+    errores = {}
+    pendientes = dict(etapas)
+    en_ejecucion = {}
+
+    def transcurrido_ms():
+        return round((time.perf_counter() - inicio_pipeline) * 1000, 1)
+
+    def correr(nombre, entradas):
+        inicio_ms = transcurrido_ms()
+        try:
+            # Si la solicitud se está perfilando, el hilo de la etapa entra al muestreo
+            with perfilado.hilo_perfilado():
+                return etapas[nombre]["funcion"](entradas)
+        finally:
+            fin_ms = transcurrido_ms()
+            tiempos[nombre] = {"inicio_ms": inicio_ms, "fin_ms": fin_ms, "duracion_ms": round(fin_ms - inicio_ms, 1)}
+
+    executor = ThreadPoolExecutor(max_workers=max_hilos, thread_name_prefix=nombre_pipeline)
+    try:
+        while pendientes or en_ejecucion:
+            # Lanzar todas las etapas cuyas dependencias ya terminaron
+            listas = [
+                nombre for nombre, definicion in pendientes.items()
+                if all(d in resultados for d in definicion["dependencias"])
+            ]
+            for nombre in listas:
+                definicion = pendientes.pop(nombre)
+                entradas = {d: resultados[d] for d in definicion["dependencias"]}
+                # Cada etapa corre con una copia del contexto de la solicitud
+                contexto = contextvars.copy_context()
+                en_ejecucion[executor.submit(contexto.run, correr, nombre, entradas)] = nombre
+
+            if not en_ejecucion:
+                raise Exception(f"Etapas sin poder ejecutarse: {sorted(pendientes)}")
+
+            terminados, _ = wait(list(en_ejecucion), return_when=FIRST_COMPLETED)
+            for futuro in terminados:
+                nombre = en_ejecucion.pop(futuro)
+                try:
+                    resultados[nombre] = futuro.result()
+                except Exception as e:
+                    if not etapas[nombre]["opcional"]:
+                        logging.error(f"Etapa {nombre} falló, se cancela el pipeline: {str(e)}")
+                        raise
+                    logging.error(f"Etapa opcional {nombre} falló: {str(e)}")
+                    errores[nombre] = str(e)
+                    resultados[nombre] = None
+    finally:
+        # Si una etapa obligatoria falla, no se inician las pendientes
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return _reportar(etapas, tiempos, errores, transcurrido_ms(), nombre_pipeline, resultados)
+
+async def ejecutar_grafo_async(etapas, nombre_pipeline="pipeline"):
+    """
+    Versión asíncrona de ejecutar_grafo para los handlers async: las etapas definidas con
+    `async def` corren como tareas del event loop y las síncronas en el executor de CPU
+    (asincrono.en_executor). Regresa la misma tupla (resultados, reporte).
+    """
+    validar_grafo(etapas)
+
+    inicio_pipeline = time.perf_counter()
+    resultados = {}
+    tiempos = {}
+    errores = {}
+    pendientes = dict(etapas)
+    en_ejecucion = {}
+
+    def transcurrido_ms():
+        return round((time.perf_counter() - inicio_pipeline) * 1000, 1)
+
+    def correr_en_hilo(funcion, entradas):
+        with perfilado.hilo_perfilado():
+            return funcion(entradas)
+
+    async def correr(nombre, entradas):
+        funcion = etapas[nombre]["funcion"]
+        inicio_ms = transcurrido_ms()
+        try:
+            if asyncio.iscoroutinefunction(funcion):
+                return await funcion(entradas)
+            return await asincrono.en_executor(correr_en_hilo, funcion, entradas)
+        finally:
+            fin_ms = transcurrido_ms()
+            tiempos[nombre] = {"inicio_ms": inicio_ms, "fin_ms": fin_ms, "duracion_ms": round(fin_ms - inicio_ms, 1)}
+
+    try:
+        while pendientes or en_ejecucion:
+            listas = [
+                nombre for nombre, definicion in pendientes.items()
+                if all(d in resultados for d in definicion["dependencias"])
+            ]
+            for nombre in listas:
+                definicion = pendientes.pop(nombre)
+                entradas = {d: resultados[d] for d in definicion["dependencias"]}
+                # create_task copia el contexto de la solicitud para cada etapa
+                en_ejecucion[asyncio.ensure_future(correr(nombre, entradas))] = nombre
+
+            if not en_ejecucion:
+                raise Exception(f"Etapas sin poder ejecutarse: {sorted(pendientes)}")
+
+            terminadas, _ = await asyncio.wait(list(en_ejecucion), return_when=asyncio.FIRST_COMPLETED)
+            for tarea in terminadas:
+                nombre = en_ejecucion.pop(tarea)
+                try:
+                    resultados[nombre] = tarea.result()
+                except Exception as e:
+                    if not etapas[nombre]["opcional"]:
+                        logging.error(f"Etapa {nombre} falló, se cancela el pipeline: {str(e)}")
+                        raise
+                    logging.error(f"Etapa opcional {nombre} falló: {str(e)}")
+                    errores[nombre] = str(e)
+                    resultados[nombre] = None
+    finally:
+        # Si una etapa obligatoria falla (o se cancela la solicitud), se cancelan las que siguen en curso
+        for tarea in en_ejecucion:
+            tarea.cancel()
+
+    return _reportar(etapas, tiempos, errores, transcurrido_ms(), nombre_pipeline, resultados)
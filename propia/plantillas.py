@@ -0,0 +1,252 @@
+import os
+import re
+import copy
+import time
+import threading
+import logging
+from collections import OrderedDict
+from docx import Document
+
+from propia import metricas, motor_xml
+from propia.almacenamiento import descargar_a_stream
+
+# Configuración del registro de plantillas
+PLANTILLAS_PREFIJO = os.getenv("PLANTILLAS_PREFIJO", "plantilla/")
+PLANTILLA_DEFAULT = os.getenv("PLANTILLA_DEFAULT", "Plantilla-Propuesta")
+# Segundos que se reutiliza el listado (y por lo tanto los ETag) antes de volver a consultar Storage
+PLANTILLAS_TTL_LISTADO = int(os.getenv("PLANTILLAS_TTL_LISTADO", "60"))
+PLANTILLAS_CACHE_MB = float(os.getenv("PLANTILLAS_CACHE_MB", "200"))
+# Un documento parseado ocupa varias veces el tamaño del .docx comprimido
+PLANTILLAS_FACTOR_MEMORIA = float(os.getenv("PLANTILLAS_FACTOR_MEMORIA", "10"))
+# Motor de render: "docx" (python-docx) o "xml" (sustitución directa sobre el XML del paquete)
+MOTOR_RENDER = os.getenv("MOTOR_RENDER", "docx").lower()
+
+# Placeholders tipo identificador: [RESUMEN], [PLAN_TRABAJO], [titulo] (no "[1]" ni "[ver anexo]")
+PLACEHOLDER_PATTERN = re.compile(r'\[[^\W\d]\w{0,59}\]')
+
+_lock = threading.Lock()
+# contenedor -> {"expira", "plantillas": {nombre: {"blob_name", "etag", "size"}}}
+_listados = {}
+# (contenedor, nombre, etag) -> {"documento", "costo_bytes", ...}
+_compiladas = OrderedDict()
+_locks_compilacion = {}
+
+
+class PlantillaNoEncontrada(Exception):
+    """La plantilla solicitada no existe bajo el prefijo de plantillas"""
+
+
+# ========== DESCUBRIMIENTO ==========
+
+def _nombre_desde_blob(blob_name):
+    """Convierte 'plantilla/consultoria/en.docx' en 'consultoria/en'"""
+    return blob_name[len(PLANTILLAS_PREFIJO):][:-len('.docx')]
+
+def listar_plantillas(container_client, forzar=False):
+    """Descubre las plantillas .docx bajo PLANTILLAS_PREFIJO (listado cacheado por PLANTILLAS_TTL_LISTADO)"""
+    contenedor = container_client.container_name
+    ahora = time.monotonic()
+
+    with _lock:
+        listado = _listados.get(contenedor)
+        if listado and listado["expira"] > ahora and not forzar:
+            return listado["plantillas"]
+
+    plantillas = {}
+    for blob in container_client.list_blobs(name_starts_with=PLANTILLAS_PREFIJO):
+        if blob.name.lower().endswith('.docx'):
+            plantillas[_nombre_desde_blob(blob.name)] = {
+                "blob_name": blob.name,
+                "etag": blob.etag,
+                "size": blob.size
+            }
+
+    with _lock:
+        _listados[contenedor] = {"expira": ahora + PLANTILLAS_TTL_LISTADO, "plantillas": plantillas}
+
+    logging.info(f"Plantillas descubiertas en {contenedor}: {sorted(plantillas)}")
+    return plantillas
+
+def resolver_plantilla(plantillas, nombre=None, unidad_negocio=None, idioma=None):
+    """
+    Elige la plantilla para una solicitud.
+
+    Un nombre explícito debe existir. Si no se indica, se prueba en orden
+    '<unidad>/<idioma>', '<unidad>', '<default>-<idioma>' y la plantilla por defecto.
+    """
+    if nombre:
+        nombre = nombre[len(PLANTILLAS_PREFIJO):] if nombre.startswith(PLANTILLAS_PREFIJO) else nombre
+        nombre = nombre[:-len('.docx')] if nombre.lower().endswith('.docx') else nombre
+        if nombre not in plantillas:
+            raise PlantillaNoEncontrada(f"La plantilla '{nombre}' no existe. Disponibles: {sorted(plantillas)}")
+        return nombre
+
+    candidatos = []
+    if unidad_negocio and idioma:
+        candidatos.append(f"{unidad_negocio}/{idioma}")
+    if unidad_negocio:
+        candidatos.append(unidad_negocio)
+    if idioma:
+        candidatos.append(f"{PLANTILLA_DEFAULT}-{idioma}")
+    candidatos.append(PLANTILLA_DEFAULT)
+
+    for candidato in candidatos:
+        if candidato in plantillas:
+            return candidato
+
+    raise PlantillaNoEncontrada(f"No hay plantilla para {candidatos}. Disponibles: {sorted(plantillas)}")
+
+# ========== INVENTARIO DE PLACEHOLDERS ==========
+
+def escanear_placeholders(documento):
+    """
+    Regresa el conjunto de placeholders presentes en el cuerpo del documento.
+
+    El texto se concatena por párrafo (w:p) para detectar placeholders partidos en varios runs;
+    incluye párrafos normales, celdas de tablas y cuadros de texto.
+    """
+    placeholders = set()
+    for element in documento.element.body.iter():
+        if element.tag.endswith('}p'):
+            texto = "".join(child.text for child in element.iter() if child.tag.endswith('}t') and child.text)
+            if '[' in texto:
+                placeholders.update(PLACEHOLDER_PATTERN.findall(texto))
+    return placeholders
+
+def planificar_placeholders(placeholders_config, placeholders_plantilla, personalizados=()):
+    """
+    Cruza los generadores configurados con los placeholders presentes en la plantilla.
+
+    El escaneo solo reconoce placeholders con forma de identificador, así que los personalizados
+    (p. ej. "[NOMBRE CLIENTE]" o "{CLIENTE}") se conservan siempre y se buscan al reemplazar.
+
+    :param personalizados: Placeholders que envió el solicitante.
+    :return: Tupla (config solo con placeholders presentes, placeholders omitidos por no estar
+             en la plantilla, placeholders de la plantilla sin generador).
+    """
+    config_presente = {
+        p: f for p, f in placeholders_config.items() if p in placeholders_plantilla or p in personalizados
+    }
+    omitidos = sorted(p for p in placeholders_config if p not in config_presente)
+    sin_generador = sorted(p for p in placeholders_plantilla if p not in placeholders_config)
+
+    metricas.incrementar("placeholders.programados", len(config_presente))
+    metricas.incrementar("placeholders.omitidos", len(omitidos))
+    if omitidos:
+        logging.info(f"Placeholders sin presencia en la plantilla (no se generan): {omitidos}")
+
+    return config_presente, omitidos, sin_generador
+
+# ========== CACHE LRU DE PLANTILLAS COMPILADAS ==========
+
+def _costo_total():
+    """Memoria estimada ocupada por las plantillas compiladas"""
+    return sum(entrada["costo_bytes"] for entrada in _compiladas.values())
+
+def _desalojar(limite_bytes):
+    """Desaloja las plantillas menos usadas hasta quedar bajo el límite (conserva al menos una)"""
+    while len(_compiladas) > 1 and _costo_total() > limite_bytes:
+        clave, _ = _compiladas.popitem(last=False)
+        metricas.incrementar("plantillas.desalojos")
+        logging.info(f"Plantilla desalojada de la cache: {clave[1]} ({clave[2]})")
+
+def _compilar(container_client, nombre, info):
+    """Descarga y parsea una plantilla una sola vez"""
+    inicio = time.perf_counter()
+    blob_client = container_client.get_blob_client(info["blob_name"])
+    documento, compilada_xml = None, None
+    with descargar_a_stream(blob_client) as plantilla_stream:
+        if MOTOR_RENDER == "xml":
+            compilada_xml = motor_xml.compilar(plantilla_stream, PLACEHOLDER_PATTERN)
+        else:
+            documento = Document(plantilla_stream)
+    if compilada_xml is not None:
+        placeholders = compilada_xml["placeholders"]
+        # El motor XML solo guarda bytes: su costo es el tamaño real en memoria
+        costo_bytes = len(compilada_xml["zip_base"]) + sum(len(s) for s in compilada_xml["segmentos"])
+    else:
+        placeholders = escanear_placeholders(documento)
+        costo_bytes = int((info["size"] or 0) * PLANTILLAS_FACTOR_MEMORIA)
+
+    duracion_ms = round((time.perf_counter() - inicio) * 1000, 1)
+    metricas.observar("plantillas.compilacion_ms", duracion_ms)
+    logging.info(f"Plantilla compilada: {nombre} ({info['size']} bytes en {duracion_ms} ms), placeholders: {sorted(placeholders)}")
+
+    return {
+        "documento": documento,
+        "xml": compilada_xml,
+        "placeholders": frozenset(placeholders),
+        "nombre": nombre,
+        "etag": info["etag"],
+        "costo_bytes": costo_bytes
+    }
+
+def obtener_compilada(container_client, nombre=None, unidad_negocio=None, idioma=None):
+    """Regresa la entrada compilada de la plantilla seleccionada, compilándola solo si no está en cache"""
+    plantillas = listar_plantillas(container_client)
+    nombre = resolver_plantilla(plantillas, nombre, unidad_negocio, idioma)
+    info = plantillas[nombre]
+    clave = (container_client.container_name, nombre, info["etag"])
+
+    with _lock:
+        entrada = _compiladas.get(clave)
+        if entrada:
+            _compiladas.move_to_end(clave)
+            metricas.incrementar("plantillas.cache_aciertos")
+            return entrada
+        lock_clave = _locks_compilacion.setdefault(clave, threading.Lock())
+
+    # Solo un hilo compila cada (nombre, etag); los demás esperan su resultado
+    with lock_clave:
+        with _lock:
+            entrada = _compiladas.get(clave)
+        if entrada is None:
+            metricas.incrementar("plantillas.cache_fallos")
+            entrada = _compilar(container_client, nombre, info)
+            with _lock:
+                # Versiones anteriores de la misma plantilla ya no se usarán
+                for anterior in [c for c in _compiladas if c[:2] == clave[:2]]:
+                    del _compiladas[anterior]
+                _compiladas[clave] = entrada
+                _desalojar(PLANTILLAS_CACHE_MB * 1024 * 1024)
+                metricas.fijar("plantillas.cache_mb", round(_costo_total() / (1024 * 1024), 1))
+                metricas.fijar("plantillas.cache_entradas", len(_compiladas))
+
+    with _lock:
+        _locks_compilacion.pop(clave, None)
+
+    return entrada
+
+def obtener_plantilla(container_client, nombre=None, unidad_negocio=None, idioma=None):
+    """
+    Regresa una copia editable de la plantilla seleccionada.
+
+    :return: Tupla (Document, {"nombre", "etag"}). La copia se obtiene de la plantilla
+             compilada en memoria, sin volver a descargar ni parsear el .docx.
+    """
+    return copiar_plantilla(obtener_compilada(container_client, nombre, unidad_negocio, idioma))
+
+def copiar_plantilla(entrada):
+    """
+    Regresa (documento editable, {"nombre", "etag"}) a partir de una entrada compilada.
+    Con MOTOR_RENDER=xml el documento es el del motor XML (ver motor_xml.es_documento).
+    """
+    info = info_plantilla(entrada)
+    if entrada.get("xml") is not None:
+        return motor_xml.nuevo_documento(entrada["xml"]), info
+    return copy.deepcopy(entrada["documento"]), info
+
+def info_plantilla(entrada):
+    """Identificación de la plantilla que se reporta en el resultado y el manifiesto"""
+    return {"nombre": entrada["nombre"], "etag": entrada["etag"]}
+
+def seleccion_desde_body(req_body):
+    """Extrae la selección de plantilla ('plantilla', 'unidad_negocio', 'idioma') del body JSON"""
+    if not isinstance(req_body, dict):
+        return {}
+    campos = {"plantilla": "nombre", "unidad_negocio": "unidad_negocio", "idioma": "idioma"}
+    return {
+        parametro: req_body[campo].strip()
+        for campo, parametro in campos.items()
+        if isinstance(req_body.get(campo), str) and req_body[campo].strip()
+    }
@@ -0,0 +1,94 @@
+import os
+import time
+import logging
+import threading
+import contextvars
+
+from propia import metricas
+
+# Segundos que tiene cada solicitud para responder, contados desde que llega (incluye la espera de
+# admisión). Una invocación HTTP de Azure Functions se corta a los 230 s. 0 = sin plazo
+PLAZO_SOLICITUD_SEGUNDOS = float(os.getenv("PLAZO_SOLICITUD_SEGUNDOS", "200"))
+# Parte final del plazo reservada para ensamblar, subir, firmar y registrar el documento
+PLAZO_RESERVA_SEGUNDOS = float(os.getenv("PLAZO_RESERVA_SEGUNDOS", "20"))
+# Con menos de estos segundos disponibles ya no se inicia una llamada a Azure OpenAI
+PLAZO_MINIMO_LLAMADA_SEGUNDOS = float(os.getenv("PLAZO_MINIMO_LLAMADA_SEGUNDOS", "3"))
+
+# Plazo de la solicitud en curso: {"fin", "lock", "pendientes"}
+_plazo = contextvars.ContextVar("plazo_solicitud", default=None)
+
+
+class PlazoAgotado(Exception):
+    """No queda tiempo de la solicitud para (terminar) una llamada a Azure OpenAI"""
+
+
+# ========== CONTEXTO DE LA SOLICITUD ==========
+
+def iniciar(recibida=None, segundos=None):
+    """
+    Abre el plazo de una solicitud en el contexto actual.
+
+    :param recibida: time.monotonic() de la llegada de la solicitud; por defecto, ahora.
+    :param segundos: Duración del plazo; por defecto PLAZO_SOLICITUD_SEGUNDOS (0 = sin plazo).
+    """
+    segundos = PLAZO_SOLICITUD_SEGUNDOS if segundos is None else segundos
+    plazo = {
+        "fin": (recibida or time.monotonic()) + segundos if segundos > 0 else None,
+        "lock": threading.Lock(),
+        "pendientes": []
+    }
+    _plazo.set(plazo)
+    return plazo
+
+def restante():
+    """Segundos disponibles para llamadas al LLM (el plazo menos la reserva), o None sin plazo"""
+    plazo = _plazo.get()
+    if plazo is None or plazo["fin"] is None:
+        return None
+    return plazo["fin"] - PLAZO_RESERVA_SEGUNDOS - time.monotonic()
+
+def vencido():
+    disponible = restante()
+    return disponible is not None and disponible <= 0
+
+def timeout_llamada(maximo):
+    """
+    Timeout de la siguiente llamada: lo que queda del plazo, sin pasar de `maximo`.
+
+    :raises PlazoAgotado: Si quedan menos de PLAZO_MINIMO_LLAMADA_SEGUNDOS.
+    """
+    disponible = restante()
+    if disponible is None:
+        return maximo
+    if disponible < PLAZO_MINIMO_LLAMADA_SEGUNDOS:
+        metricas.incrementar("plazos.llamadas_omitidas")
+        raise agotado()
+    return min(maximo, disponible)
+
+def agotado():
+    """Excepción para una llamada que el plazo no alcanza a cubrir"""
+    disponible = restante()
+    return PlazoAgotado(
+        f"Plazo de la solicitud agotado ({round(max(0.0, disponible or 0.0), 1)} s disponibles para Azure OpenAI)"
+    )
+
+# ========== SECCIONES PENDIENTES ==========
+
+def marcar_pendiente(placeholder):
+    """Registra una sección que se quedó sin generar por falta de tiempo"""
+    plazo = _plazo.get()
+    if plazo is None:
+        return
+    with plazo["lock"]:
+        if placeholder not in plazo["pendientes"]:
+            plazo["pendientes"].append(placeholder)
+    metricas.incrementar("plazos.secciones_pendientes")
+    logging.warning(f"{placeholder}: sin tiempo para generarla, queda pendiente")
+
+def pendientes(plazo=None):
+    """Secciones pendientes de la solicitud, en orden"""
+    plazo = plazo or _plazo.get()
+    if plazo is None:
+        return []
+    with plazo["lock"]:
+        return sorted(plazo["pendientes"])
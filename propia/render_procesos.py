@@ -0,0 +1,173 @@
+import io
+import os
+import copy
+import time
+import asyncio
+import logging
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from docx import Document
+
+from propia import metricas, motor_xml, asincrono
+
+# Procesos que ensamblan los documentos (copia de la plantilla, reemplazos y serialización).
+# 0 = el ensamblado corre en los hilos del pipeline, como hasta ahora
+RENDER_PROCESOS = int(os.getenv("RENDER_PROCESOS", "0"))
+# Plantillas compiladas que conserva cada proceso de trabajo
+RENDER_PROCESOS_PLANTILLAS = int(os.getenv("RENDER_PROCESOS_PLANTILLAS", "8"))
+
+_lock = threading.Lock()
+_pool = None
+
+# Solo en los procesos de trabajo: (nombre, etag, motor) -> Document o plantilla del motor XML
+_plantillas_trabajador = OrderedDict()
+
+# ========== PROCESO DE TRABAJO ==========
+
+def _plantilla_trabajador(clave, paquete):
+    """Plantilla compilada del proceso; None si no la tiene y no se envió el paquete"""
+    compilada = _plantillas_trabajador.get(clave)
+    if compilada is not None:
+        _plantillas_trabajador.move_to_end(clave)
+        return compilada
+    if paquete is None:
+        return None
+    compilada = paquete if clave[2] == "xml" else Document(io.BytesIO(paquete))
+    _plantillas_trabajador[clave] = compilada
+    while len(_plantillas_trabajador) > RENDER_PROCESOS_PLANTILLAS:
+        _plantillas_trabajador.popitem(last=False)
+    return compilada
+
+def _ensamblar(clave, paquete, contenidos, reemplazar):
+    """
+    Ensambla un documento en el proceso de trabajo.
+
+    :return: None si el proceso aún no tiene la plantilla (se reenvía con el paquete), o
+             tupla (bytes del .docx, reemplazos por placeholder, duración en ms).
+    """
+    compilada = _plantilla_trabajador(clave, paquete)
+    if compilada is None:
+        return None
+    doc = motor_xml.nuevo_documento(compilada) if clave[2] == "xml" else copy.deepcopy(compilada)
+    return _ensamblar_documento(doc, contenidos, reemplazar)
+
+def _ensamblar_documento(doc, contenidos, reemplazar):
+    """Aplica los contenidos a una copia de la plantilla y la serializa"""
+    inicio = time.perf_counter()
+    cambios = {
+        placeholder: reemplazar(doc, placeholder, contenido)
+        for placeholder, contenido in contenidos.items() if contenido
+    }
+    salida = io.BytesIO()
+    if motor_xml.es_documento(doc):
+        motor_xml.guardar(doc, salida)
+    else:
+        doc.save(salida)
+    return salida.getvalue(), cambios, round((time.perf_counter() - inicio) * 1000, 1)
+
+# ========== PROCESO PRINCIPAL ==========
+
+def habilitado():
+    return RENDER_PROCESOS > 0
+
+def _obtener_pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            # spawn: el worker de Functions tiene hilos (gRPC, pipeline) que no sobreviven a un fork
+            _pool = ProcessPoolExecutor(max_workers=RENDER_PROCESOS, mp_context=multiprocessing.get_context("spawn"))
+            logging.info(f"Pool de render iniciado con {RENDER_PROCESOS} procesos")
+        return _pool
+
+def _descartar_pool(pool):
+    """
+    Descarta un pool roto (un proceso murió por falta de memoria o un fallo): queda como
+    BrokenProcessPool para siempre, así que la siguiente solicitud crea uno nuevo.
+    """
+    global _pool
+    with _lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+    metricas.incrementar("render_procesos.pool_reiniciado")
+    logging.warning("Un proceso de render terminó de forma inesperada; se crea un pool nuevo")
+
+def _ensamblar_local(entrada, contenidos, reemplazar):
+    """Ensambla en el hilo que llama, cuando el pool falla dos veces seguidas"""
+    metricas.incrementar("render_procesos.en_hilo")
+    logging.warning("El pool de render volvió a fallar; el documento se ensambla en el hilo de la solicitud")
+    doc = motor_xml.nuevo_documento(entrada["xml"]) if entrada.get("xml") is not None else copy.deepcopy(entrada["documento"])
+    return _ensamblar_documento(doc, contenidos, reemplazar)
+
+def _clave(entrada):
+    return (entrada["nombre"], entrada["etag"], "xml" if entrada.get("xml") is not None else "docx")
+
+def _paquete(entrada):
+    """Lo que necesita un proceso para compilar la plantilla: la plantilla XML o el .docx serializado"""
+    if entrada.get("xml") is not None:
+        return entrada["xml"]
+    with _lock:
+        paquete = entrada.get("paquete_docx")
+    if paquete is None:
+        salida = io.BytesIO()
+        entrada["documento"].save(salida)
+        paquete = salida.getvalue()
+        with _lock:
+            entrada["paquete_docx"] = paquete
+    return paquete
+
+def _registrar(resultado, inicio):
+    docx_bytes, cambios, ensamblado_ms = resultado
+    metricas.observar("render_procesos.ensamblado_ms", ensamblado_ms)
+    # Incluye la espera en la cola del pool y el envío de los textos y del documento
+    metricas.observar("render_procesos.total_ms", round((time.perf_counter() - inicio) * 1000, 1))
+    return docx_bytes, cambios
+
+def renderizar(entrada, contenidos, reemplazar):
+    """
+    Ensambla el documento en el pool de procesos a partir de los textos ya generados.
+
+    La plantilla solo viaja al proceso la primera vez: cada proceso conserva sus plantillas compiladas.
+
+    :param entrada: Plantilla compilada (plantillas.obtener_compilada).
+    :param contenidos: {placeholder: texto}; los vacíos se omiten.
+    :param reemplazar: Función de nivel de módulo (doc, placeholder, texto) -> reemplazos,
+                       p. ej. reemplazar_placeholder.
+    :return: Tupla (bytes del .docx, {placeholder: reemplazos}).
+    """
+    inicio = time.perf_counter()
+    clave = _clave(entrada)
+    # Si un proceso muere, el pool se recrea y se reintenta una vez; después se ensambla en el hilo
+    for _ in range(2):
+        pool = _obtener_pool()
+        try:
+            resultado = pool.submit(_ensamblar, clave, None, contenidos, reemplazar).result()
+            if resultado is None:
+                metricas.incrementar("render_procesos.plantilla_enviada")
+                resultado = pool.submit(_ensamblar, clave, _paquete(entrada), contenidos, reemplazar).result()
+            return _registrar(resultado, inicio)
+        except BrokenProcessPool:
+            _descartar_pool(pool)
+    return _registrar(_ensamblar_local(entrada, contenidos, reemplazar), inicio)
+
+async def renderizar_async(entrada, contenidos, reemplazar):
+    """Versión asíncrona de renderizar (no ocupa un hilo mientras el proceso ensambla)"""
+    inicio = time.perf_counter()
+    clave = _clave(entrada)
+    for _ in range(2):
+        pool = _obtener_pool()
+        try:
+            resultado = await asyncio.wrap_future(pool.submit(_ensamblar, clave, None, contenidos, reemplazar))
+            if resultado is None:
+                metricas.incrementar("render_procesos.plantilla_enviada")
+                resultado = await asyncio.wrap_future(
+                    pool.submit(_ensamblar, clave, _paquete(entrada), contenidos, reemplazar)
+                )
+            return _registrar(resultado, inicio)
+        except BrokenProcessPool:
+            _descartar_pool(pool)
+    # El ensamblado en el hilo es CPU: va al executor de CPU y no bloquea el event loop
+    return _registrar(await asincrono.en_executor(_ensamblar_local, entrada, contenidos, reemplazar), inicio)
@@ -0,0 +1,210 @@
+import os
+import json
+import math
+import logging
+import threading
+from collections import deque
+
+from propia import metricas, consumo, enrutador_openai, transmision
+from propia.consumo import PresupuestoExcedido
+from propia.plazos import PlazoAgotado
+
+# Tabla de ruteo por sección como JSON: placeholder -> {"deployment", "max_tokens", "temperature", "fijo"}
+# {"[CARTA_PRESENTACION]": {"deployment": "gpt-4o-mini-rapido", "temperature": 0.4},
+#  "[INVERSION]": {"deployment": "gpt-4o", "temperature": 0.2, "fijo": true}}
+# Sin "deployment" se usa DEPLOYMENT_NAME (o el de cada endpoint del pool); sin "max_tokens" se usa el
+# presupuesto aprendido o el del código. "fijo" fija el modelo: sin respaldo al despliegue por defecto
+# y sin recortar max_tokens con lo aprendido.
+RUTAS_SECCIONES = os.getenv("RUTAS_SECCIONES")
+# Ajusta max_tokens de cada sección a la distribución observada de completion_tokens
+RUTAS_APRENDER_MAX_TOKENS = os.getenv("RUTAS_APRENDER_MAX_TOKENS", "true").lower() == "true"
+# Respuestas observadas por sección antes de aplicar el presupuesto aprendido
+RUTAS_MUESTRAS_MINIMAS = int(os.getenv("RUTAS_MUESTRAS_MINIMAS", "30"))
+# Percentil de completion_tokens y margen sobre él que definen el presupuesto aprendido
+RUTAS_PERCENTIL = float(os.getenv("RUTAS_PERCENTIL", "99"))
+RUTAS_MARGEN = float(os.getenv("RUTAS_MARGEN", "1.2"))
+# Últimas respuestas que se conservan por sección
+RUTAS_VENTANA = 200
+RUTAS_MAX_TOKENS_MINIMO = 64
+
+_lock = threading.Lock()
+# sección -> {"completion_tokens": deque, "al_limite": int, "max_tokens_codigo": int}
+_observaciones = {}
+_tabla = {}
+
+# ========== TABLA DE RUTEO ==========
+
+def tabla():
+    """Tabla de RUTAS_SECCIONES (se lee una vez; las claves desconocidas se reportan con un aviso)"""
+    with _lock:
+        if "rutas" in _tabla:
+            return _tabla["rutas"]
+
+    rutas = {}
+    for seccion, ruta in (json.loads(RUTAS_SECCIONES) if RUTAS_SECCIONES else {}).items():
+        desconocidas = set(ruta) - {"deployment", "max_tokens", "temperature", "fijo"}
+        if desconocidas:
+            logging.warning(f"RUTAS_SECCIONES: claves desconocidas en {seccion}: {sorted(desconocidas)}")
+        rutas[seccion] = {
+            "deployment": ruta.get("deployment"),
+            "max_tokens": int(ruta["max_tokens"]) if ruta.get("max_tokens") else None,
+            "temperature": float(ruta["temperature"]) if ruta.get("temperature") is not None else None,
+            "fijo": bool(ruta.get("fijo", False))
+        }
+    with _lock:
+        _tabla["rutas"] = rutas
+    return rutas
+
+def _percentil(valores_ordenados, p):
+    indice = min(len(valores_ordenados) - 1, max(0, math.ceil(p / 100 * len(valores_ordenados)) - 1))
+    return valores_ordenados[indice]
+
+def max_tokens_aprendido(seccion, max_tokens_codigo):
+    """
+    Presupuesto de salida a partir de las respuestas observadas de la sección: percentil
+    RUTAS_PERCENTIL por RUTAS_MARGEN, sin pasar del max_tokens del código.
+
+    :return: Tokens, o None si aún no hay RUTAS_MUESTRAS_MINIMAS respuestas.
+    """
+    with _lock:
+        observado = _observaciones.get(seccion)
+        muestras = sorted(observado["completion_tokens"]) if observado else []
+    if len(muestras) < RUTAS_MUESTRAS_MINIMAS:
+        return None
+    aprendido = math.ceil(_percentil(muestras, RUTAS_PERCENTIL) * RUTAS_MARGEN)
+    return min(max_tokens_codigo, max(RUTAS_MAX_TOKENS_MINIMO, aprendido))
+
+def resolver(pool, max_tokens):
+    """
+    Ruta de la llamada según la sección en curso (consumo.etiquetar).
+
+    :param pool: Pool por defecto (DEPLOYMENT_NAME o AZURE_OPENAI_POOL).
+    :param max_tokens: Presupuesto de salida que indica el código de la sección.
+    :return: {"seccion", "pool", "respaldo", "deployment", "max_tokens", "max_tokens_codigo",
+              "origen_max_tokens", "temperature"}; "respaldo" es el pool por defecto si se puede
+              recurrir a él cuando falla el despliegue de la sección.
+    """
+    seccion = consumo.etiqueta_actual()
+    ruta = tabla().get(seccion) or {}
+    deployment = ruta.get("deployment")
+
+    if ruta.get("max_tokens"):
+        presupuesto, origen = ruta["max_tokens"], "tabla"
+    elif RUTAS_APRENDER_MAX_TOKENS and seccion and not ruta.get("fijo"):
+        aprendido = max_tokens_aprendido(seccion, max_tokens)
+        presupuesto, origen = (aprendido, "aprendido") if aprendido else (max_tokens, "codigo")
+    else:
+        presupuesto, origen = max_tokens, "codigo"
+
+    pool_seccion = enrutador_openai.pool_con_deployment(pool, deployment) if deployment else pool
+    return {
+        "seccion": seccion,
+        "pool": pool_seccion,
+        "respaldo": pool if pool_seccion is not pool and not ruta.get("fijo") else None,
+        "deployment": deployment,
+        "max_tokens": presupuesto,
+        "max_tokens_codigo": max_tokens,
+        "origen_max_tokens": origen,
+        "temperature": ruta.get("temperature")
+    }
+
+# ========== OBSERVACIONES ==========
+
+def observar(ruta, usage):
+    """
+    Registra la longitud de una respuesta de la sección.
+
+    Una respuesta truncada por el presupuesto aprendido se registra como si hubiera necesitado
+    todo el max_tokens del código, así que el aprendido vuelve a subir.
+    """
+    seccion = ruta["seccion"]
+    completion_tokens = (usage or {}).get("completion_tokens")
+    if not seccion or completion_tokens is None:
+        return
+    al_limite = completion_tokens >= ruta["max_tokens"]
+    truncada_por_aprendido = al_limite and ruta["origen_max_tokens"] == "aprendido"
+    with _lock:
+        observado = _observaciones.setdefault(
+            seccion, {"completion_tokens": deque(maxlen=RUTAS_VENTANA), "al_limite": 0, "max_tokens_codigo": None}
+        )
+        observado["completion_tokens"].append(ruta["max_tokens_codigo"] if truncada_por_aprendido else completion_tokens)
+        observado["max_tokens_codigo"] = ruta["max_tokens_codigo"]
+        if al_limite:
+            observado["al_limite"] += 1
+    metricas.observar(f"rutas.{seccion}.completion_tokens", completion_tokens)
+    if al_limite:
+        metricas.incrementar(f"rutas.{seccion}.al_limite")
+        if truncada_por_aprendido:
+            logging.info(f"{seccion}: respuesta truncada con el presupuesto aprendido ({ruta['max_tokens']} tokens)")
+
+def estado():
+    """Ruta y presupuesto vigente de cada sección, para GET /api/metricas"""
+    rutas = tabla()
+    with _lock:
+        observaciones = {
+            seccion: (sorted(observado["completion_tokens"]), observado["al_limite"], observado["max_tokens_codigo"])
+            for seccion, observado in _observaciones.items()
+        }
+    salida = {}
+    for seccion in sorted(set(rutas) | set(observaciones)):
+        ruta = rutas.get(seccion) or {}
+        muestras, al_limite, max_tokens_codigo = observaciones.get(seccion, ([], 0, None))
+        aprende = RUTAS_APRENDER_MAX_TOKENS and max_tokens_codigo and not ruta.get("fijo") and not ruta.get("max_tokens")
+        salida[seccion] = {
+            "deployment": ruta.get("deployment"),
+            "temperature": ruta.get("temperature"),
+            "fijo": ruta.get("fijo", False),
+            "max_tokens_tabla": ruta.get("max_tokens"),
+            "max_tokens_codigo": max_tokens_codigo,
+            "max_tokens_aprendido": max_tokens_aprendido(seccion, max_tokens_codigo) if aprende else None,
+            "muestras": len(muestras),
+            "completion_tokens_p50": _percentil(muestras, 50) if muestras else None,
+            "completion_tokens_p95": _percentil(muestras, 95) if muestras else None,
+            "completion_tokens_max": muestras[-1] if muestras else None,
+            "al_limite": al_limite
+        }
+    return salida
+
+# ========== COMPLETIONS ==========
+
+def _respaldo(ruta, error):
+    metricas.incrementar("rutas.respaldo")
+    logging.warning(
+        f"{ruta['seccion']}: falló el despliegue {ruta['deployment']} ({str(error)[:200]}); "
+        f"se usa el despliegue por defecto"
+    )
+
+def completar(ruta, messages):
+    """
+    Chat completion con el despliegue, max_tokens y temperatura de la ruta. Si el despliegue de la
+    sección falla y no está fijo, se intenta una vez con el pool por defecto.
+
+    :return: Tupla (texto, usage).
+    """
+    try:
+        texto, usage = transmision.completar(ruta["pool"], messages, ruta["max_tokens"], ruta["temperature"])
+    except (PresupuestoExcedido, PlazoAgotado):
+        raise
+    except Exception as e:
+        if ruta["respaldo"] is None:
+            raise
+        _respaldo(ruta, e)
+        texto, usage = transmision.completar(ruta["respaldo"], messages, ruta["max_tokens"], ruta["temperature"])
+    observar(ruta, usage)
+    return texto, usage
+
+async def completar_async(ruta, messages):
+    """Versión asíncrona de completar"""
+    try:
+        texto, usage = await transmision.completar_async(ruta["pool"], messages, ruta["max_tokens"], ruta["temperature"])
+    except (PresupuestoExcedido, PlazoAgotado):
+        raise
+    except Exception as e:
+        if ruta["respaldo"] is None:
+            raise
+        _respaldo(ruta, e)
+        texto, usage = await transmision.completar_async(
+            ruta["respaldo"], messages, ruta["max_tokens"], ruta["temperature"]
+        )
+    observar(ruta, usage)
+    return texto, usage
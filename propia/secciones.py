@@ -0,0 +1,272 @@
+import os
+import gzip
+import json
+import time
+import logging
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from azure.core.exceptions import ResourceNotFoundError
+
+from propia import metricas, motor_xml, render_procesos, manifiesto
+from propia.almacenamiento import crear_stream_temporal, subir_desde_stream
+from propia.plantillas import copiar_plantilla, info_plantilla
+
+# Textos finales de cada sección, guardados junto al .docx para volver a renderizarlo sin el LLM
+SECCIONES_GUARDAR = os.getenv("SECCIONES_GUARDAR", "true").lower() == "true"
+SECCIONES_SUFIJO = os.getenv("SECCIONES_SUFIJO", ".secciones.json.gz")
+# Propuestas que se vuelven a renderizar a la vez
+RERENDER_HILOS = int(os.getenv("RERENDER_HILOS", "8"))
+
+_lock = threading.Lock()
+# Documento -> {"lock", "usuarios"}: el lock serializa las solicitudes para completar sus
+# secciones pendientes; la entrada se quita cuando la suelta la última que lo tenía o lo esperaba
+_locks_documento = {}
+
+# ========== REGISTRO DE SECCIONES ==========
+
+def nombre_blob(blob_docx):
+    """'propuestas/Propuesta_X.docx' -> 'propuestas/Propuesta_X.secciones.json.gz'"""
+    base = blob_docx[:-len('.docx')] if blob_docx.lower().endswith('.docx') else blob_docx
+    return base + SECCIONES_SUFIJO
+
+def nombre_documento(blob_secciones):
+    """Inverso de nombre_blob"""
+    return blob_secciones[:-len(SECCIONES_SUFIJO)] + '.docx'
+
+def serializar(registro):
+    """JSON compacto comprimido; mtime fijo para que el mismo registro produzca los mismos bytes"""
+    contenido = json.dumps(registro, ensure_ascii=False, separators=(",", ":"), sort_keys=True)
+    return gzip.compress(contenido.encode("utf-8"), mtime=0)
+
+def deserializar(datos):
+    return json.loads(gzip.decompress(datos).decode("utf-8"))
+
+def _registro(document_id, blob_docx, contenidos, plantilla, pendientes=None, prompt=None):
+    registro = {
+        "version": 1,
+        "document_id": document_id,
+        "documento": blob_docx,
+        "plantilla": plantilla,
+        "secciones": {placeholder: texto for placeholder, texto in contenidos.items() if texto}
+    }
+    # Secciones que se quedaron sin generar al agotarse el plazo, con el prompt para completarlas
+    if pendientes:
+        registro.update(pendientes=list(pendientes), prompt=prompt)
+    return registro
+
+def _guardado(blob_docx, datos, inicio):
+    metricas.observar("secciones.bytes", len(datos))
+    metricas.observar("secciones.guardado_ms", round((time.perf_counter() - inicio) * 1000, 1))
+    return nombre_blob(blob_docx)
+
+def guardar(container_client, blob_docx, document_id, contenidos, plantilla, pendientes=None, prompt=None):
+    """
+    Guarda el mapa placeholder -> texto de una propuesta junto a su .docx.
+
+    Los errores se registran en el log sin interrumpir la generación (el documento ya está subido).
+    Con `pendientes` también se guarda el prompt, para generarlas después con completar.
+
+    :return: Nombre del blob de secciones, o None si está deshabilitado o falló.
+    """
+    if not SECCIONES_GUARDAR:
+        return None
+    inicio = time.perf_counter()
+    try:
+        datos = serializar(_registro(document_id, blob_docx, contenidos, plantilla, pendientes, prompt))
+        container_client.get_blob_client(nombre_blob(blob_docx)).upload_blob(datos, overwrite=True)
+        return _guardado(blob_docx, datos, inicio)
+    except Exception as e:
+        metricas.incrementar("secciones.errores")
+        logging.error(f"Error guardando las secciones de {blob_docx}: {str(e)}")
+        return None
+
+async def guardar_async(container_client, blob_docx, document_id, contenidos, plantilla, pendientes=None, prompt=None):
+    """Versión de guardar para un ContainerClient de azure.storage.blob.aio"""
+    if not SECCIONES_GUARDAR:
+        return None
+    inicio = time.perf_counter()
+    try:
+        datos = serializar(_registro(document_id, blob_docx, contenidos, plantilla, pendientes, prompt))
+        await container_client.get_blob_client(nombre_blob(blob_docx)).upload_blob(datos, overwrite=True)
+        return _guardado(blob_docx, datos, inicio)
+    except Exception as e:
+        metricas.incrementar("secciones.errores")
+        logging.error(f"Error guardando las secciones de {blob_docx}: {str(e)}")
+        return None
+
+def leer(container_client, blob_docx):
+    """Registro de secciones de una propuesta, o None si se generó antes de guardarlas"""
+    try:
+        return deserializar(container_client.get_blob_client(nombre_blob(blob_docx)).download_blob().readall())
+    except ResourceNotFoundError:
+        return None
+
+# ========== RE-RENDER MASIVO ==========
+
+def ensamblar_documento(compilada, secciones, reemplazar, documento_stream):
+    """Aplica los textos a una copia de la plantilla y serializa; regresa {placeholder: reemplazos}"""
+    if render_procesos.habilitado():
+        docx_bytes, cambios = render_procesos.renderizar(compilada, secciones, reemplazar)
+        documento_stream.write(docx_bytes)
+        return cambios
+
+    doc, _ = copiar_plantilla(compilada)
+    cambios = {placeholder: reemplazar(doc, placeholder, texto) for placeholder, texto in secciones.items()}
+    if motor_xml.es_documento(doc):
+        motor_xml.guardar(doc, documento_stream)
+    else:
+        doc.save(documento_stream)
+    return cambios
+
+def _actualizar_manifiesto(container_client, registro, **cambios):
+    """Vuelve a registrar la propuesta con los campos cambiados (el índice conserva el último registro por id)"""
+    anterior = manifiesto.buscar_por_id(container_client, registro.get("document_id"))
+    if not anterior:
+        return
+    anterior.update(cambios)
+    manifiesto.registrar_propuesta(container_client, anterior)
+
+def rerenderizar_uno(container_client, blob_docx, compilada, reemplazar, forzar=False):
+    """
+    Vuelve a renderizar una propuesta guardada con la plantilla compilada indicada, sin llamadas al LLM.
+
+    El registro de secciones se actualiza con la plantilla nueva después de subir el documento, así
+    que una propuesta ya renderizada con esa versión se omite al reanudar un trabajo interrumpido.
+
+    :return: "rerenderizada", "al_dia" (ya usa esa versión) o "sin_secciones".
+    """
+    registro = leer(container_client, blob_docx)
+    if registro is None:
+        return "sin_secciones"
+    plantilla = info_plantilla(compilada)
+    if registro.get("plantilla") == plantilla and not forzar:
+        return "al_dia"
+
+    secciones = {p: t for p, t in registro["secciones"].items() if p in compilada["placeholders"]}
+    faltantes = sorted(p for p in compilada["placeholders"] if p not in registro["secciones"])
+    if faltantes:
+        logging.warning(f"{blob_docx}: la plantilla {plantilla['nombre']} tiene placeholders sin texto guardado: {faltantes}")
+
+    with crear_stream_temporal() as documento_stream:
+        cambios = ensamblar_documento(compilada, secciones, reemplazar, documento_stream)
+        if not sum(cambios.values()):
+            raise Exception("No se realizaron cambios en el documento")
+        transferencia = subir_desde_stream(container_client.get_blob_client(blob_docx), documento_stream)
+
+    registro["plantilla"] = plantilla
+    registro["rerenderizado"] = datetime.now(timezone.utc).isoformat()
+    container_client.get_blob_client(nombre_blob(blob_docx)).upload_blob(serializar(registro), overwrite=True)
+    _actualizar_manifiesto(
+        container_client, registro,
+        plantilla=plantilla, size_bytes=transferencia.get("bytes"), rerenderizado=registro["rerenderizado"]
+    )
+    return "rerenderizada"
+
+# ========== SECCIONES PENDIENTES ==========
+
+def completar(container_client, blob_docx, compilada, reemplazar, generar):
+    """
+    Genera las secciones que una propuesta dejó pendientes al agotarse su plazo y vuelve a subir
+    el documento con ellas, en el mismo blob; las secciones guardadas no se regeneran.
+
+    Las solicitudes simultáneas para el mismo documento se serializan: la segunda encuentra el
+    registro ya actualizado.
+
+    :param generar: Función (placeholders, prompt) -> {placeholder: texto o None}.
+    :return: {"completadas", "pendientes", "transferencia"}, o None si la propuesta no tiene registro de secciones.
+    """
+    with _lock:
+        entrada = _locks_documento.setdefault(blob_docx, {"lock": threading.Lock(), "usuarios": 0})
+        entrada["usuarios"] += 1
+    try:
+        with entrada["lock"]:
+            registro = leer(container_client, blob_docx)
+            if registro is None:
+                return None
+            pendientes = registro.get("pendientes") or []
+            if not pendientes:
+                return {"completadas": [], "pendientes": [], "transferencia": None}
+
+            nuevas = {p: t for p, t in generar(pendientes, registro["prompt"]).items() if t}
+            restantes = [p for p in pendientes if p not in nuevas]
+            transferencia = None
+            if nuevas:
+                registro["secciones"].update(nuevas)
+                textos = {p: t for p, t in registro["secciones"].items() if p in compilada["placeholders"]}
+                with crear_stream_temporal() as documento_stream:
+                    ensamblar_documento(compilada, textos, reemplazar, documento_stream)
+                    transferencia = subir_desde_stream(container_client.get_blob_client(blob_docx), documento_stream)
+                registro["plantilla"] = info_plantilla(compilada)
+
+            registro["pendientes"] = restantes
+            if not restantes:
+                del registro["pendientes"], registro["prompt"]
+            registro["completado"] = datetime.now(timezone.utc).isoformat()
+            container_client.get_blob_client(nombre_blob(blob_docx)).upload_blob(serializar(registro), overwrite=True)
+            if nuevas:
+                _actualizar_manifiesto(
+                    container_client, registro,
+                    plantilla=registro["plantilla"], size_bytes=transferencia.get("bytes"),
+                    placeholders_pendientes=restantes, completado=registro["completado"]
+                )
+    finally:
+        with _lock:
+            entrada["usuarios"] -= 1
+            if not entrada["usuarios"]:
+                _locks_documento.pop(blob_docx, None)
+
+    metricas.incrementar("secciones.completadas", len(nuevas))
+    logging.info(f"{blob_docx}: {len(nuevas)} secciones pendientes completadas, {len(restantes)} siguen pendientes")
+    return {"completadas": sorted(nuevas), "pendientes": restantes, "transferencia": transferencia}
+
+def listar_guardadas(container_client, prefijo):
+    """Documentos bajo `prefijo` que tienen registro de secciones"""
+    return [
+        nombre_documento(blob.name)
+        for blob in container_client.list_blobs(name_starts_with=prefijo)
+        if blob.name.endswith(SECCIONES_SUFIJO)
+    ]
+
+def rerenderizar(container_client, compilada, reemplazar, blobs=None, prefijo="propuestas/", hilos=None,
+                 forzar=False, al_avanzar=None):
+    """
+    Aplica una versión nueva de plantilla a un conjunto de propuestas guardadas, en paralelo.
+
+    Cada propuesta es independiente: un error se reporta y el trabajo continúa. Volver a correr el
+    trabajo reanuda donde quedó, porque las propuestas ya renderizadas con la versión se omiten.
+
+    :param blobs: Nombres de los .docx por renderizar; por defecto todos los que tienen secciones bajo `prefijo`.
+    :param reemplazar: Función (doc, placeholder, texto) -> reemplazos, p. ej. propia.reemplazar_placeholder.
+    :param al_avanzar: Función opcional (blob_docx, estado) llamada al terminar cada propuesta.
+    :return: Resumen con los conteos por estado, los errores por blob y la duración.
+    """
+    inicio = time.perf_counter()
+    blobs = listar_guardadas(container_client, prefijo) if blobs is None else list(blobs)
+    resumen = {"total": len(blobs), "rerenderizada": 0, "al_dia": 0, "sin_secciones": 0, "errores": {}}
+    lock_resumen = threading.Lock()
+
+    def una(blob_docx):
+        try:
+            estado = rerenderizar_uno(container_client, blob_docx, compilada, reemplazar, forzar)
+        except Exception as e:
+            logging.error(f"Error renderizando de nuevo {blob_docx}: {str(e)}")
+            estado = "error"
+            with lock_resumen:
+                resumen["errores"][blob_docx] = str(e)
+        else:
+            with lock_resumen:
+                resumen[estado] += 1
+        metricas.incrementar(f"secciones.rerender.{estado}")
+        if al_avanzar:
+            al_avanzar(blob_docx, estado)
+
+    with ThreadPoolExecutor(max_workers=hilos or RERENDER_HILOS) as executor:
+        list(executor.map(una, blobs))
+
+    resumen["duracion_ms"] = round((time.perf_counter() - inicio) * 1000, 1)
+    logging.info(
+        f"Re-render con {compilada['nombre']} ({compilada['etag']}): {resumen['rerenderizada']} renderizadas, "
+        f"{resumen['al_dia']} al día, {resumen['sin_secciones']} sin secciones, {len(resumen['errores'])} errores"
+    )
+    return resumen
@@ -0,0 +1,216 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from azure.core.exceptions import ResourceNotFoundError
+
+from propia import metricas, consumo, tablas
+from propia.pipeline import etapa, ejecutar_grafo
+
+# Prompts más largos que esto se condensan en una síntesis del proyecto antes de generar secciones
+PROMPT_LARGO_CARACTERES = int(os.getenv("PROMPT_LARGO_CARACTERES", "24000"))
+SINTESIS_FRAGMENTO_CARACTERES = int(os.getenv("SINTESIS_FRAGMENTO_CARACTERES", "12000"))
+SINTESIS_SOLAPE_CARACTERES = int(os.getenv("SINTESIS_SOLAPE_CARACTERES", "400"))
+# Si el texto requiere más fragmentos, los fragmentos crecen en lugar de multiplicar las llamadas
+SINTESIS_MAX_FRAGMENTOS = int(os.getenv("SINTESIS_MAX_FRAGMENTOS", "16"))
+SINTESIS_MAX_HILOS = int(os.getenv("SINTESIS_MAX_HILOS", "4"))
+SINTESIS_PREFIJO = os.getenv("SINTESIS_PREFIJO", "sintesis/")
+SINTESIS_CACHE_ENTRADAS = 100
+# Cambiar al modificar las instrucciones: invalida las síntesis guardadas
+SINTESIS_VERSION = "1"
+
+SECCIONES_SINTESIS = """CLIENTE Y CONTEXTO:
+OBJETIVOS:
+ALCANCE Y REQUERIMIENTOS:
+RESTRICCIONES Y SUPUESTOS:
+PLAZOS Y FECHAS:
+PRESUPUESTO Y MONTOS:
+EQUIPO Y ROLES:
+ENTREGABLES Y CRITERIOS DE EVALUACIÓN:
+OTROS DATOS RELEVANTES:"""
+
+_lock = threading.Lock()
+# huella del prompt -> texto de la síntesis
+_sintesis = OrderedDict()
+# huella del prompt -> {"lock", "usuarios"}; la entrada se quita cuando la suelta la última
+# solicitud que lo tenía o lo esperaba
+_locks_huella = {}
+
+# ========== FRAGMENTACIÓN ==========
+
+def fragmentar(texto, tamano=SINTESIS_FRAGMENTO_CARACTERES, solape=SINTESIS_SOLAPE_CARACTERES):
+    """
+    Divide el texto en fragmentos de hasta `tamano` caracteres, cortando de preferencia en un
+    párrafo, luego en un salto de línea y luego en una oración. Cada fragmento repite los
+    últimos `solape` caracteres del anterior para no partir un dato entre dos fragmentos.
+    """
+    tamano = max(tamano, -(-len(texto) // max(1, SINTESIS_MAX_FRAGMENTOS)))
+    fragmentos = []
+    inicio = 0
+    while inicio < len(texto):
+        fin = min(len(texto), inicio + tamano)
+        if fin < len(texto):
+            minimo = inicio + int(tamano * 0.6)
+            for separador in ("\n\n", "\n", ". "):
+                corte = texto.rfind(separador, minimo, fin)
+                if corte != -1:
+                    fin = corte + len(separador)
+                    break
+        fragmentos.append(texto[inicio:fin])
+        if fin >= len(texto):
+            break
+        inicio = max(inicio + 1, fin - solape)
+    return fragmentos
+
+# ========== MAPEO Y REDUCCIÓN ==========
+
+def _mensajes_fragmento(fragmento, indice, total):
+    return [
+        {
+            "role": "system",
+            "content": f"""Eres un analista de preventa. Vas a recibir el fragmento {indice} de {total} de una solicitud de propuesta (RFP).
+Extrae ÚNICAMENTE los hechos presentes en el fragmento, organizados en estas secciones:
+
+{SECCIONES_SINTESIS}
+
+IMPORTANTE:
+- Conserva literalmente nombres, cifras, montos, fechas y requisitos numerados
+- No inventes información; si una sección no aplica escribe "-"
+- Sin formato Markdown, solo texto con viñetas simples"""
+        },
+        {"role": "user", "content": fragmento}
+    ]
+
+def _mensajes_reduccion(parciales):
+    unidas = "\n\n".join(f"--- Síntesis del fragmento {i} ---\n{texto}" for i, texto in enumerate(parciales, 1))
+    return [
+        {
+            "role": "system",
+            "content": f"""Eres un analista de preventa. Combina las síntesis parciales de una misma solicitud de propuesta
+en una sola síntesis del proyecto con estas secciones:
+
+{SECCIONES_SINTESIS}
+
+IMPORTANTE:
+- Elimina repeticiones, pero conserva todos los datos concretos (nombres, cifras, fechas, requisitos)
+- Si dos fragmentos se contradicen, incluye ambos valores indicando la discrepancia
+- Sin formato Markdown, solo texto con viñetas simples"""
+        },
+        {"role": "user", "content": unidas}
+    ]
+
+def _generar(prompt, llamar):
+    """Condensa cada fragmento en paralelo y combina los resultados en una síntesis"""
+    fragmentos = fragmentar(prompt)
+    total = len(fragmentos)
+
+    def condensar(indice):
+        consumo.etiquetar("sintesis")
+        texto = llamar(_mensajes_fragmento(fragmentos[indice], indice + 1, total), max_tokens=900)
+        if not texto:
+            raise Exception(f"No se pudo sintetizar el fragmento {indice + 1} de {total}")
+        return texto
+
+    def reducir(entradas):
+        consumo.etiquetar("sintesis")
+        parciales = [entradas[f"fragmento:{indice}"] for indice in range(total)]
+        texto = llamar(_mensajes_reduccion(parciales), max_tokens=1500)
+        if not texto:
+            raise Exception("No se pudo combinar la síntesis del proyecto")
+        return texto
+
+    etapas = {f"fragmento:{indice}": etapa(lambda entradas, i=indice: condensar(i)) for indice in range(total)}
+    etapas["reduccion"] = etapa(reducir, dependencias=list(etapas))
+    resultados, reporte = ejecutar_grafo(etapas, max_hilos=SINTESIS_MAX_HILOS, nombre_pipeline="sintesis")
+    return resultados["reduccion"], total, reporte
+
+# ========== CACHE ==========
+
+def _leer_blob(contenedor, huella):
+    try:
+        return contenedor.get_blob_client(f"{SINTESIS_PREFIJO}{huella}.txt").download_blob().readall().decode("utf-8")
+    except ResourceNotFoundError:
+        return None
+
+def _recordar(huella, texto):
+    with _lock:
+        _sintesis[huella] = texto
+        _sintesis.move_to_end(huella)
+        while len(_sintesis) > SINTESIS_CACHE_ENTRADAS:
+            _sintesis.popitem(last=False)
+
+def preparar(prompt_completo, llamar, obtener_contenedor=None):
+    """
+    Regresa el texto con el que se generan las secciones.
+
+    Los prompts de hasta PROMPT_LARGO_CARACTERES se usan tal cual. Los más largos se dividen en
+    fragmentos que se condensan en paralelo y se combinan en una síntesis estructurada del proyecto;
+    la síntesis se guarda en memoria y en SINTESIS_PREFIJO para reutilizarla en todas las secciones
+    y en regeneraciones posteriores del mismo prompt.
+
+    :param llamar: Función (messages, max_tokens) -> texto, p. ej. call_azure_openai.
+    :param obtener_contenedor: Función sin argumentos que regresa el container client donde se
+                               guardan las síntesis (opcional; sin él solo se usa la memoria).
+    :return: Tupla (texto, info). `info` es None si el prompt no requirió síntesis.
+    """
+    if len(prompt_completo) <= PROMPT_LARGO_CARACTERES:
+        return prompt_completo, None
+
+    inicio = time.perf_counter()
+    huella = hashlib.sha256(f"{SINTESIS_VERSION}\n{prompt_completo}".encode("utf-8")).hexdigest()
+    info = {"huella": huella[:16], "caracteres_prompt": len(prompt_completo)}
+
+    with _lock:
+        entrada = _locks_huella.setdefault(huella, {"lock": threading.Lock(), "usuarios": 0})
+        entrada["usuarios"] += 1
+
+    try:
+        # Solicitudes simultáneas con el mismo prompt esperan una sola síntesis
+        with entrada["lock"]:
+            with _lock:
+                texto = _sintesis.get(huella)
+            origen = "memoria" if texto else None
+
+            contenedor = None
+            if texto is None and obtener_contenedor is not None:
+                try:
+                    contenedor = obtener_contenedor()
+                    texto = _leer_blob(contenedor, huella)
+                    origen = "blob" if texto else None
+                except Exception as e:
+                    logging.warning(f"No se pudo leer la síntesis guardada {huella[:16]}: {str(e)}")
+
+            if texto is None:
+                texto, fragmentos, reporte = _generar(prompt_completo, llamar)
+                origen = "generada"
+                info.update({"fragmentos": fragmentos, "duracion_grafo_ms": reporte["duracion_total_ms"]})
+                metricas.observar("sintesis.fragmentos", fragmentos)
+                if contenedor is not None:
+                    try:
+                        contenedor.get_blob_client(f"{SINTESIS_PREFIJO}{huella}.txt").upload_blob(
+                            texto.encode("utf-8"), overwrite=True
+                        )
+                    except Exception as e:
+                        logging.warning(f"No se pudo guardar la síntesis {huella[:16]}: {str(e)}")
+
+            _recordar(huella, texto)
+    finally:
+        # También si la síntesis falla; con solicitudes esperando, el lock se conserva para que
+        # la siguiente y las que lleguen después lo compartan
+        with _lock:
+            entrada["usuarios"] -= 1
+            if not entrada["usuarios"]:
+                _locks_huella.pop(huella, None)
+
+    duracion_ms = round((time.perf_counter() - inicio) * 1000, 1)
+    metricas.incrementar(f"sintesis.{origen}")
+    metricas.observar("sintesis.duracion_ms", duracion_ms)
+    info.update({"origen": origen, "caracteres_sintesis": len(texto), "duracion_ms": duracion_ms})
+    logging.info(
+        f"Prompt de {len(prompt_completo)} caracteres sintetizado en {len(texto)} ({origen}, {duracion_ms} ms)"
+    )
+    encabezado = f"Síntesis del proyecto (elaborada a partir de una solicitud de {len(prompt_completo)} caracteres):\n\n"
+    # Las tablas de equipo e inversión viajan tal cual: sus cifras no dependen de la síntesis
+    return tablas.anexar(prompt_completo, encabezado + texto), info
@@ -0,0 +1,256 @@
+import os
+import re
+import time
+import unicodedata
+
+from propia import metricas
+
+# Secciones que se arman sin Azure OpenAI cuando el prompt trae sus tablas (roles, montos...)
+TABLAS_RAPIDAS = os.getenv("TABLAS_RAPIDAS", "true").lower() == "true"
+# Con tablas, genera con el LLM solo un párrafo introductorio (sin cifras) antes de los bullets
+TABLAS_NARRATIVA_LLM = os.getenv("TABLAS_NARRATIVA_LLM", "false").lower() == "true"
+
+SEPARADOR = re.compile(r"^\|?\s*:?-{2,}:?\s*(\|\s*:?-{2,}:?\s*)*\|?$")
+ENCABEZADO = re.compile(r"^(#{1,6})\s+(.*)$")
+MARCADO = re.compile(r"\*\*|__|`")
+# Celda con una cifra: "$1,200", "-$86,900 MXN", "480", "50%", "$250,000 + IVA" (no "12 semanas")
+CIFRA = re.compile(
+    r"^[-−+]?\s*(?:[$€£]\s*)?[-−]?\d[\d.,' ]*(?:\s*%|\s*(?:mxn|usd|eur|mdp|k|m)\b\.?)?(?:\s*\+?\s*iva)?$",
+    re.IGNORECASE
+)
+# Notas de una tabla: líneas cortas inmediatamente después de ella ("Precios más IVA")
+NOTA_MAX_CARACTERES = 80
+NOTAS_MAX = 5
+
+# Columnas (normalizadas, sin acentos) que identifican cada tipo de tabla
+COLUMNAS_ROL = ("rol", "perfil", "puesto", "recurso", "posicion", "cargo")
+COLUMNAS_ESFUERZO = ("horas", "tarifa", "dedicacion", "subtotal", "fte", "costo", "precio")
+COLUMNAS_MONTO = ("monto", "costo", "importe", "precio", "inversion", "total", "subtotal")
+COLUMNAS_DESCRIPCION = ("descripcion", "detalle", "responsabilidad", "funcion", "actividad", "alcance")
+
+
+def _normalizar(texto):
+    sin_acentos = unicodedata.normalize("NFKD", texto).encode("ascii", "ignore").decode("ascii")
+    return sin_acentos.lower().strip()
+
+def _contiene(encabezado, claves):
+    """Si alguna palabra del encabezado es una de las claves (o su plural): "Costos" sí, "Duración total" no es "rol"."""
+    for palabra in re.findall(r"[a-z0-9]+", _normalizar(encabezado)):
+        if palabra in claves or (palabra.endswith("s") and palabra[:-1] in claves) or (
+            palabra.endswith("es") and palabra[:-2] in claves
+        ):
+            return True
+    return False
+
+def _columna_de_cifras(tabla, indice):
+    """Si la mayoría de las celdas no vacías de la columna son cifras"""
+    valores = [MARCADO.sub("", celdas[indice]).strip() for celdas in tabla["filas"] if celdas[indice]]
+    return bool(valores) and sum(1 for valor in valores if CIFRA.match(valor)) * 2 > len(valores)
+
+def _celdas(linea):
+    linea = linea.strip()
+    if linea.startswith("|"):
+        linea = linea[1:]
+    if linea.endswith("|"):
+        linea = linea[:-1]
+    return [MARCADO.sub("", celda).strip() for celda in linea.split("|")]
+
+# ========== EXTRACCIÓN ==========
+
+def _es_inicio_tabla(lineas, indice):
+    return (
+        lineas[indice].strip().startswith("|") and indice + 1 < len(lineas)
+        and SEPARADOR.match(lineas[indice + 1].strip()) is not None
+    )
+
+def _leer_notas(lineas, indice):
+    """
+    Notas de la tabla que termina en `indice`: hasta NOTAS_MAX líneas cortas seguidas, justo
+    después de la tabla o tras una línea en blanco. Un párrafo largo, un encabezado u otra tabla
+    las terminan.
+
+    :return: Tupla (notas, índice siguiente).
+    """
+    if indice < len(lineas) and not lineas[indice].strip():
+        indice += 1
+    notas = []
+    while indice < len(lineas) and len(notas) < NOTAS_MAX:
+        linea = lineas[indice].strip()
+        if not linea or len(linea) > NOTA_MAX_CARACTERES or ENCABEZADO.match(linea) or _es_inicio_tabla(lineas, indice):
+            break
+        notas.append(linea)
+        indice += 1
+    return notas, indice
+
+def extraer(texto):
+    """
+    Tablas Markdown del texto, con el título de su bloque y sus notas.
+
+    Las notas son las líneas cortas que siguen inmediatamente a la tabla, p. ej. "Precios más IVA"
+    o "Descuento por pago anticipado"; el resto del texto del bloque no se considera.
+
+    :return: Lista de {"encabezados", "filas", "titulo", "notas"}.
+    """
+    lineas = texto.splitlines()
+    tablas, titulo = [], None
+    indice = 0
+    while indice < len(lineas):
+        linea = lineas[indice].strip()
+        encabezado = ENCABEZADO.match(linea)
+        if encabezado:
+            titulo = encabezado.group(2).strip()
+        elif _es_inicio_tabla(lineas, indice):
+            encabezados = _celdas(linea)
+            filas = []
+            indice += 2
+            while indice < len(lineas) and lineas[indice].strip().startswith("|"):
+                celdas = _celdas(lineas[indice])
+                if any(celdas):
+                    filas.append((celdas + [""] * len(encabezados))[:len(encabezados)])
+                indice += 1
+            notas, indice = _leer_notas(lineas, indice)
+            tablas.append({"encabezados": encabezados, "filas": filas, "titulo": titulo, "notas": notas})
+            continue
+        indice += 1
+    return [tabla for tabla in tablas if tabla["filas"]]
+
+def es_tabla_equipo(tabla):
+    encabezados = tabla["encabezados"]
+    return _contiene(encabezados[0], COLUMNAS_ROL) and any(_contiene(e, COLUMNAS_ESFUERZO) for e in encabezados[1:])
+
+def _columnas_monto(tabla):
+    """Columnas de importe: encabezado de monto ("Monto", "Costo total") y celdas con cifras"""
+    return [
+        indice for indice, encabezado in enumerate(tabla["encabezados"])
+        if indice and _contiene(encabezado, COLUMNAS_MONTO) and _columna_de_cifras(tabla, indice)
+    ]
+
+def es_tabla_inversion(tabla):
+    return not es_tabla_equipo(tabla) and bool(_columnas_monto(tabla))
+
+# ========== FORMATO ==========
+
+def _fila(encabezados, celdas, nombres):
+    """'• Etiqueta: Descripción - Columna: valor - ...' con las celdas tal como vienen en el prompt"""
+    etiqueta = celdas[0]
+    descripcion = None
+    pares = []
+    for encabezado, nombre, valor in zip(encabezados[1:], nombres[1:], celdas[1:]):
+        if not valor:
+            continue
+        if descripcion is None and _contiene(encabezado, COLUMNAS_DESCRIPCION):
+            descripcion = valor
+        else:
+            pares.append((nombre, valor))
+    # Filas de totales y descuentos: "• Total: $X"
+    if descripcion is None and len(pares) == 1:
+        return f"• {etiqueta}: {pares[0][1]}"
+    partes = [f"{nombre}: {valor}" for nombre, valor in pares]
+    inicio = f"• {etiqueta}: {descripcion}" if descripcion else f"• {etiqueta}"
+    return " - ".join([inicio] + partes)
+
+def formatear_tabla(tabla, monto="Monto"):
+    """Bullets de una tabla; con una sola columna de importe, esa columna se nombra `monto`"""
+    encabezados = tabla["encabezados"]
+    nombres = list(encabezados)
+    columnas_monto = _columnas_monto(tabla)
+    if monto and len(columnas_monto) == 1:
+        nombres[columnas_monto[0]] = monto
+    return "\n".join(_fila(encabezados, celdas, nombres) for celdas in tabla["filas"] if celdas[0])
+
+def _notas(tablas):
+    notas, vistas = [], set()
+    for tabla in tablas:
+        if id(tabla["notas"]) in vistas:
+            continue
+        vistas.add(id(tabla["notas"]))
+        notas.extend(re.sub(r"^\s*(?:[-\*\+]|•)\s+", "• ", MARCADO.sub("", nota)) for nota in tabla["notas"])
+    return notas
+
+# Placeholder -> (criterio de la tabla, nombre de la columna de importe)
+SECCIONES_TABULARES = {
+    "[EQUIPO]": (es_tabla_equipo, None),
+    "[INVERSION]": (es_tabla_inversion, "Monto")
+}
+
+def formatear(placeholder, prompt_completo):
+    """
+    Contenido de una sección tabular armado directamente de las tablas del prompt, sin Azure OpenAI:
+    cada fila se vuelve un bullet con las cifras sin modificar, seguido de las notas de las tablas.
+
+    :return: Texto de la sección, o None si la sección no es tabular o el prompt no trae sus tablas.
+    """
+    if not TABLAS_RAPIDAS or placeholder not in SECCIONES_TABULARES:
+        return None
+    inicio = time.perf_counter()
+    criterio, monto = SECCIONES_TABULARES[placeholder]
+    tablas = [tabla for tabla in extraer(prompt_completo) if criterio(tabla)]
+    if not tablas:
+        metricas.incrementar(f"tablas.{placeholder}.sin_tabla")
+        return None
+
+    bloques = [
+        (f"{tabla['titulo']}\n" if tabla["titulo"] and len(tablas) > 1 else "") + formatear_tabla(tabla, monto)
+        for tabla in tablas
+    ]
+    notas = _notas(tablas)
+    if notas:
+        bloques.append("\n".join(notas))
+    metricas.incrementar(f"tablas.{placeholder}.locales")
+    metricas.observar("tablas.formato_ms", round((time.perf_counter() - inicio) * 1000, 2))
+    return "\n\n".join(bloques)
+
+# ========== NARRATIVA ==========
+
+def mensajes_narrativa(placeholder, prompt_completo):
+    """
+    Mensajes para el párrafo que acompaña a las tablas (TABLAS_NARRATIVA_LLM). Las cifras quedan
+    fuera del texto del modelo: solo aparecen en los bullets armados localmente.
+
+    :return: Tupla (messages, max_tokens), o None si no se usa narrativa.
+    """
+    if not TABLAS_NARRATIVA_LLM:
+        return None
+    tema = "el equipo de trabajo propuesto" if placeholder == "[EQUIPO]" else "la inversión del proyecto"
+    messages = [
+        {
+            "role": "system",
+            "content": f"""Eres un consultor experto en propuestas técnicas. Escribe ÚNICAMENTE un párrafo introductorio sobre {tema} para documentos Word.
+
+IMPORTANTE:
+- NO incluyas cifras, montos, porcentajes, horas ni tarifas (se presentan aparte en una lista)
+- NO uses formato Markdown
+- Un solo párrafo
+- No incluyas títulos ni encabezados"""
+        },
+        {
+            "role": "user",
+            "content": f"Basándote en esta información, escribe el párrafo introductorio:\n\n{prompt_completo}"
+        }
+    ]
+    return messages, 200
+
+def combinar(narrativa, contenido_tablas):
+    return f"{narrativa}\n\n{contenido_tablas}" if narrativa else contenido_tablas
+
+def anexar(prompt_original, texto):
+    """
+    Agrega al texto (p. ej. la síntesis de un prompt largo) las tablas tabulares del prompt
+    original tal cual, para que las cifras no dependan de la síntesis.
+    """
+    lineas = prompt_original.splitlines()
+    bloques, indice = [], 0
+    while indice < len(lineas):
+        if _es_inicio_tabla(lineas, indice):
+            fin = indice + 2
+            while fin < len(lineas) and lineas[fin].strip().startswith("|"):
+                fin += 1
+            bloque = "\n".join(l.strip() for l in lineas[indice:fin])
+            if any(criterio(tabla) for tabla in extraer(bloque) for criterio, _ in SECCIONES_TABULARES.values()):
+                bloques.append(bloque)
+            indice = fin
+            continue
+        indice += 1
+    if not bloques:
+        return texto
+    return texto + "\n\nTABLAS DEL DOCUMENTO ORIGINAL:\n\n" + "\n\n".join(bloques)
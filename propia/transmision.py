@@ -0,0 +1,151 @@
+import os
+import re
+import time
+import logging
+
+from propia import metricas, consumo, enrutador_openai
+
+# Transmite las completions (SSE) y corta la respuesta en cuanto la sección alcanza su límite
+OPENAI_STREAMING = os.getenv("OPENAI_STREAMING", "false").lower() == "true"
+
+# Límite estructural que las instrucciones de cada sección ya le piden al modelo
+LIMITE_PARRAFOS = re.compile(r"Máximo (\d+) párrafos")
+TITULO = re.compile(r"^#{1,6}\s+")
+VINETA = re.compile(r"^\s*(?:[-\*\+]|•)\s+")
+
+# ========== LIMPIEZA INCREMENTAL ==========
+
+def limite_de(messages):
+    """Número máximo de párrafos que piden las instrucciones de sistema, o None si no lo indican"""
+    sistema = "\n".join(m.get("content", "") for m in messages if m.get("role") == "system")
+    coincidencia = LIMITE_PARRAFOS.search(sistema)
+    return int(coincidencia.group(1)) if coincidencia else None
+
+def limpiar_linea(linea):
+    """Reglas de limpieza de Markdown que solo dependen de la línea (las de limpiar_formato_markdown)"""
+    if linea.lstrip().startswith(("|", "```")):
+        # Tablas y bloques de código se convierten al final, con todas sus líneas
+        return linea
+    linea = TITULO.sub("", linea)
+    linea = re.sub(r"\*\*(.*?)\*\*", r"\1", linea)
+    linea = re.sub(r"\*(.*?)\*", r"\1", linea)
+    return re.sub(r"^\s*[-\*\+]\s+", "• ", linea)
+
+def nuevo(limite):
+    """Estado de una respuesta transmitida; sin límite el texto se conserva tal cual"""
+    return {
+        "limite": limite,
+        "pendiente": "",
+        "lineas": [],
+        "bloques": 0,
+        "blanco": False,
+        "solo_titulo": False,
+        "vineta": False,
+        "en_codigo": False,
+        "detenido": False
+    }
+
+def _agregar_linea(estado, linea):
+    """Agrega una línea completa; regresa True si abre un bloque más allá del límite"""
+    if estado["limite"] is None:
+        estado["lineas"].append(linea)
+        return False
+
+    if linea.strip().startswith("```"):
+        estado["en_codigo"] = not estado["en_codigo"]
+    if not linea.strip() and not estado["en_codigo"]:
+        estado["blanco"] = bool(estado["lineas"])
+        return False
+
+    es_vineta = bool(VINETA.match(linea))
+    # Un bloque nuevo empieza tras una línea en blanco, salvo que continúe una lista
+    # o que el bloque anterior fuera solo un título
+    if estado["bloques"] == 0 or (
+        estado["blanco"] and not estado["en_codigo"]
+        and not (es_vineta and estado["vineta"]) and not estado["solo_titulo"]
+    ):
+        if estado["bloques"] >= estado["limite"]:
+            return True
+        estado["bloques"] += 1
+        estado["solo_titulo"] = bool(TITULO.match(linea))
+    elif not TITULO.match(linea):
+        estado["solo_titulo"] = False
+
+    if estado["blanco"]:
+        estado["lineas"].append("")
+    estado["blanco"] = False
+    estado["vineta"] = es_vineta
+    estado["lineas"].append(limpiar_linea(linea))
+    return False
+
+def alimentar(estado, fragmento):
+    """
+    Procesa un fragmento de la respuesta a medida que llega, línea por línea.
+
+    :return: True cuando la respuesta ya alcanzó el límite de párrafos y la transmisión debe cancelarse.
+    """
+    if estado["detenido"]:
+        return True
+    estado["pendiente"] += fragmento
+    *completas, estado["pendiente"] = estado["pendiente"].split("\n")
+    for linea in completas:
+        if _agregar_linea(estado, linea):
+            estado["detenido"] = True
+            return True
+    return False
+
+def terminar(estado):
+    """Texto limpio de la respuesta (sin los bloques posteriores al límite)"""
+    if estado["pendiente"] and not estado["detenido"]:
+        if _agregar_linea(estado, estado["pendiente"]):
+            estado["detenido"] = True
+        estado["pendiente"] = ""
+    return "\n".join(estado["lineas"]).strip()
+
+# ========== COMPLETIONS ==========
+
+def _resultado(messages, respuesta, estado, inicio):
+    texto = terminar(estado)
+    duracion_ms = round((time.perf_counter() - inicio) * 1000, 1)
+    metricas.observar("openai.stream.duracion_ms", duracion_ms)
+    if respuesta.get("primer_fragmento_ms") is not None:
+        metricas.observar("openai.stream.primer_fragmento_ms", respuesta["primer_fragmento_ms"])
+    if respuesta.get("cancelada"):
+        metricas.incrementar("openai.stream.cortadas")
+        logging.info(f"Respuesta cortada al alcanzar {estado['limite']} párrafos ({len(texto)} caracteres, {duracion_ms} ms)")
+    # Sin bloque usage (respuesta cortada o API sin stream_options) el consumo se estima
+    return texto, respuesta.get("usage") or consumo.estimar_uso(messages, texto)
+
+def completar(pool, messages, max_tokens, temperature=None):
+    """
+    Genera la respuesta de una chat completion.
+
+    Con OPENAI_STREAMING la respuesta se transmite, se limpia línea por línea y se cancela
+    en cuanto abre un párrafo más de los que piden las instrucciones de sistema, en lugar de
+    esperar a que el modelo llegue a `max_tokens`.
+
+    :return: Tupla (texto, usage).
+    """
+    if not OPENAI_STREAMING:
+        respuesta = enrutador_openai.completar(pool, messages, max_tokens, temperature)
+        return respuesta['choices'][0]['message']['content'].strip(), respuesta.get('usage')
+
+    inicio = time.perf_counter()
+    estado = nuevo(limite_de(messages))
+    respuesta = enrutador_openai.completar_stream(
+        pool, messages, max_tokens, lambda texto: alimentar(estado, texto), temperature
+    )
+    return _resultado(messages, respuesta, estado, inicio)
+
+async def completar_async(pool, messages, max_tokens, temperature=None):
+    """Versión asíncrona de completar"""
+    if not OPENAI_STREAMING:
+        respuesta = await enrutador_openai.completar_async(pool, messages, max_tokens, temperature)
+        return respuesta['choices'][0]['message']['content'].strip(), respuesta.get('usage')
+
+    inicio = time.perf_counter()
+    estado = nuevo(limite_de(messages))
+    respuesta = await enrutador_openai.completar_stream_async(
+        pool, messages, max_tokens, lambda texto: alimentar(estado, texto), temperature
+    )
+    return _resultado(messages, respuesta, estado, inicio)